@@ -1,10 +1,17 @@
-from mediapub_extensions.ApiWrappers.Wordpress import Wordpress
-from mediapub_extensions.ApiWrappers.Snowflake import Snowflake
-from mediapub_extensions.ApiWrappers.Snowflake import GoogleAnalytics
-from mediapub_extensions.ApiWrappers.BigQuery import BigQuery
-from mediapub_extensions.ApiWrappers.SQLServer import SQLServer
-from mediapub_extensions.ApiWrappers.GoogleAdManager import GoogleAdManager
+import importlib
 
 __version__ = '1.0.beta'
 __author__ = 'David Parks businessintelligence@seattletimes.com'
-__all__ = []
+
+# Wrappers are resolved lazily through mediapub_extensions, see its __init__
+__all__ = ['BigQuery', 'GoogleAdManager', 'GoogleAnalytics', 'Snowflake', 'SQLServer', 'Wordpress']
+
+
+def __getattr__(name):
+    if name not in __all__:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return getattr(importlib.import_module('mediapub_extensions'), name)
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,61 @@
+"""
+Import time benchmark for the package entry point
+
+Imports each wrapper through mediapub_extensions in a fresh interpreter and
+reports the wall time and which SDKs were loaded.  Importing one wrapper
+should only load that wrapper's SDK.
+
+Usage:
+    python benchmarks/import_time.py [--repeat N] [wrapper ...]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WRAPPERS = ['Wordpress', 'SQLServer', 'Snowflake', 'BigQuery', 'GoogleAnalytics', 'GoogleAdManager']
+SDKS = ['requests', 'pyodbc', 'snowflake.connector', 'google.cloud.bigquery', 'googleads', 'apiclient', 'oauth2client']
+
+# Run in the child interpreter: time the import and list the SDKs that ended up in sys.modules
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import mediapub_extensions
+error = None
+if {name!r}:
+    try:
+        getattr(mediapub_extensions, {name!r})
+    except ImportError as e:
+        error = str(e)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'error': error, 'sdks': [m for m in {sdks!r} if m in sys.modules]}}))
+"""
+
+
+def probe(name):
+    """ Import one wrapper (or just the package when name is empty) in a fresh interpreter """
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.check_output([sys.executable, '-c', PROBE.format(name=name, sdks=SDKS)], env=env)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('wrappers', nargs='*', default=[''] + WRAPPERS, help="wrappers to import, default is all of them")
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per wrapper")
+    args = parser.parse_args()
+
+    print("{:<18} {:>10} {:>10}  {}".format('import', 'median ms', 'max ms', 'sdks loaded'))
+    for name in args.wrappers:
+        runs = [probe(name) for _ in range(args.repeat)]
+        times = [run['seconds'] * 1000 for run in runs]
+        loaded = runs[-1]['error'] or ', '.join(runs[-1]['sdks']) or '-'
+        print("{:<18} {:>10.1f} {:>10.1f}  {}".format(name or '(package)', statistics.median(times), max(times), loaded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+Offline throughput benchmarks for the wrappers
+
+Runs each wrapper against the local stand-ins in standins.py and reports
+rows/sec, call latency percentiles and peak traced memory.  Nothing here
+touches the network or needs credentials, so it can run in CI.  A case is
+skipped when its wrapper's SDK is not installed.
+
+Usage:
+    python benchmarks/run.py [--repeat N] [--scale X] [--json results.json] [case ...]
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import standins
+
+CASES = []
+
+
+def case(name):
+    """ Register a benchmark case.  The case takes (workdir, scale) and returns a callable that returns a row count. """
+
+    def register(function):
+        CASES.append((name, function))
+        return function
+    return register
+
+
+#####################################################
+# Cases
+#####################################################
+
+@case('wordpress.get_posts')
+def wordpress_get_posts(workdir, scale):
+    from mediapub_extensions.ApiWrappers.Wordpress import Wordpress
+
+    server = standins.WordpressServer(pages=int(20 * scale), per_page=10, latency=0.002)
+    server.start()
+    wp = Wordpress(prod_url=server.url, stage_url=server.url)
+    run = lambda: len(wp.get_posts(env='prod', per_page=10))
+    run.cleanup = server.stop
+    return run
+
+
+@case('google_analytics.parse_response')
+def google_analytics_parse_response(workdir, scale):
+    from mediapub_extensions.ApiWrappers.GoogleAnalytics import GoogleAnalytics
+
+    ga = GoogleAnalytics.__new__(GoogleAnalytics) # Skip the credentials, the stand-in needs none
+    ga.VIEW_ID = 'benchmark'
+    ga.requests = []
+    ga.analytics = standins.FakeAnalytics(rows_per_report=int(5000 * scale))
+    params = {'metrics': ['ga:pageviews', 'ga:avgTimeOnPage'], 'dimensions': ['ga:dimension18', 'ga:dimension17', 'ga:date']}
+
+    def run():
+        ga.add_query_to_request(params)
+        return sum(len(report) for report in ga.parse_response(ga.send_requests()))
+    return run
+
+
+def _sqlserver(path, pool_size=None):
+    """ Build a SQLServer on the sqlite stand-in, returns it and the patch to stop when the case is done """
+
+    from mediapub_extensions.ApiWrappers import SQLServer as module
+
+    #NOTE: The pool opens connections lazily, so the stand-in stays patched in for the life of the case
+    patch = mock.patch.object(module.pyodbc, 'connect', lambda conn_string: standins.SqliteODBCConnection(path))
+    patch.start()
+    sql = module.SQLServer(dsn='benchmark', user_id='benchmark', password='benchmark', pool_size=pool_size)
+    return sql, patch
+
+
+@case('sqlserver.run_query')
+def sqlserver_run_query(workdir, scale):
+    path = standins.create_table(os.path.join(workdir, 'sqlserver.db'), rows=int(100000 * scale))
+    sql, patch = _sqlserver(path)
+    run = lambda: len(sql.run_query('SELECT * FROM starts'))
+    run.cleanup = patch.stop
+    return run
+
+
+@case('sqlserver.stream_query')
+def sqlserver_stream_query(workdir, scale):
+    path = standins.create_table(os.path.join(workdir, 'sqlserver.db'), rows=int(100000 * scale))
+    sql, patch = _sqlserver(path)
+
+    def run():
+        cols, batches = sql.stream_query('SELECT * FROM starts', batch_size=5000, row_format='tuple')
+        return sum(len(batch) for batch in batches)
+    run.cleanup = patch.stop
+    return run
+
+
+@case('sqlserver.run_query_result')
+def sqlserver_run_query_result(workdir, scale):
+    path = standins.create_table(os.path.join(workdir, 'sqlserver.db'), rows=int(100000 * scale))
+    sql, patch = _sqlserver(path)
+    run = lambda: len(sql.run_query_result('SELECT * FROM starts'))
+    run.cleanup = patch.stop
+    return run
+
+
+@case('sqlserver.pooled_concurrent')
+def sqlserver_pooled_concurrent(workdir, scale):
+    path = standins.create_table(os.path.join(workdir, 'sqlserver.db'), rows=int(10000 * scale))
+    sql, patch = _sqlserver(path, pool_size=4)
+    executor = ThreadPoolExecutor(max_workers=8)
+
+    def run():
+        queries = ['SELECT * FROM starts WHERE id % 16 = {}'.format(i) for i in range(16)]
+        return sum(len(rows) for rows in executor.map(sql.run_query, queries))
+
+    def cleanup():
+        executor.shutdown()
+        patch.stop()
+    run.cleanup = cleanup
+    return run
+
+
+@case('sqlserver.extract_partitioned')
+def sqlserver_extract_partitioned(workdir, scale):
+    path = standins.create_table(os.path.join(workdir, 'sqlserver.db'), rows=int(100000 * scale))
+    sql, patch = _sqlserver(path, pool_size=4)
+
+    def run():
+        cols, batches = sql.extract_partitioned('starts', 'id', partitions=8, ordered=False, batch_size=5000)
+        return sum(len(batch) for batch in batches)
+    run.cleanup = patch.stop
+    return run
+
+
+@case('snowflake.run_query')
+def snowflake_run_query(workdir, scale):
+    from mediapub_extensions.ApiWrappers.Snowflake import Snowflake
+
+    path = standins.create_table(os.path.join(workdir, 'snowflake.db'), rows=int(100000 * scale))
+    sf = Snowflake.__new__(Snowflake) # Skip the login, the stand-in needs none
+    sf.verbose = False
+    sf.ctx = standins.SqliteSnowflakeConnection(path)
+    sf.set_environment_settings()
+    return lambda: len(sf.run_query('SELECT * FROM starts'))
+
+
+@case('google_ad_manager.read_temp_file')
+def google_ad_manager_read_temp_file(workdir, scale):
+    from mediapub_extensions.ApiWrappers.GoogleAdManager import GoogleAdManager
+
+    path = standins.write_report_dump(os.path.join(workdir, 'report.csv'), rows=int(100000 * scale))
+    dfp = GoogleAdManager.__new__(GoogleAdManager) # Skip the login, reading a recorded dump needs no client
+    return lambda: len(dfp._read_temp_file(path)[0])
+
+
+@case('google_ad_manager.stream_report')
+def google_ad_manager_stream_report(workdir, scale):
+    from mediapub_extensions.ApiWrappers.GoogleAdManager import GoogleAdManager
+
+    path = standins.write_report_dump(os.path.join(workdir, 'report.csv.gz'), rows=int(100000 * scale), compress=True)
+    dfp = GoogleAdManager.__new__(GoogleAdManager)
+    dfp.client = standins.FakeAdManagerClient(path)
+    return lambda: sum(1 for row in dfp.stream_report(1)[0])
+
+
+#####################################################
+# Harness
+#####################################################
+
+def measure(run, repeat):
+    """ Time repeat calls, then trace one more call for its peak memory """
+
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = run()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    median = statistics.median(latencies)
+    return {
+        'rows': rows,
+        'rows_per_sec': rows / median if median else 0.0,
+        'latency_p50': median,
+        'latency_p95': latencies[min(int(round(0.95 * len(latencies))) - 1, len(latencies) - 1)] if latencies else 0.0,
+        'latency_max': latencies[-1],
+        'peak_mb': peak / 1024.0 / 1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cases', nargs='*', help="case names or prefixes, default is all of them")
+    parser.add_argument('--repeat', type=int, default=5, help="timed calls per case")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply the stand-in data sizes")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    selected = [(name, setup) for name, setup in CASES if not args.cases or any(name.startswith(prefix) for prefix in args.cases)]
+    results = {}
+    print("{:<36} {:>10} {:>12} {:>9} {:>9} {:>9} {:>9}".format('case', 'rows', 'rows/sec', 'p50 ms', 'p95 ms', 'max ms', 'peak MB'))
+    for name, setup in selected:
+        workdir = tempfile.mkdtemp(prefix='mediapub_benchmark_')
+        try:
+            try:
+                run = setup(workdir, args.scale)
+            except ImportError as e:
+                results[name] = {'skipped': str(e)}
+                print("{:<36} skipped: {}".format(name, e))
+                continue
+            try:
+                result = results[name] = measure(run, args.repeat)
+            finally:
+                if hasattr(run, 'cleanup'): run.cleanup()
+            print("{:<36} {:>10} {:>12,.0f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+                name, result['rows'], result['rows_per_sec'], result['latency_p50'] * 1000,
+                result['latency_p95'] * 1000, result['latency_max'] * 1000, result['peak_mb']))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
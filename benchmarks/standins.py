@@ -0,0 +1,314 @@
+"""
+Local stand-ins for the services behind the wrappers
+
+Everything here runs in-process or on localhost so the benchmarks need no
+network or credentials:
+    WordpressServer: a WordPress REST API serving generated posts
+    FakeAnalytics: a Google Analytics Reporting v4 batchGet service
+    SqliteODBCConnection: a sqlite database behind the pyodbc connection interface
+    SqliteSnowflakeConnection: a sqlite database behind the snowflake connection interface
+    write_report_dump: an Ad Manager CSV_DUMP with report properties
+"""
+import csv
+import gzip
+import json
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+#####################################################
+# Wordpress
+#####################################################
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WordpressServer(object):
+    """
+    A WordPress REST API on localhost
+
+    Serves /wp/v2/posts/ with per_page posts on each of pages pages, and the
+    rest_post_invalid_page_number error past the last page.  Each response
+    is delayed by latency seconds.
+
+    Example:
+        with WordpressServer(pages=20, latency=0.01) as server:
+            wp = Wordpress(prod_url=server.url, stage_url=server.url)
+    """
+
+    def __init__(self, pages=10, per_page=10, latency=0.0, body_size=2000):
+        self.pages = pages
+        self.per_page = per_page
+        self.latency = latency
+        self.body_size = body_size
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/".format(self._server.server_address[1])
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                standin.requests += 1
+                if standin.latency: time.sleep(standin.latency)
+                status, body = standin.respond(urlparse(self.path))
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, url):
+        """ Build the status and JSON body for a request """
+
+        parts = [part for part in url.path.split('/') if part]
+        if parts[-1].isdigit(): return 200, self.post(int(parts[-1]))
+
+        page = int(parse_qs(url.query).get('page', ['1'])[0] or 1)
+        if page > self.pages:
+            return 400, {'code': 'rest_post_invalid_page_number', 'message': 'The page number requested is larger than the number of pages available.'}
+        first = (page - 1) * self.per_page
+        return 200, [self.post(post_id) for post_id in range(first, first + self.per_page)]
+
+    def post(self, post_id):
+        return {
+            'id': post_id,
+            'date': '2018-05-07T07:{:02d}:00'.format(post_id % 60),
+            'title': {'rendered': 'Post &#039;{}&#039; &amp; more'.format(post_id)},
+            'content': {'rendered': '<p>{}</p>'.format('x' * self.body_size)},
+            'categories': [post_id % 7],
+            'tags': [post_id % 11, post_id % 13],
+        }
+
+
+#####################################################
+# Google Analytics
+#####################################################
+
+class FakeAnalytics(object):
+    """
+    A stand-in for build('analyticsreporting', 'v4')
+
+    Each report request returns rows_per_report generated rows for its
+    dimensions and metrics after latency seconds.
+    """
+
+    def __init__(self, rows_per_report=1000, latency=0.0, seed=0):
+        self.rows_per_report = rows_per_report
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.calls = 0
+
+    def reports(self):
+        return self
+
+    def batchGet(self, body):
+        requests = body['reportRequests']
+        if isinstance(requests, dict): requests = [requests]
+        return _Execute(lambda: self.__batch_get(requests))
+
+    def __batch_get(self, requests):
+        self.calls += 1
+        if self.latency: time.sleep(self.latency)
+        return {'reports': [self.report(request) for request in requests]}
+
+    def report(self, request):
+        dimensions = [dimension['name'] for dimension in request['dimensions']]
+        metrics = [metric['expression'] for metric in request['metrics']]
+        rows = []
+        for i in range(self.rows_per_report):
+            rows.append({
+                'dimensions': ["{} &#039;{}&#039;".format(dimension, i) for dimension in dimensions],
+                'metrics': [{'values': [str(self.random.randint(0, 10000)) for _ in metrics]}],
+            })
+        return {
+            'columnHeader': {
+                'dimensions': dimensions,
+                'metricHeader': {'metricHeaderEntries': [{'name': metric, 'type': 'INTEGER'} for metric in metrics]},
+            },
+            'data': {'rows': rows, 'rowCount': len(rows)},
+        }
+
+
+class _Execute(object):
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self):
+        return self.function()
+
+
+#####################################################
+# SQL Server and Snowflake
+#####################################################
+
+def create_table(path, table='starts', rows=100000, seed=0):
+    """ Create a sqlite table of generated reporting rows, returns the path """
+
+    generator = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("DROP TABLE IF EXISTS {}".format(table))
+    conn.execute("CREATE TABLE {} (id INTEGER PRIMARY KEY, day TEXT, product TEXT, starts INTEGER, revenue REAL)".format(table))
+    conn.executemany("INSERT INTO {} VALUES (?, ?, ?, ?, ?)".format(table), (
+        (i, '2019-{:02d}-{:02d}'.format(i % 12 + 1, i % 28 + 1), 'product {}'.format(i % 17),
+         generator.randint(0, 500), generator.random() * 1000) for i in range(rows)))
+    conn.commit()
+    conn.close()
+    return path
+
+
+class SqliteODBCConnection(object):
+    """ A sqlite database behind the parts of the pyodbc connection interface the wrapper uses """
+
+    def __init__(self, path, latency=0.0):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self.latency = latency
+
+    def cursor(self):
+        return SqliteCursor(self._conn.cursor(), self.latency)
+
+    def execute(self, query):
+        return self.cursor().execute(query)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+class SqliteSnowflakeConnection(SqliteODBCConnection):
+    """ A sqlite database behind the snowflake connection interface, USE statements are ignored """
+
+    def cursor(self):
+        return SqliteCursor(self._conn.cursor(), self.latency, ignore=('USE ',))
+
+
+class SqliteCursor(object):
+    """ A DB-API cursor that adds latency to execute and skips ignored statements """
+
+    def __init__(self, cursor, latency=0.0, ignore=()):
+        self._cursor = cursor
+        self.latency = latency
+        self.ignore = ignore
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, query, *params):
+        if query.strip().upper().startswith(self.ignore or ('\0',)): return self
+        if self.latency: time.sleep(self.latency)
+        #NOTE: pyodbc takes the parameters as separate arguments or as one sequence
+        if len(params) == 1 and isinstance(params[0], (list, tuple)): params = params[0]
+        self._cursor.execute(query, params)
+        return self
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def close(self):
+        self._cursor.close()
+
+
+#####################################################
+# Google Ad Manager
+#####################################################
+
+REPORT_PROPERTIES = [
+    ['Report properties'],
+    ['Network', 'Benchmark Network'],
+    ['Date range', 'Last week'],
+    ['Report timezone', 'AD_EXCHANGE'],
+    ['Currency', 'USD'],
+    ['Generated', '2019-09-01 00:00:00'],
+    ['Report type', 'Ad Exchange'],
+    [],
+]
+REPORT_COLUMNS = ['Dimension.AD_EXCHANGE_DATE', 'Dimension.AD_EXCHANGE_PRODUCT_NAME', 'Dimension.AD_EXCHANGE_PRICING_RULE_NAME',
+                  'Dimension.AD_EXCHANGE_TRANSACTION_TYPE', 'Column.AD_EXCHANGE_AD_REQUESTS', 'Column.AD_EXCHANGE_IMPRESSIONS',
+                  'Column.AD_EXCHANGE_ESTIMATED_REVENUE']
+
+
+def write_report_dump(path, rows=100000, compress=False, seed=0):
+    """ Write a CSV_DUMP report with report properties like DownloadReportToFile does, returns the path """
+
+    generator = random.Random(seed)
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerows(REPORT_PROPERTIES)
+        writer.writerow(REPORT_COLUMNS)
+        for i in range(rows):
+            writer.writerow(['2019-08-{:02d}'.format(i % 7 + 1), 'Display', 'Rule {}'.format(i % 40), 'Open auction',
+                             generator.randint(0, 100000), generator.randint(0, 50000), '{:.2f}'.format(generator.random() * 500)])
+    return path
+
+
+class FakeDataDownloader(object):
+    """ Serves a recorded report dump to GoogleAdManager's download methods """
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+
+    def WaitForReport(self, report_job):
+        if self.latency: time.sleep(self.latency)
+        return 1
+
+    def DownloadReportToFile(self, report_job_id, export_format, outfile, include_report_properties=False, use_gzip_compression=True, **kwargs):
+        with open(self.path, 'rb') as file:
+            data = file.read()
+        if use_gzip_compression and not data.startswith(b'\x1f\x8b'): data = gzip.compress(data)
+        if not use_gzip_compression and data.startswith(b'\x1f\x8b'): data = gzip.decompress(data)
+        outfile.write(data)
+
+
+class FakeAdManagerClient(object):
+    """ The parts of AdManagerClient the report download path uses """
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+
+    def GetDataDownloader(self, version=None):
+        return FakeDataDownloader(self.path, self.latency)
@@ -7,6 +7,11 @@ from google.cloud.bigquery.job import DestinationFormat
 from google.cloud import storage
 import os
 import json
+import queue
+import threading
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.Credentials import credentials as shared_credentials
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
 
 class BigQuery(object):
     """
@@ -17,16 +22,26 @@ class BigQuery(object):
     Requires:
         google-api-python-client: pip install google-api-python-client
         google-cloud: pip install google-cloud==0.27.0
+        pyarrow and google-cloud-bigquery-storage for the Arrow methods (optional):
+            pip install mediapub_extensions[bigquery-storage]
 
     Attributes:
         client (google.cloud.bigquery.Client): The BigQuery connection
         project (str): The Google Cloud project
         verbose (bool): The verbosity flag
+        instrumentation (Instrumentation): Receives the timing and row counts of each call
+        credential_manager (CredentialManager): Shares the key file and access tokens with other instances
+        read_queue_size (int): Arrow batches each read stream may buffer ahead of the consumer
     """
     client = None
     verbose = False
     project = None
     credentials = None
+    instrumentation = instrumentation
+    credential_manager = shared_credentials
+    storage_client = None
+    read_client = None
+    read_queue_size = 4
 
     # dataset = None
     # storageClient = None
@@ -45,9 +60,9 @@ class BigQuery(object):
         self.project = project
         self.credentials = cred_file
         if self.verbose: print('initializing BigQuery client...')
-        #NOTE: The Client only takes specific Google data formats, the from_service_account_json generates the proper format from a json file
+        #NOTE: The Client only takes specific Google data formats, the credential manager builds them from the json file once per process
         #NOTE: I am not sure if this project param does anything
-        self.client = bigquery.Client.from_service_account_json(self.credentials, project=self.project)
+        self.client = bigquery.Client(project=self.project, credentials=self.credential_manager.get_google_credentials(self.credentials))
 
     def run_query(self, query, use_legacy_sql=False, query_id=str(uuid.uuid4()), use_query_cache=True ,destination_dataset=None, destination_table=None, truncate=False):
         """
@@ -80,22 +95,25 @@ class BigQuery(object):
             else:
                 job.write_disposition = (google.cloud.bigquery.job.WriteDisposition.WRITE_APPEND)
         if self.verbose: print("Starting Query")
-        job.begin()
-        self.wait_for_job(job)
-        results = job.query_results()
+        with self.instrumentation.measure('BigQuery', 'run_query') as event:
+            job.begin()
+            event.retries = self.wait_for_job(job)
+            results = job.query_results()
         return results
 
     def wait_for_job(self,job):
-        """ Blocking poll for query status """
+        """ Blocking poll for query status, returns the number of polls """
 
         if self.verbose: print("Waiting for results...")
+        polls = 0
         while True:
             job.reload()
+            polls += 1
             # Retry the job every second until it finishes.  Throw an exception if it fails.
             if job.state == 'DONE':
                 if job.error_result:
                     raise RuntimeError(job.errors)
-                return
+                return polls
             time.sleep(1)
 
     def process_results(self, results, max_results=1000, fetch_all=True):
@@ -118,17 +136,20 @@ class BigQuery(object):
         page_token = None
         cols = []
         data = []
-        rows = results.fetch_data(max_results=max_results, page_token=page_token)
-
-        while fetch_all:
-            if self.verbose: print("Fetching next page...")
-            row_dat = list(rows)
-            for row in row_dat:
-                data.append(row)
-            #TODO: This makes a list of lists, where each inner list is a page of results... stop that!
-            if rows.next_page_token is None: # Stop looping on the last page of results
-                break
-            rows = results.fetch_data(max_results=max_results, page_token=rows.next_page_token)
+        with self.instrumentation.measure('BigQuery', 'process_results') as event:
+            rows = results.fetch_data(max_results=max_results, page_token=page_token)
+
+            while fetch_all:
+                if self.verbose: print("Fetching next page...")
+                row_dat = list(rows)
+                event.pages += 1
+                for row in row_dat:
+                    data.append(row)
+                #TODO: This makes a list of lists, where each inner list is a page of results... stop that!
+                if rows.next_page_token is None: # Stop looping on the last page of results
+                    break
+                rows = results.fetch_data(max_results=max_results, page_token=rows.next_page_token)
+            event.rows = len(data)
 
         schema = results.schema
         for col in schema:
@@ -138,6 +159,169 @@ class BigQuery(object):
         if self.verbose: print("Processed " + str(tot) + " results")
         return data, cols, tot
 
+    def process_query_result(self, results, max_results=1000):
+        """
+        Process the results from a QueryResults object into a QueryResult
+
+        Args:
+            results (google.cloud.bigquery.query.QueryResults): The results of the query
+            max_results (int): The maximum number of results to return on each page
+
+        Returns:
+            QueryResult: The columnar results, with the total_rows in the meta
+        """
+
+        data, cols, tot = self.process_results(results, max_results=max_results)
+        return QueryResult.from_rows(data, cols, meta={'total_rows': tot})
+
+    def stream_results_arrow(self, results, max_streams=4, ordered=False, max_results=10000):
+        """
+        Stream the results of a finished query as Arrow record batches
+
+        Opens up to max_streams BigQuery Storage read streams over the query's
+        destination table and decodes them on parallel threads.  Batches are
+        yielded as they arrive, or stream by stream when ordered is set (the
+        row order of the streams themselves is up to BigQuery).  Each stream
+        buffers at most read_queue_size batches ahead of the consumer.
+
+        Falls back to process_results style paging when the Storage API
+        client is not installed or the session cannot be opened, e.g. when the
+        API is not enabled for the project.  Requires pyarrow, install the
+        bigquery-storage extra for both.
+
+        Args:
+            results (google.cloud.bigquery.query.QueryResults): The results of the query
+            max_streams (int): The most read streams to open
+            ordered (bool): Yield the streams one after another instead of interleaved
+            max_results (int): The page size when falling back to paging
+
+        Returns:
+            cols (list): The column names
+            batches (generator): pyarrow.RecordBatch objects
+        """
+
+        _import_pyarrow()
+        cols = [col.name for col in results.schema]
+        session = self._open_read_session(results, max_streams)
+        if session is None:
+            batches = self.__iter_result_pages(results, cols, max_results)
+            return cols, self.instrumentation.measure_iter(batches, 'BigQuery', 'stream_results_arrow', mode='paging')
+        batches = self.__iter_read_streams(session, ordered)
+        return cols, self.instrumentation.measure_iter(batches, 'BigQuery', 'stream_results_arrow', mode='read_streams', streams=len(session.streams))
+
+    def process_results_arrow(self, results, max_streams=4, max_results=10000):
+        """
+        Read the results of a finished query into a pyarrow.Table
+
+        Merges the read streams of stream_results_arrow, or falls back to
+        process_query_result when they are not available.  Requires pyarrow.
+
+        Returns:
+            pyarrow.Table: The results
+        """
+
+        pyarrow = _import_pyarrow()
+        session = self._open_read_session(results, max_streams)
+        if session is None: return self.process_query_result(results, max_results=max_results).to_arrow()
+        batches = self.instrumentation.measure_iter(self.__iter_read_streams(session, ordered=True), 'BigQuery', 'process_results_arrow', streams=len(session.streams))
+        schema = pyarrow.ipc.read_schema(pyarrow.py_buffer(session.arrow_schema.serialized_schema))
+        return pyarrow.Table.from_batches(list(batches), schema=schema)
+
+    def get_read_client(self):
+        """ Get the BigQuery Storage read client, built once per instance from the shared credentials """
+
+        if self.read_client is None:
+            try:
+                from google.cloud import bigquery_storage
+            except ImportError:
+                raise ImportError("The BigQuery Storage read client needs google-cloud-bigquery-storage 2.x: "
+                                  "pip install mediapub_extensions[bigquery-storage]") from None
+            self.read_client = bigquery_storage.BigQueryReadClient(credentials=self.credential_manager.get_google_credentials(self.credentials))
+        return self.read_client
+
+    def _open_read_session(self, results, max_streams):
+        """ Open an Arrow read session over the query's destination table, None when the fast path is not available """
+
+        try:
+            from google.cloud.bigquery_storage import types
+            from google.api_core.exceptions import GoogleAPIError
+        except ImportError:
+            if self.verbose: print("google-cloud-bigquery-storage is not installed (pip install mediapub_extensions[bigquery-storage]), paging through the results")
+            return None
+
+        try:
+            job = results.job
+            if job is None: raise AttributeError("the results have no job")
+            if job.destination is None: job.reload()
+            table = job.destination
+            if table is None: raise AttributeError("the query has no destination table")
+            if hasattr(table, 'dataset_name'):
+                #NOTE: The pinned google-cloud 0.27 client names the parts dataset_name and name, its table_id is the full 'project:dataset.table'
+                dataset_id, table_id = table.dataset_name, table.name
+            else:
+                dataset_id, table_id = table.dataset_id, table.table_id
+            path = "projects/{}/datasets/{}/tables/{}".format(table.project, dataset_id, table_id)
+            requested = types.ReadSession(table=path, data_format=types.DataFormat.ARROW)
+            session = self.get_read_client().create_read_session(parent="projects/{}".format(self.project), read_session=requested, max_stream_count=max_streams)
+        except (AttributeError, GoogleAPIError) as e:
+            if self.verbose: print("Could not open read streams ({}), paging through the results".format(e))
+            return None
+        if self.verbose: print("Reading {} with {} streams".format(path, len(session.streams)))
+        return session
+
+    def __iter_read_streams(self, session, ordered):
+        # Decode every stream on its own thread, each into a bounded queue, and yield the batches.
+
+        done = object()
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.read_queue_size) for _ in session.streams]
+        if not ordered: queues = [queue.Queue(maxsize=self.read_queue_size * len(session.streams))] * len(session.streams)
+
+        def put(out_queue, item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read(stream, out_queue):
+            try:
+                for page in self.get_read_client().read_rows(stream.name).rows(session).pages:
+                    if not put(out_queue, page.to_arrow()): return
+                put(out_queue, done)
+            except BaseException as e: # Raised in the consumer instead
+                put(out_queue, e)
+
+        threads = [threading.Thread(target=read, args=(stream, out_queue), name='bigquery-read-{}'.format(i), daemon=True)
+                   for i, (stream, out_queue) in enumerate(zip(session.streams, queues))]
+        for thread in threads: thread.start()
+        try:
+            remaining = len(threads)
+            position = 0
+            while remaining:
+                item = queues[position].get()
+                if isinstance(item, BaseException): raise item
+                if item is done:
+                    remaining -= 1
+                    if ordered: position += 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+            for thread in threads: thread.join()
+
+    def __iter_result_pages(self, results, cols, max_results):
+        # The fallback, each fetch_data page as a record batch.
+
+        rows = results.fetch_data(max_results=max_results)
+        while True:
+            page = QueryResult.from_rows([tuple(row) for row in rows], cols).to_arrow()
+            for batch in page.to_batches(): yield batch
+            if rows.next_page_token is None: break
+            rows = results.fetch_data(max_results=max_results, page_token=rows.next_page_token)
+
     def export_table(self, project, dataset, table_id, bucket, filename, format="NEWLINE_DELIMITED_JSON"):
         """
         Saves a table to GCS
@@ -162,37 +346,57 @@ class BigQuery(object):
         table_ref = self.client.dataset(dataset, project=project).table(table_id)
         if self.verbose: print("Starting load of {} to {} as {}".format(table_id, destination_url, job_id))
 
-        extract_job = self.client.extract_table_to_storage(job_id, table_ref, destination_url)
-        extract_job.destination_format = format
-        extract_job._build_resource()
-        extract_job.begin()
-        result = extract_job.result().state
+        with self.instrumentation.measure('BigQuery', 'export_table', table=table_id):
+            extract_job = self.client.extract_table_to_storage(job_id, table_ref, destination_url)
+            extract_job.destination_format = format
+            extract_job._build_resource()
+            extract_job.begin()
+            result = extract_job.result().state
         if self.verbose: print("Job {} is finished with a status of {}".format(job_id, result))
         return job_id, result
 
+    def get_storage_client(self):
+        """ Get the GCS client, built once per instance from the shared credentials """
+
+        if self.storage_client is None:
+            self.storage_client = storage.Client(project=self.project, credentials=self.credential_manager.get_google_credentials(self.credentials))
+        return self.storage_client
+
     def download_export(self, bucket, filename, destination_filename=None):
         if not destination_filename: destination_filename = filename
-        storage_client = storage.Client.from_service_account_json(self.credentials, project=self.project)
-        bucket = storage_client.get_bucket(bucket)
-        bucket.blob(filename).download_to_filename(destination_filename)
+        with self.instrumentation.measure('BigQuery', 'download_export') as event:
+            storage_client = self.get_storage_client()
+            bucket = storage_client.get_bucket(bucket)
+            bucket.blob(filename).download_to_filename(destination_filename)
+            event.bytes = os.path.getsize(destination_filename)
 
     def get_gcs_files(self, bucket):
-        storage_client = storage.Client.from_service_account_json(self.credentials, project=self.project)
+        storage_client = self.get_storage_client()
         bucket = storage_client.get_bucket(bucket)
         return [b.name for b in bucket.list_blobs()]
 
     def delete_gcs_files(self, bucket, file):
-        storage_client = storage.Client.from_service_account_json(self.credentials, project=self.project)
+        storage_client = self.get_storage_client()
         bucket = storage_client.get_bucket(bucket)
         blob = bucket.blob(file)
         blob.delete()
 
     def delete_gcs_files_in_bucket(self, bucket):
-        storage_client = storage.Client.from_service_account_json(self.credentials, project=self.project)
+        storage_client = self.get_storage_client()
         bucket = storage_client.get_bucket(bucket)
         for b in bucket.list_blobs():
             blob = bucket.blob(b.name)
             blob.delete()
 
+def _import_pyarrow():
+    """ Import pyarrow for the Arrow methods, it stays an optional dependency of the rest of the wrapper """
+
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("The BigQuery Arrow methods need pyarrow: pip install mediapub_extensions[bigquery-storage]") from None
+    return pyarrow
+
 if __name__ == '__main__':
     print("Don't call directly.  Install package and import as a class.")
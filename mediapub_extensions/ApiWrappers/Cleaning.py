@@ -0,0 +1,253 @@
+import html
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
+
+class Cleaner(object):
+    """
+    Cleans whole batches of records or columns
+
+    Column names are renamed through a precomputed map, falling back to
+    removing a known prefix (e.g. 'ga:').  String values are HTML entity
+    decoded and their whitespace collapsed, and columns listed in types are
+    coerced.  Work is done a column at a time with a per-column cache, so a
+    value that repeats (a section, an author, a title across dates) is only
+    cleaned once per batch.  Strings nested in dicts and lists, like the
+    WordPress {'rendered': ...} fields, are cleaned too.
+
+    With processes set, batches of at least parallel_threshold rows are
+    split across a process pool.  Custom coercion functions must then be
+    importable module level functions so they can be pickled.
+
+    Example:
+        cleaner = Cleaner(rename={'ga:dimension18': 'articleId'}, prefixes=('ga:',), types={'pageviews': 'int'})
+        rows = cleaner.clean_records(rows)
+
+    Attributes:
+        rename (dict): Column name to its clean name
+        prefixes (tuple): Prefixes removed from the column names that are not in rename
+        types (dict): Clean column name to a coercion, one of COERCIONS or a function
+        fields (tuple): The clean column names whose values are cleaned, None for all of them
+        unescape (bool): Decode HTML entities, e.g. &#039; and &amp;
+        whitespace (bool): Strip strings and collapse runs of whitespace to one space
+        processes (int): The process pool size for large batches, None to clean in process
+        parallel_threshold (int): The fewest rows worth sending to the process pool
+    """
+
+    rename = None
+    prefixes = ()
+    types = None
+    fields = None
+    unescape = True
+    whitespace = True
+    processes = None
+    parallel_threshold = 100000
+
+    def __init__(self, rename=None, prefixes=(), types=None, fields=None, unescape=True, whitespace=True, processes=None, parallel_threshold=100000):
+        self.rename = dict(rename or {})
+        self.prefixes = tuple(prefixes)
+        self.types = dict(types or {})
+        self.fields = None if fields is None else frozenset(fields)
+        self.unescape = unescape
+        self.whitespace = whitespace
+        self.processes = processes
+        self.parallel_threshold = parallel_threshold
+        self._headers = {}
+
+    #####################################################
+    # Headers
+    #####################################################
+
+    def clean_header(self, header):
+        """ Get the clean name of a column """
+
+        clean = self._headers.get(header)
+        if clean is None:
+            clean = self.rename.get(header)
+            if clean is None:
+                clean = header
+                for prefix in self.prefixes:
+                    if clean.startswith(prefix):
+                        clean = clean[len(prefix):]
+                        break
+            self._headers[header] = clean
+        return clean
+
+    #####################################################
+    # Values
+    #####################################################
+
+    def clean_value(self, value, coerce=None):
+        """
+        Clean one value
+
+        Args:
+            value: The value, strings and the strings nested in dicts and lists are cleaned
+            coerce: A key of COERCIONS or a function applied to the cleaned value
+
+        Returns:
+            The cleaned value
+        """
+
+        if isinstance(value, str):
+            if self.unescape and '&' in value: value = html.unescape(value)
+            if self.whitespace: value = " ".join(value.split())
+        elif isinstance(value, dict):
+            return {key: self.clean_value(item) for key, item in value.items()}
+        elif isinstance(value, list):
+            return [self.clean_value(item) for item in value]
+        if coerce is not None and value is not _MISSING:
+            value = self._coercion(coerce)(value)
+        return value
+
+    def clean_column(self, name, values, coerce=None):
+        """ Clean a column of values, cleaning each distinct string once """
+
+        if self.fields is not None and name not in self.fields: return list(values)
+        coerce = coerce if coerce is not None else self.types.get(name)
+        function = self._coercion(coerce) if coerce is not None else None
+        cache = {}
+        cleaned = []
+        for value in values:
+            if isinstance(value, str):
+                clean = cache.get(value, _MISSING)
+                if clean is _MISSING:
+                    clean = cache[value] = self.clean_value(value, function)
+            else:
+                clean = self.clean_value(value, function)
+            cleaned.append(clean)
+        return cleaned
+
+    @staticmethod
+    def _coercion(coerce):
+        if callable(coerce): return coerce
+        if coerce not in COERCIONS: raise ValueError("Invalid coercion: {}".format(coerce))
+        return COERCIONS[coerce]
+
+    #####################################################
+    # Batches
+    #####################################################
+
+    def clean_columns(self, data, types=None):
+        """
+        Clean a batch of columns
+
+        Args:
+            data (dict): Column name to a sequence of values
+            types (dict): Clean column name to a coercion, added to the cleaner's types for this batch
+
+        Returns:
+            dict: Clean column name to a list of cleaned values, in the same order
+        """
+
+        types = {**self.types, **(types or {})}
+        rows = len(next(iter(data.values()))) if data else 0
+        if self.processes and rows >= self.parallel_threshold:
+            return self.__clean_columns_parallel(data, types, rows)
+        cleaned = {}
+        for name, values in data.items():
+            clean_name = self.clean_header(name)
+            cleaned[clean_name] = self.clean_column(clean_name, values, types.get(clean_name))
+        return cleaned
+
+    def clean_records(self, records, types=None):
+        """
+        Clean a batch of dicts, e.g. GA report rows or WordPress posts
+
+        The records are cleaned column by column, keys missing from a record
+        stay missing.
+
+        Returns:
+            list: New dicts with clean keys and values
+        """
+
+        records = list(records)
+        columns = {}
+        for record in records:
+            for key in record:
+                if key not in columns: columns[key] = None
+        data = {key: [record.get(key, _MISSING) for record in records] for key in columns}
+        cleaned = self.clean_columns(data, types)
+        names = list(cleaned)
+        return [{name: value for name, value in zip(names, row) if value is not _MISSING} for row in zip(*cleaned.values())]
+
+    def clean_result(self, result, types=None):
+        """ Clean a QueryResult into a new one, numeric columns are stored typed again """
+
+        cleaned = self.clean_columns({col: result.data[col] for col in result.columns}, types)
+        return QueryResult(list(cleaned), cleaned, meta=result.meta)
+
+    def __clean_columns_parallel(self, data, types, rows):
+        # Clean row slices of the batch on a process pool and stitch the columns back together.
+
+        step = -(-rows // self.processes)
+        slices = [{name: list(values[start:start + step]) for name, values in data.items()} for start in range(0, rows, step)]
+        serial = Cleaner(self.rename, self.prefixes, types, self.fields, self.unescape, self.whitespace)
+        cleaned = {}
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            for part in executor.map(serial.clean_columns, slices):
+                for name, values in part.items():
+                    cleaned.setdefault(name, []).extend(values)
+        return cleaned
+
+
+class _Missing(object):
+    """ Marks a key a record does not have, unpickles to the same instance """
+
+    def __reduce__(self):
+        return '_MISSING'
+
+    def __repr__(self):
+        return '<missing>'
+
+_MISSING = _Missing()
+
+
+#####################################################
+# Coercions
+#####################################################
+
+def _blank(value):
+    return value is None or value == ''
+
+def to_int(value):
+    if _blank(value): return None
+    try:
+        return int(value)
+    except ValueError: # e.g. '12.0'
+        return int(float(value))
+
+def to_float(value):
+    return None if _blank(value) else float(value)
+
+def to_bool(value):
+    if _blank(value): return None
+    if isinstance(value, str): return value.strip().lower() in ('1', 'true', 'yes', 'y', 't')
+    return bool(value)
+
+def to_date(value):
+    """ Parse YYYY-MM-DD or GA's YYYYMMDD """
+
+    if _blank(value): return None
+    if isinstance(value, datetime.date): return value
+    value = str(value)
+    return datetime.datetime.strptime(value, '%Y%m%d' if len(value) == 8 else '%Y-%m-%d').date()
+
+def to_datetime(value):
+    """ Parse ISO 8601, e.g. the WordPress date fields """
+
+    if _blank(value): return None
+    if isinstance(value, datetime.datetime): return value
+    return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+def to_str(value):
+    return None if value is None else str(value)
+
+COERCIONS = {
+    'int': to_int,
+    'float': to_float,
+    'bool': to_bool,
+    'date': to_date,
+    'datetime': to_datetime,
+    'str': to_str,
+}
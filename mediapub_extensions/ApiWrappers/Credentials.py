@@ -0,0 +1,420 @@
+import os
+import json
+import copy
+import datetime
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows, the token file is then only shared between threads
+    fcntl = None
+
+#####################################################
+# Private Cache Files
+#####################################################
+
+def user_cache_path(name):
+    """ The path of a file in the per-user cache directory, $XDG_CACHE_HOME/mediapub_extensions or ~/.cache/mediapub_extensions """
+
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mediapub_extensions', name)
+
+def open_private_file(path):
+    """
+    Open a cache file for reading and writing, creating it and its directory if needed
+
+    A new directory is created with mode 0700 and a new file with mode 0600.
+    An existing file is only opened while it is owned by the current user
+    with mode 0600, and symlinks are not followed, so a file someone else
+    planted or can read is never used.
+
+    Returns:
+        int: The open file descriptor
+
+    Raises:
+        OSError: If the file can not be opened or is not private to this user
+    """
+
+    os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    try:
+        stat = os.fstat(fd)
+        if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o777 != 0o600):
+            raise PermissionError("{} is not private to this user".format(path))
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+class CredentialManager(object):
+    """
+    Shares key files, credentials and access tokens between wrapper instances
+
+    Key files are read once per process.  Access tokens are cached in memory
+    until shortly before they expire, and in a file-locked token file so
+    that worker processes reuse each other's tokens instead of each minting
+    their own.  Only tokens and their expiry are written to the token file,
+    never the private keys.  The token file lives in the user's cache
+    directory and is only used while it is owned by the current user with
+    mode 0600, otherwise (or when it cannot be read) the tokens are a cache
+    miss and are minted as usual.
+
+    The wrappers use the shared module level instance, credentials.
+
+    Example:
+        from mediapub_extensions.ApiWrappers.Credentials import credentials
+        creds = credentials.get_google_credentials('key.json')
+        client = bigquery.Client(project='my-project', credentials=creds)
+
+    Attributes:
+        token_file (str): The token cache shared across processes, None to only share within the process
+        refresh_margin (datetime.timedelta): Tokens this close to expiring are refreshed
+    """
+
+    token_file = user_cache_path('tokens.json')
+    refresh_margin = datetime.timedelta(minutes=5)
+
+    def __init__(self, token_file=token_file, refresh_margin=refresh_margin):
+        self.token_file = token_file
+        self.refresh_margin = refresh_margin
+        self._lock = threading.RLock()
+        self._keyfiles = {}
+        self._objects = {}
+        self._tokens = {}
+
+    #####################################################
+    # Key Files
+    #####################################################
+
+    def load_keyfile(self, path):
+        """ Return the parsed JSON key file, read once per process (and again if the file changes) """
+
+        path = os.path.abspath(path)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._keyfiles.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path) as file:
+                    cached = self._keyfiles[path] = (mtime, json.load(file))
+            return cached[1]
+
+    def memoize(self, key, factory):
+        """ Return the object cached under key, building it with factory() the first time """
+
+        with self._lock:
+            if key not in self._objects: self._objects[key] = factory()
+            return self._objects[key]
+
+    #####################################################
+    # Credentials
+    #####################################################
+
+    def get_google_credentials(self, path, scopes=None):
+        """
+        Get google-auth service account credentials for a key file
+
+        The credentials check the shared token cache before asking Google for
+        a new token and store new tokens in it, so clients built from them
+        share tokens.  Clients that add their own scopes keep the caching.
+
+        Args:
+            path (str): The service account key file
+            scopes (list): The OAuth scopes, None lets the client set them
+
+        Returns:
+            google.oauth2.service_account.Credentials
+        """
+
+        key = ('google', os.path.abspath(path), tuple(scopes or ()))
+        return self.memoize(key, lambda: _cached_google_credentials_class().from_service_account_info(
+            self.load_keyfile(path), scopes=scopes, manager=self))
+
+    def get_oauth2client_credentials(self, path, scopes):
+        """
+        Get oauth2client service account credentials for a key file
+
+        Used by the Google Analytics discovery client.  The credentials share
+        the token cache through an oauth2client Storage.
+
+        Returns:
+            oauth2client.service_account.ServiceAccountCredentials
+        """
+
+        def build():
+            from oauth2client.service_account import ServiceAccountCredentials
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(self.load_keyfile(path), scopes)
+            creds.set_store(_TokenStorage(self, creds))
+            return creds
+        return self.memoize(('oauth2client', os.path.abspath(path), tuple(scopes)), build)
+
+    def get_googleads_oauth2_client(self, path, scope):
+        """
+        Get a googleads GoogleServiceAccountClient for a key file
+
+        The client uses the caching google-auth credentials instead of
+        reading the key file and minting a token on construction.
+
+        Returns:
+            googleads.oauth2.GoogleServiceAccountClient
+        """
+
+        def build():
+            from googleads import common, oauth2
+
+            class CachedServiceAccountClient(oauth2.GoogleServiceAccountClient):
+                def __init__(self, creds, scope):
+                    #NOTE: Skips the parent constructor, which loads the key file and refreshes immediately
+                    self.scope = scope
+                    self.creds = creds
+                    self.proxy_config = common.ProxyConfig()
+
+            return CachedServiceAccountClient(self.get_google_credentials(path, [scope]), scope)
+        return self.memoize(('googleads', os.path.abspath(path), scope), build)
+
+    #####################################################
+    # Token Cache
+    #####################################################
+
+    def get_token(self, key):
+        """
+        Get a cached (token, expiry) that is not close to expiring
+
+        Looks in memory first, then in the token file.  expiry is a naive UTC datetime.
+        """
+
+        with self._lock:
+            cached = self._tokens.get(key)
+            if self.__usable(cached): return cached
+        with self.locked_tokens() as tokens:
+            cached = self.__parse(tokens.get(key))
+        if not self.__usable(cached): return None
+        with self._lock:
+            self._tokens[key] = cached
+        return cached
+
+    def put_token(self, key, token, expiry):
+        """ Cache a token in memory and in the token file """
+
+        with self._lock:
+            self._tokens[key] = (token, expiry)
+        with self.locked_tokens(write=True) as tokens:
+            self.__store(tokens, key, token, expiry)
+
+    def get_or_refresh_token(self, key, refresh):
+        """
+        Get a cached token, or call refresh() for a new one while holding the token file lock
+
+        Holding the lock means that when many processes start at once only
+        one of them asks Google for a token and the rest pick it up.
+
+        Args:
+            key (str): The token cache key
+            refresh (callable): Returns a new (token, expiry)
+
+        Returns:
+            tuple: (token, expiry)
+        """
+
+        with self._lock:
+            cached = self._tokens.get(key)
+            if self.__usable(cached): return cached
+            with self.locked_tokens(write=True) as tokens:
+                cached = self.__parse(tokens.get(key))
+                if not self.__usable(cached):
+                    cached = refresh()
+                    self.__store(tokens, key, *cached)
+            self._tokens[key] = cached
+            return cached
+
+    @staticmethod
+    def __parse(entry):
+        """ Read a token file entry, None if it is missing or malformed """
+
+        if not entry: return None
+        try:
+            token = entry['token']
+            expiry = datetime.datetime.strptime(entry['expiry'], '%Y-%m-%dT%H:%M:%S')
+        except (KeyError, TypeError, ValueError): # A malformed entry is only a cache miss
+            return None
+        if not isinstance(token, str): return None
+        return token, expiry
+
+    @staticmethod
+    def __store(tokens, key, token, expiry):
+        """ Add a token to the token file contents, dropping expired and malformed ones while it is open """
+
+        now = datetime.datetime.utcnow()
+        for stale, entry in list(tokens.items()):
+            cached = CredentialManager.__parse(entry)
+            if cached is None or cached[1] < now: del tokens[stale]
+        tokens[key] = {'token': token, 'expiry': expiry.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    @contextmanager
+    def locked_tokens(self, write=False):
+        """
+        Hold the token file lock and yield its tokens
+
+        With write set the (possibly changed) tokens are written back before
+        the lock is released.  Without a usable token file this yields an
+        empty dict and nothing is written.
+        """
+
+        with self._lock:
+            opened = self.__open_token_file(write) if self.token_file else None
+            if opened is None:
+                yield {}
+                return
+            file, tokens = opened
+            try:
+                yield tokens
+                if write:
+                    try:
+                        file.seek(0)
+                        file.truncate()
+                        json.dump(tokens, file)
+                        file.flush()
+                    except OSError: # The token is still cached in memory
+                        pass
+            finally:
+                if fcntl: fcntl.flock(file, fcntl.LOCK_UN)
+                file.close()
+
+    def __open_token_file(self, write):
+        """ Open, lock and read the token file, None if it cannot be used """
+
+        file = None
+        try:
+            file = os.fdopen(open_private_file(self.token_file), 'r+')
+            if fcntl: fcntl.flock(file, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            content = file.read()
+        except OSError: # An unusable cache is only a cache miss
+            if file is not None: file.close()
+            return None
+        try:
+            tokens = json.loads(content) if content else {}
+        except ValueError: # A corrupt cache is only a cache miss
+            tokens = {}
+        if not isinstance(tokens, dict): tokens = {}
+        return file, tokens
+
+    def clear(self):
+        """ Forget the cached key files, credentials and in-memory tokens """
+
+        with self._lock:
+            self._keyfiles.clear()
+            self._objects.clear()
+            self._tokens.clear()
+
+    def __usable(self, cached):
+        return bool(cached) and cached[1] - self.refresh_margin > datetime.datetime.utcnow()
+
+    @staticmethod
+    def token_key(kind, account, scopes):
+        """ The token cache key for an account and its scopes """
+
+        return "{}:{}:{}".format(kind, account, " ".join(sorted(scopes or ())))
+
+
+#####################################################
+# Library Adapters
+#####################################################
+
+_CACHED_GOOGLE_CREDENTIALS = None
+
+def _cached_google_credentials_class():
+    """
+    Build the caching subclass of google-auth's service account credentials
+
+    Built on first use so google-auth is only imported by the wrappers that need it.
+    """
+
+    global _CACHED_GOOGLE_CREDENTIALS
+    if _CACHED_GOOGLE_CREDENTIALS is not None: return _CACHED_GOOGLE_CREDENTIALS
+    from google.oauth2 import service_account
+
+    class CachedCredentials(service_account.Credentials):
+        """ Service account credentials that share their tokens through a CredentialManager """
+
+        _manager = None
+
+        @classmethod
+        def from_service_account_info(cls, info, manager=None, **kwargs):
+            creds = super(CachedCredentials, cls).from_service_account_info(info, **kwargs)
+            creds._manager = manager
+            return creds
+
+        def _make_copy(self):
+            creds = super(CachedCredentials, self)._make_copy()
+            creds._manager = self._manager
+            return creds
+
+        def with_scopes(self, scopes, *args, **kwargs):
+            creds = super(CachedCredentials, self).with_scopes(scopes, *args, **kwargs)
+            creds._manager = self._manager
+            return creds
+
+        def refresh(self, request):
+            if self._manager is None: return super(CachedCredentials, self).refresh(request)
+            key = CredentialManager.token_key('google', self.service_account_email, self._scopes)
+
+            def fetch():
+                super(CachedCredentials, self).refresh(request)
+                return self.token, self.expiry
+            self.token, self.expiry = self._manager.get_or_refresh_token(key, fetch)
+
+    _CACHED_GOOGLE_CREDENTIALS = CachedCredentials
+    return CachedCredentials
+
+
+class _TokenStorage(object):
+    """
+    An oauth2client Storage backed by the CredentialManager token cache
+
+    oauth2client calls locked_get before refreshing and locked_put after,
+    which is where the shared token is picked up or published.
+    """
+
+    def __init__(self, manager, creds):
+        self.manager = manager
+        self.key = CredentialManager.token_key('oauth2client', creds.service_account_email, creds._scopes.split(' ') if isinstance(creds._scopes, str) else creds._scopes)
+        self.creds = creds
+        self._lock = threading.Lock()
+
+    def acquire_lock(self):
+        self._lock.acquire()
+
+    def release_lock(self):
+        self._lock.release()
+
+    def locked_get(self):
+        cached = self.manager.get_token(self.key)
+        if cached is None: return None
+        #NOTE: A copy with only the token changed, oauth2client copies its state onto the live credentials
+        creds = copy.copy(self.creds)
+        creds.access_token, creds.token_expiry = cached
+        creds.invalid = False
+        return creds
+
+    def locked_put(self, credentials):
+        if credentials.access_token and credentials.token_expiry:
+            self.manager.put_token(self.key, credentials.access_token, credentials.token_expiry)
+
+    def locked_delete(self):
+        pass
+
+    # oauth2client's Storage interface also has the unlocked forms
+    def get(self):
+        with self._lock:
+            return self.locked_get()
+
+    def put(self, credentials):
+        with self._lock:
+            self.locked_put(credentials)
+
+    def delete(self):
+        pass
+
+
+# The shared instance the wrappers use
+credentials = CredentialManager()
@@ -1,8 +1,24 @@
 from googleads import ad_manager
+from googleads import common
 from googleads import oauth2
 import tempfile
 import googleads.errors
 import csv
+import copy
+import gzip
+import io
+import itertools
+import os
+import re
+import time
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from zeep.cache import SqliteCache
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.Credentials import credentials as shared_credentials, open_private_file, user_cache_path
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
 
 class GoogleAdManager(object):
     """
@@ -16,23 +32,39 @@ class GoogleAdManager(object):
     Attributes:
         client (googleads.ad_manager.AdManagerClient): The Ad Manager Connection
         verbose (bool): The verbosity flag
+        wsdl_cache_path (str): The on-disk WSDL cache shared across processes, None when WSDLs are not cached
+        instrumentation (Instrumentation): Receives the timing and row counts of each request
+        credential_manager (CredentialManager): Shares the key file and access tokens with other instances
+        rate_limiter (RateLimiter): Paces API calls per network and retries quota errors, None to disable
     """
 
     client = None
     verbose = False
     default_version='v201908'
+    wsdl_cache_path = user_cache_path('wsdl_cache.db')
+    wsdl_cache_timeout = 7 * 24 * 60 * 60 # WSDLs only change between API versions, so keep them for a week
+    instrumentation = instrumentation
+    credential_manager = shared_credentials
+    rate_limiter = None
+    ROW_FORMATS = ('list', 'dict', 'columns', 'dataframe')
+    REPORT_HEADER_ROWS = 9 # Report properties, a blank row and the column names precede the data
+    PQL_PARQUET_ROW_GROUP = 100000
+    PQL_PATTERN = re.compile(r'^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<table>\w+)'
+                             r'(?:\s+WHERE\s+(?P<where>.+?))?(?:\s+ORDER\s+BY\s+.+?)?(?:\s+LIMIT\s+.+?)?\s*;?\s*$',
+                             re.IGNORECASE | re.DOTALL)
 
 
     #********************************************************
     # Connection Methods
     #********************************************************
 
-    def __init__(self, credentials_file=None, network_code=None, application_name=None, verbose=False):
+    def __init__(self, credentials_file=None, network_code=None, application_name=None, wsdl_cache_path=wsdl_cache_path, verbose=False):
         """
         Create an Ad Manager connection
 
         Args:
             credentials_file (str): The Google API Keyfile path
+            wsdl_cache_path (str): The sqlite file WSDLs and schemas are cached in, None to not cache them at all
             verbose (bool): Should output be printed to stdout
 
         Yields:
@@ -44,8 +76,33 @@ class GoogleAdManager(object):
         # If the Google API key is passed, use it to build a connection, otherwise look for the YAML
         if credentials_file: self.client = self._oauth2_client(credentials_file, network_code=network_code, application_name=application_name)
         else: self.client = ad_manager.AdManagerClient.LoadFromStorage()
+
+        # Share downloaded WSDLs across processes and keep built services for the life of the instance
+        self.__set_wsdl_cache(wsdl_cache_path)
+        self._services = {}
+        self._services_lock = threading.Lock()
         if self.verbose: print("done.\n")
 
+    def __set_wsdl_cache(self, path):
+        """
+        Cache WSDLs and schemas in a sqlite file only this user can read or write
+
+        A WSDL someone else wrote could point the services, and the OAuth
+        token sent to them, at another host.  When there is no path or the
+        file is not private the client gets zeep's no-cache option, otherwise
+        googleads would fall back to its own default cache.
+        """
+
+        self.wsdl_cache_path = None
+        if path:
+            try:
+                os.close(open_private_file(path))
+                self.wsdl_cache_path = path
+            except OSError as e:
+                if self.verbose: print("Not caching WSDLs: {}".format(e))
+        if self.wsdl_cache_path: self.client.cache = SqliteCache(path=path, timeout=self.wsdl_cache_timeout)
+        else: self.client.cache = common.ZeepServiceProxy.NO_CACHE
+
     def _oauth2_client(self, credentials_file, network_code, application_name):
         """
         Create a client given a Google API Keyfile.
@@ -53,7 +110,7 @@ class GoogleAdManager(object):
 
         #NOTE: created this function to move things out of the constructor, but
         #NOTE: (cont) we may want to move all of the client functions here.
-        oauth2_client = oauth2.GoogleServiceAccountClient(credentials_file, oauth2.GetAPIScope('ad_manager'))
+        oauth2_client = self.credential_manager.get_googleads_oauth2_client(credentials_file, oauth2.GetAPIScope('ad_manager'))
         ad_client = ad_manager.AdManagerClient(oauth2_client, application_name, network_code)
         return ad_client
 
@@ -64,20 +121,27 @@ class GoogleAdManager(object):
     def set_api_version(self, version):
         """ Change the version of googleads API """
 
+        if version != self.default_version: self.clear_service_cache()
         self.default_version = version
 
+    def clear_service_cache(self):
+        """ Drop the services built by get_service so they are rebuilt on next use """
+
+        with self._services_lock:
+            self._services.clear()
+
     def get_all_networks(self):
         """ Get a List of all Networks on the Account"""
 
         network_service = self.get_service("NetworkService")
-        networks = network_service.getAllNetworks()
+        networks = self._call(network_service.getAllNetworks)
         return networks
 
     def get_current_network(self):
         """ Get a the Current Network Set on the Account"""
 
         network_service = self.get_service("NetworkService")
-        network = network_service.getCurrentNetwork()
+        network = self._call(network_service.getCurrentNetwork)
         return network
 
     def set_current_network(self):
@@ -87,15 +151,18 @@ class GoogleAdManager(object):
         #TODO: Do this!!
         raise NotImplementedError
 
-    def get_service(self, service='reporting', version=None):
+    def get_service(self, service='reporting', version=None, cached=True):
         """
         Get a Service
 
-        Returns a specific Ad Manager Service for the client to build requests
+        Returns a specific Ad Manager Service for the client to build requests.
+        Building a service parses its WSDL, so services are cached on the
+        instance by (service, version) and reused on later calls.
 
         Args:
             service (str): The requested service
             version (str): The Ad Manager version
+            cached (bool): Reuse the instance's service, False always builds a new one
 
         Returns:
             googleads.common.GoogleSoapService: A Google Service Worker
@@ -112,8 +179,39 @@ class GoogleAdManager(object):
         # NOTE (cont): but less clear about an invalid service.  Handling that case here to make it more obvious.
         if version in ad_manager._SERVICE_MAP:
             if service not in ad_manager._SERVICE_MAP[version]: raise ImportError("Invalid Service Requested")
-        service = self.client.GetService(service, version=version)
-        return service
+        if not cached: return self.client.GetService(service, version=version)
+
+        key = (service, version)
+        with self.instrumentation.measure('GoogleAdManager', 'get_service', service=service) as event, self._services_lock:
+            if key not in self._services:
+                if self.verbose: print("Loading {} {}".format(service, version))
+                self._services[key] = self.client.GetService(service, version=version)
+                event.cache_misses = 1
+            else:
+                event.cache_hits = 1
+            return self._services[key]
+
+    def _call(self, function, *args, **kwargs):
+        """
+        Call an Ad Manager API method through the rate limiter
+
+        Waits for the network's rate limiter and retries QuotaErrors with
+        backoff.  Without a rate limiter the function is called directly.
+        """
+
+        if self.rate_limiter is None: return function(*args, **kwargs)
+        network_code = getattr(self.client, 'network_code', None)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire('GoogleAdManager', network_code)
+            try:
+                return function(*args, **kwargs)
+            except googleads.errors.GoogleAdsServerFault as e:
+                if 'QuotaError' not in str(e) or attempt >= self.rate_limiter.max_retries: raise
+                if self.verbose: print("Ad Manager quota exceeded, backing off...")
+                self.rate_limiter.throttled('GoogleAdManager', network_code)
+                self.rate_limiter.backoff(attempt)
+                attempt += 1
 
     def get_statement(self, version=None):
         """ Return a statement builder """
@@ -150,10 +248,197 @@ class GoogleAdManager(object):
 
         if version is None: version=self.default_version
 
-        data_downloader = self.client.GetDataDownloader(version)
-        resp = data_downloader.DownloadPqlResultToList(query)
+        with self.instrumentation.measure('GoogleAdManager', 'run_pql') as event:
+            data_downloader = self.client.GetDataDownloader(version)
+            resp = self._call(data_downloader.DownloadPqlResultToList, query)
+            event.rows = max(len(resp) - 1, 0)
         return resp
 
+    def run_pql_result(self, query, version=None):
+        """
+        Run a PQL query and return the results as a QueryResult
+
+        Returns:
+            QueryResult: The columnar results
+        """
+
+        resp = self.run_pql(query, version=version)
+        if not resp: return QueryResult([])
+        return QueryResult.from_rows(resp[1:], resp[0])
+
+    def run_pql_partitioned(self, query, key='Id', partitions=16, max_workers=4, ordered=True, version=None):
+        """
+        Run a PQL query as parallel key range partitions
+
+        Finds the min and max of the key column, splits that range into
+        partitions and runs the query once per range on a bounded thread
+        pool.  Rows are yielded partition by partition as they finish, so
+        only the partitions in flight are held in memory.
+
+        The query must be a plain SELECT ... FROM table [WHERE ...] [ORDER BY ...].
+        Any ORDER BY or LIMIT is dropped, and rows come back in key order when ordered is set.
+
+        Example:
+            rows = dfp.run_pql_partitioned('SELECT Id, Name FROM Line_Item', partitions=32)
+            cols = next(rows)
+            for row in rows:
+                ...
+
+        Args:
+            query (str): The Query to run
+            key (str): The numeric column to partition on
+            partitions (int): The number of key ranges to split the query into
+            max_workers (int): The maximum number of concurrent partition queries
+            ordered (bool): Yield partitions in key order, otherwise as they complete
+            version (str): The version number the query is written in
+
+        Yields:
+            List: The column names, then each row of the results.  The column
+                names come from the first partition that returns them, so an
+                empty result is shaped like run_pql's: nothing at all when
+                googleads returns no header row for it.
+
+        Resources:
+            https://developers.google.com/ad-manager/api/pqlreference
+        """
+
+        if version is None: version=self.default_version
+        match = self.PQL_PATTERN.match(query)
+        if match is None: raise ValueError("Query can not be partitioned: {}".format(query))
+        columns, table, where = match.group('columns'), match.group('table'), match.group('where')
+
+        # Find the key range, there is nothing to do for an empty table
+        low = self._get_pql_key_bound(table, key, where, 'ASC', version)
+        if low is None:
+            #NOTE: Run the query unpartitioned so an empty table gives exactly what run_pql does
+            for row in self.run_pql(query, version=version): yield row
+            return
+        high = self._get_pql_key_bound(table, key, where, 'DESC', version)
+        step = max((high - low + 1) // partitions, 1)
+        bounds = [(start, min(start + step, high + 1)) for start in range(low, high + 1, step)]
+        if self.verbose: print("Running {} partitions of {} from {} to {}".format(len(bounds), table, low, high))
+
+        local = threading.local()
+        def fetch(bound):
+            #NOTE: Each worker thread gets its own downloader so the SOAP clients are not shared
+            if not hasattr(local, 'downloader'): local.downloader = self.client.GetDataDownloader(version)
+            condition = '{key} >= {0} AND {key} < {1}'.format(bound[0], bound[1], key=key)
+            if where: condition = '({}) AND {}'.format(where, condition)
+            partition = 'SELECT {} FROM {} WHERE {} ORDER BY {} ASC'.format(columns, table, condition, key)
+            return self._call(local.downloader.DownloadPqlResultToList, partition)
+
+        header = False
+        partitions = self._iter_parallel(fetch, bounds, max_workers=max_workers, ordered=ordered)
+        count = lambda rows: max(len(rows) - 1, 0) # Every partition starts with the column names
+        for rows in self.instrumentation.measure_iter(partitions, 'GoogleAdManager', 'run_pql_partitioned', count=count, table=table):
+            if not rows: continue
+            if not header:
+                header = True
+                yield rows[0]
+            for row in rows[1:]: yield row
+
+    def run_pql_to_file(self, query, filename, file_format='csv', key='Id', partitions=16, max_workers=4, ordered=True, version=None):
+        """
+        Run a partitioned PQL query and write the rows to a file as they arrive
+
+        See run_pql_partitioned for the query arguments.  Parquet output
+        requires pyarrow and writes row groups of PQL_PARQUET_ROW_GROUP rows.
+
+        Args:
+            filename (str): The path of the output file
+            file_format (str): 'csv' or 'parquet'
+
+        Returns:
+            int: The number of data rows written
+        """
+
+        rows = self.run_pql_partitioned(query, key=key, partitions=partitions, max_workers=max_workers, ordered=ordered, version=version)
+        cols = next(rows, None)
+        if cols is None: return 0
+
+        if file_format == 'csv':
+            total = 0
+            with open(filename, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(cols)
+                for row in rows:
+                    writer.writerow(row)
+                    total += 1
+            return total
+
+        if file_format == 'parquet':
+            import pyarrow #NOTE: Imported here so pyarrow stays an optional dependency
+            import pyarrow.parquet
+            total = 0
+            writer = None
+            batch = []
+            try:
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.PQL_PARQUET_ROW_GROUP:
+                        writer = self.__write_parquet_batch(writer, filename, cols, batch)
+                        total += len(batch)
+                        batch = []
+                if batch or writer is None:
+                    writer = self.__write_parquet_batch(writer, filename, cols, batch)
+                    total += len(batch)
+            finally:
+                if writer is not None: writer.close()
+            return total
+
+        raise ValueError("Invalid file_format: {}".format(file_format))
+
+    @staticmethod
+    def __write_parquet_batch(writer, filename, cols, batch):
+        """ Append a batch of rows to the parquet file, opening it on the first batch """
+
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_pydict(GoogleAdManager.convert_rows(batch, cols, 'columns'))
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(filename, table.schema)
+        else:
+            table = table.cast(writer.schema)
+        writer.write_table(table)
+        return writer
+
+    def _get_pql_key_bound(self, table, key, where, direction, version):
+        """ Get the lowest (ASC) or highest (DESC) key value in a PQL table """
+
+        condition = ' WHERE {}'.format(where) if where else ''
+        query = 'SELECT {key} FROM {} {} ORDER BY {key} {} LIMIT 1'.format(table, condition, direction, key=key)
+        result = self._call(self.get_service('PublisherQueryLanguageService', version=version).select, {'query': query})
+        if 'rows' not in result or not result['rows']: return None
+        return int(result['rows'][0]['values'][0]['value'])
+
+    @staticmethod
+    def _iter_parallel(function, items, max_workers=4, ordered=True):
+        """
+        Map a function over items on a bounded thread pool
+
+        At most max_workers * 2 results are in flight at a time.  Results are
+        yielded in item order, or as they complete when ordered is False.
+        Every item is mapped, including ones that are None.
+        """
+
+        def wait_next(futures):
+            if ordered: return futures.popleft()
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            future = done.pop()
+            futures.remove(future)
+            return future
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            items = iter(items)
+            #NOTE: islice only takes what it submits, zip with a range would pull and drop one extra item
+            futures = deque(executor.submit(function, item) for item in itertools.islice(items, max_workers * 2))
+            for item in items:
+                future = wait_next(futures)
+                futures.append(executor.submit(function, item))
+                yield future.result()
+            while futures:
+                yield wait_next(futures).result()
+
     def run_request(self, report_job, version=None):
         """
         Run an Ad Exchange request
@@ -179,18 +464,262 @@ class GoogleAdManager(object):
         # Run request and wait for the response
         data_downloader = self.client.GetDataDownloader(version)
         if self.verbose: print("Running query:", report_job)
-        report_job_id = data_downloader.WaitForReport(report_job)
+        with self.instrumentation.measure('GoogleAdManager', 'wait_for_report'):
+            report_job_id = self._call(data_downloader.WaitForReport, report_job)
 
         # Save and convert the results
         #NOTE: converting the temp csv into a native python object so the library does not handle saving of files.
-        filename = self._save_temp_file(data_downloader, report_job_id)
-        return self._read_temp_file(filename) #results, column_names, meta_data
+        return self._download_report(report_job_id, version, data_downloader) #results, column_names, meta_data
+
+    def run_request_result(self, report_job, version=None):
+        """
+        Run an Ad Exchange request and return the results as a QueryResult
+
+        The report is streamed into columnar storage, the report properties are the meta.
+
+        Returns:
+            QueryResult: The columnar results
+        """
+
+        batches, cols, meta = self.run_request_stream(report_job, version=version, batch_size=10000)
+        return QueryResult.from_batches(batches, cols, meta=meta)
+
+    def run_request_stream(self, report_job, version=None, batch_size=None, row_format='list'):
+        """
+        Run an Ad Exchange request and stream the results
+
+        Like run_request, but the report is downloaded gzip compressed and
+        decompressed while it is parsed, so rows are yielded as they arrive
+        instead of being collected in memory first.
+
+        Example:
+            rows, cols, meta = dfp.run_request_stream(report_job)
+            for row in rows:
+                ...
+
+        Args:
+            report_job (dict): The request object
+            version (str): The version number the request is written in
+            batch_size (int): Yield batches of this many rows instead of single rows
+            row_format (str): The shape of each batch, one of 'list', 'dict',
+                'columns' (dict of column name to list) or 'dataframe' (requires pandas).
+                Only used with batch_size.
+
+        Returns:
+            generator: The rows (or batches) of the report
+            List: The column names
+            Dict: The request metadata
+        """
+
+        if version is None: version=self.default_version
+
+        data_downloader = self.client.GetDataDownloader(version)
+        if self.verbose: print("Running query:", report_job)
+        report_job_id = self._call(data_downloader.WaitForReport, report_job)
+        return self.stream_report(report_job_id, version=version, batch_size=batch_size, row_format=row_format)
+
+    def stream_report(self, report_job_id, version=None, batch_size=None, row_format='list'):
+        """
+        Stream the results of a finished report job
+
+        See run_request_stream for the arguments and return values.
+        """
+
+        if version is None: version=self.default_version
+        if row_format not in self.ROW_FORMATS: raise ValueError("Invalid row_format: {}".format(row_format))
+
+        data_downloader = self.client.GetDataDownloader(version)
+        raw, filename = self._open_report_stream(data_downloader, report_job_id)
+        try:
+            text = io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding='utf-8', newline='')
+            meta, cols, rows = self._parse_report(text)
+        except Exception:
+            self._close_report_stream(raw, filename)
+            raise
+        report = self.__iter_report(rows, raw, filename)
+        #NOTE: A generator that is never started never runs its finally, so the stream and temp file are also cleaned up when the rows are dropped unread
+        cleanup = weakref.finalize(report, self._close_report_stream, raw, filename)
+        rows = self.instrumentation.measure_iter(self.__detach_on_start(report, cleanup), 'GoogleAdManager', 'stream_report', count=lambda row: 1, pages=False)
+        if batch_size: rows = self.__iter_batches(rows, cols, batch_size, row_format)
+        return rows, cols, meta
+
+    def _open_report_stream(self, downloader, report_job_id):
+        """
+        Open the gzip compressed report as a binary stream
+
+        Streams straight from the download URL when the googleads version
+        supports it, otherwise the compressed report is saved to a temporary
+        file.  The filename is None when no temporary file was used.
+        """
+
+        kwargs = {'include_report_properties': True, 'use_gzip_compression': True}
+        if hasattr(downloader, 'DownloadReportAsStream'):
+            return downloader.DownloadReportAsStream(report_job_id, 'CSV_DUMP', **kwargs), None
+
+        report_file = tempfile.NamedTemporaryFile(suffix=".csv.gz", delete=False)
+        try:
+            downloader.DownloadReportToFile(report_job_id, 'CSV_DUMP', report_file, **kwargs)
+        except Exception:
+            report_file.close()
+            os.remove(report_file.name)
+            raise
+        report_file.seek(0)
+        if self.verbose: print("File {} saved to {}".format(report_job_id, report_file.name))
+        return report_file, report_file.name
+
+    @staticmethod
+    def _close_report_stream(raw, filename):
+        """ Close the report stream and remove the temporary file, if there was one """
+
+        raw.close()
+        if filename: os.remove(filename)
+
+    def __iter_report(self, rows, raw, filename):
+        """ Yield the report rows and clean up once they are exhausted """
+
+        try:
+            for row in rows:
+                yield row
+        finally:
+            self._close_report_stream(raw, filename)
+
+    @staticmethod
+    def __detach_on_start(rows, cleanup):
+        """ Drop the unread rows finalizer once reading starts, the rows' own finally takes over """
+
+        cleanup.detach()
+        yield from rows
+
+    def __iter_batches(self, rows, cols, batch_size, row_format):
+        """ Group the report rows into converted batches """
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield self.convert_rows(batch, cols, row_format)
+                batch = []
+        if batch: yield self.convert_rows(batch, cols, row_format)
+
+    @staticmethod
+    def convert_rows(rows, cols, row_format='list'):
+        """
+        Convert report rows to another shape
+
+        Args:
+            rows (list): The report rows, each a list of strings
+            cols (list): The column names
+            row_format (str): One of 'list', 'dict', 'columns' or 'dataframe'
+
+        Returns:
+            The rows in the requested format
+        """
+
+        if row_format == 'list':
+            return rows
+        if row_format == 'dict':
+            return [dict(zip(cols, row)) for row in rows]
+        if row_format == 'columns':
+            return dict(zip(cols, (list(col) for col in zip(*rows)))) if rows else {col: [] for col in cols}
+        if row_format == 'dataframe':
+            import pandas #NOTE: Imported here so pandas stays an optional dependency
+            return pandas.DataFrame.from_records(rows, columns=cols)
+        raise ValueError("Invalid row_format: {}".format(row_format))
+
+    def run_requests(self, report_jobs, version=None, max_workers=4, poll_interval=2, max_poll_interval=30, timeout=None, raise_errors=True):
+        """
+        Run many Ad Exchange requests in parallel
+
+        Submit every report job up front, poll their statuses together with
+        an increasing interval, and download each report on a thread pool as
+        soon as it completes.  Total wall time is roughly that of the slowest
+        report instead of the sum of all of them.
+
+        Example:
+            results = dfp.run_requests({'revenue': revenue_job, 'requests': requests_job})
+            data, cols, meta = results['revenue']
+
+        Args:
+            report_jobs (dict|list): The request objects, keyed by a job name.  A list is keyed by index.
+            version (str): The version number the requests are written in
+            max_workers (int): The maximum number of concurrent downloads
+            poll_interval (float): Seconds between the first status polls
+            max_poll_interval (float): The longest the poll interval backs off to
+            timeout (float): Seconds to wait for all reports before giving up, None waits forever
+            raise_errors (bool): Raise the first failure, otherwise failed jobs map to their exception
+
+        Returns:
+            dict: The (results, column_names, meta_data) of each request, keyed like report_jobs
+
+        Raises:
+            googleads.errors.AdManagerReportError: If a report fails on the server
+        """
+
+        if version is None: version=self.default_version
+        if not isinstance(report_jobs, dict): report_jobs = dict(enumerate(report_jobs))
+
+        # Submit all of the jobs before waiting on any of them
+        report_service = self.get_service('ReportService', version=version)
+        pending = {}
+        for key, report_job in report_jobs.items():
+            if self.verbose: print("Submitting query {}:".format(key), report_job)
+            pending[key] = self._call(report_service.runReportJob, report_job)['id']
+
+        results = {}
+        downloads = {}
+        started = time.time()
+        interval = poll_interval
+        with self.instrumentation.measure('GoogleAdManager', 'run_requests') as event, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending:
+                for key, report_job_id in list(pending.items()):
+                    status = self._call(report_service.getReportJobStatus, report_job_id)
+                    event.retries += 1
+                    if status == 'COMPLETED':
+                        if self.verbose: print("Report {} ({}) completed, downloading".format(key, report_job_id))
+                        downloads[key] = executor.submit(self._download_report, report_job_id, version)
+                        del pending[key]
+                    elif status == 'FAILED':
+                        if self.verbose: print("Report {} ({}) failed".format(key, report_job_id))
+                        results[key] = googleads.errors.AdManagerReportError(report_job_id)
+                        del pending[key]
+                if not pending: break
+                if timeout is not None and time.time() - started > timeout:
+                    for future in downloads.values(): future.cancel()
+                    raise RuntimeError("Reports still running after {} seconds: {}".format(timeout, list(pending)))
+                time.sleep(interval)
+                interval = min(interval * 1.5, max_poll_interval)
+
+            for key, future in downloads.items():
+                try:
+                    results[key] = future.result()
+                    event.rows += len(results[key][0])
+                except Exception as e:
+                    results[key] = e
+
+        if raise_errors:
+            for key in report_jobs:
+                if isinstance(results[key], Exception): raise results[key]
+        return {key: results[key] for key in report_jobs}
+
+    def _download_report(self, report_job_id, version=None, data_downloader=None):
+        """ Download a finished report and convert it to native Python objects """
+
+        #NOTE: Each download gets its own downloader so parallel downloads do not share a SOAP client
+        if data_downloader is None: data_downloader = self.client.GetDataDownloader(version or self.default_version)
+        with self.instrumentation.measure('GoogleAdManager', 'download_report') as event:
+            filename = self._save_temp_file(data_downloader, report_job_id)
+            try:
+                event.bytes = os.path.getsize(filename)
+                report = self._read_temp_file(filename) #results, column_names, meta_data
+                event.rows = len(report[0])
+                return report
+            finally:
+                os.remove(filename)
 
     def _save_temp_file(self, downloader, report_job_id):
         """ Create a temporary file of the results """
 
-        #NOTE: I am not sure if this should convert to an object here and then delete the file or leave it.
-        #NOTE: (cont) I will leave it like this for now while we debate if we should change it.
+        #NOTE: The callers remove the file once it has been converted to native python objects.
         report_file = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
         downloader.DownloadReportToFile(report_job_id, 'CSV_DUMP', report_file, include_report_properties=True, use_gzip_compression=False)
         report_file.close()
@@ -200,23 +729,109 @@ class GoogleAdManager(object):
     def _read_temp_file(self, filename):
         """ Convert the CSV of the results to native Python objects"""
 
+        with open(filename, newline='') as file:
+            meta, cols, rows = self._parse_report(file)
+            #NOTE: I am not sure if this should be a list of lists and a separate list of indices.
+            data = list(rows)
+        return data, cols, meta
+
+    def _parse_report(self, file):
+        """
+        Split a CSV_DUMP report with properties into its parts
+
+        Reads the report properties and column names from the top of the file
+        and leaves the data rows to be read lazily.
+
+        Returns:
+            meta (dict): The report properties
+            cols (list): The column names
+            rows (iterator): The remaining data rows
+        """
+
         meta = {}
         cols = []
-        data = []
-
-        with open(filename) as file:
-            reader = csv.reader(file, delimiter=',')
-            for i, row in enumerate(reader):
-                #NOTE: The report properties are in the first rows and are not the same length as the data.
-                if 0 < i < 7:
-                    meta[row[0]] = row[1]
-                if i==8:
-                    for col in row:
-                        cols.append(col)
-                #NOTE: I am not sure if this should be a list of lists and a separate list of indices.
-                if i>8:
-                    data.append(row)
-        return data, cols, meta
+        reader = csv.reader(file, delimiter=',')
+        for i, row in enumerate(reader):
+            #NOTE: The report properties are in the first rows and are not the same length as the data.
+            if 0 < i < 7:
+                meta[row[0]] = row[1]
+            if i==self.REPORT_HEADER_ROWS - 1:
+                cols.extend(row)
+                break
+        return meta, cols, reader
+
+    def iter_by_statement(self, service, method, statement=None, version=None, max_workers=4):
+        """
+        Page through a *ByStatement service method in parallel
+
+        Fetches the first page to read totalResultSetSize, then fetches the
+        remaining offsets concurrently on a bounded thread pool.  Pages are
+        yielded in offset order, with at most max_workers * 2 pages held in
+        memory at a time.
+
+        Example:
+            statement = dfp.get_statement().Where('status = :status').WithBindVariable('status', 'DELIVERING')
+            for line_item in dfp.iter_by_statement('LineItemService', 'getLineItemsByStatement', statement):
+                ...
+
+        Args:
+            service (str): The requested service, e.g. 'LineItemService'
+            method (str): The service method, e.g. 'getLineItemsByStatement'
+            statement (googleads.ad_manager.StatementBuilder): The statement to page through, defaults to all items
+            version (str): The Ad Manager version
+            max_workers (int): The maximum number of concurrent page requests
+
+        Yields:
+            The individual result objects
+        """
+
+        if version is None: version=self.default_version
+        if statement is None: statement = self.get_statement(version=version)
+
+        pages = self.__iter_statement_pages(service, method, statement, version, max_workers)
+        for page in self.instrumentation.measure_iter(pages, 'GoogleAdManager', 'iter_by_statement', service=service):
+            for result in page: yield result
+
+    def __iter_statement_pages(self, service, method, statement, version, max_workers):
+        """ Yield each page of results of a *ByStatement method in offset order """
+
+        # The first page tells us how many pages there are
+        response = self._call(getattr(self.get_service(service, version=version), method), statement.ToStatement())
+        if 'results' not in response or not len(response['results']): return
+        total = response['totalResultSetSize']
+        yield response['results']
+
+        # Build every remaining statement up front, then fetch them concurrently
+        #NOTE: The offsets are set on a copy so the caller's statement is never changed, even while another thread reads it
+        statements = []
+        page = copy.copy(statement)
+        for offset in range(statement.offset + statement.limit, total, statement.limit):
+            page.offset = offset
+            statements.append(page.ToStatement())
+        if self.verbose: print("Fetching {} results over {} more pages".format(total, len(statements)))
+
+        #NOTE: Each worker thread gets its own service so the SOAP clients are not shared
+        local = threading.local()
+        def fetch(page_statement):
+            if not hasattr(local, 'method'): local.method = getattr(self.get_service(service, version=version, cached=False), method)
+            page = self._call(local.method, page_statement)
+            return page['results'] if 'results' in page else []
+
+        for results in self._iter_parallel(fetch, statements, max_workers=max_workers):
+            yield results
+
+    def get_all_by_statement(self, service, method, statement=None, version=None, max_workers=4):
+        """
+        Get every result of a *ByStatement service method
+
+        The list form of iter_by_statement, see it for the arguments.
+
+        Returns:
+            dict: the total number of results and a list of the results.
+        """
+
+        results = list(self.iter_by_statement(service, method, statement=statement, version=version, max_workers=max_workers))
+        return {'totalResults': len(results), 'response': results}
 
     #***************************************************************************
     # Data Requests
@@ -237,25 +852,37 @@ class GoogleAdManager(object):
             https://admanager.google.com/{network-code}#admin/listCompanies
         """
 
-        # Get the a Service and StatementBuilder to handle the request
-        company_service = self.get_service('CompanyService', version=self.default_version)
-        statement = self.get_statement(version=self.default_version)
-        # Creating the response outside of the loop
-        returned_response = {'totalResults': 0, 'response': []}
+        return self.get_all_by_statement('CompanyService', 'getCompaniesByStatement')
 
-        # Page through results and add them to the returned_response
-        while True:
-            response = company_service.getCompaniesByStatement(statement.ToStatement())
+    def get_line_items(self, statement=None, max_workers=4):
+        """
+        Get all Line Items, or those matching the statement
 
-            # If results are (still) returned, add them to the returned_response and update the query offset
-            if 'results' in response and len(response['results']):
-                returned_response['totalResults'] = response['totalResultSetSize']
-                returned_response['response'].extend(response['results'])
-                statement.offset += statement.limit
-            else:
-                break
+        Returns:
+            dict: the total number of results and a list of line items.
+        """
+
+        return self.get_all_by_statement('LineItemService', 'getLineItemsByStatement', statement=statement, max_workers=max_workers)
+
+    def get_orders(self, statement=None, max_workers=4):
+        """
+        Get all Orders, or those matching the statement
+
+        Returns:
+            dict: the total number of results and a list of orders.
+        """
+
+        return self.get_all_by_statement('OrderService', 'getOrdersByStatement', statement=statement, max_workers=max_workers)
+
+    def get_creatives(self, statement=None, max_workers=4):
+        """
+        Get all Creatives, or those matching the statement
+
+        Returns:
+            dict: the total number of results and a list of creatives.
+        """
 
-        return returned_response
+        return self.get_all_by_statement('CreativeService', 'getCreativesByStatement', statement=statement, max_workers=max_workers)
 
 
 if __name__ == '__main__':
@@ -281,5 +908,8 @@ if __name__ == '__main__':
     }
 
     # print(dfp.run_pql(query))
+    # dfp.run_pql_to_file(query, 'line_items.csv', partitions=32)
     # print(dfp.run_request(report_job))
+    # print(dfp.run_requests({'adx': report_job, 'adx_copy': report_job}))
+    # rows, cols, meta = dfp.run_request_stream(report_job)
     print(dfp.get_all_networks())
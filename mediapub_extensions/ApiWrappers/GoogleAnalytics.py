@@ -1,8 +1,11 @@
 from apiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+from apiclient.errors import HttpError
 from multiprocessing.dummy import Pool as ThreadPool
 import os
-import json
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.Credentials import credentials as shared_credentials
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
+from mediapub_extensions.ApiWrappers.Cleaning import Cleaner
 
 class GoogleAnalytics(object):
     verbose = False
@@ -10,18 +13,35 @@ class GoogleAnalytics(object):
     VIEW_ID = None
     analytics = None
     requests = []
+    instrumentation = instrumentation
+    credential_manager = shared_credentials
+    rate_limiter = None # A RateLimiter paces requests per view and retries quota errors
+    # Our custom dimensions, every other header just loses its ga: prefix
+    CUSTOM_DIMENSIONS = {
+        'ga:dimension2': 'author',
+        'ga:dimension6': 'tags',
+        'ga:dimension14': 'role',
+        'ga:dimension17': 'title',
+        'ga:dimension18': 'articleId',
+        'ga:dimension40': 'pubDate',
+        'ga:dimension41': 'lastModifiedDate',
+    }
+    METRIC_TYPES = {'INTEGER': 'int', 'FLOAT': 'float', 'CURRENCY': 'float', 'PERCENT': 'float', 'TIME': 'float'}
+    cleaner = Cleaner(rename=CUSTOM_DIMENSIONS, prefixes=('ga:',))
+    coerce_metrics = False # Convert the metric strings to int/float by their reported type
 
     def __init__(self, keyfile, view_id, verbose=False):
         self.verbose=verbose
         self.KEY_FILE_LOCATION = keyfile
         self.VIEW_ID = view_id
         if self.verbose: print("connecting to Google Analytics.... ")
-        credentials = ServiceAccountCredentials.from_json_keyfile_name(self.KEY_FILE_LOCATION, self.SCOPES)
+        #NOTE: Instances built from the same keyfile share its credentials and access token
+        credentials = self.credential_manager.get_oauth2client_credentials(self.KEY_FILE_LOCATION, self.SCOPES)
         self.analytics = build('analyticsreporting', 'v4', credentials=credentials)
         if self.verbose: print("Google Analytics connected. ")
 
     def multithreaded_query(self, params):
-        result = self.analytics.reports().batchGet(body={'reportRequests': self.build_query(params)}).execute()
+        result = self.batch_get(self.build_query(params), operation='multithreaded_query')
         return result
 
     def add_query_to_request(self, params):
@@ -32,10 +52,40 @@ class GoogleAnalytics(object):
         # self.requests = []
 
     def send_requests(self):
-        result = self.analytics.reports().batchGet(body={'reportRequests': self.requests}).execute()
+        result = self.batch_get(self.requests, operation='send_requests')
         self.requests.clear()
         return result
 
+    def batch_get(self, report_requests, operation='batch_get'):
+        """ Send report requests to the Reporting API and record their timing and row counts """
+
+        with self.instrumentation.measure('GoogleAnalytics', operation, view_id=self.VIEW_ID) as event:
+            attempt = 0
+            while True:
+                if self.rate_limiter: event.queue_wait += self.rate_limiter.acquire('GoogleAnalytics', self.VIEW_ID)
+                try:
+                    result = self.analytics.reports().batchGet(body={'reportRequests': report_requests}).execute()
+                    break
+                except HttpError as e:
+                    if self.rate_limiter is None or not self.is_quota_error(e) or attempt >= self.rate_limiter.max_retries: raise
+                    if self.verbose: print("Google Analytics quota exceeded, backing off...")
+                    self.rate_limiter.throttled('GoogleAnalytics', self.VIEW_ID)
+                    self.rate_limiter.backoff(attempt)
+                    attempt += 1
+                    event.retries += 1
+            for report in result.get('reports', []):
+                event.pages += 1
+                event.rows += len(report.get('data', {}).get('rows', []))
+        return result
+
+    @staticmethod
+    def is_quota_error(error):
+        """ Check if an HttpError is a rate limit or quota error """
+
+        status = getattr(error.resp, 'status', None)
+        if status == 429: return True
+        return status == 403 and any(reason in str(error.content) for reason in ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'))
+
     def build_query(self, params):
         reportrequest = {}
         reportrequest['dateRanges'] = []
@@ -85,53 +135,35 @@ class GoogleAnalytics(object):
             resp.append(self.build_response_object(report))
         return resp
 
+    def parse_response_results(self, response):
+        """ Parse each report in the response into a QueryResult """
+
+        return [QueryResult.from_records(self.build_response_object(report)) for report in response['reports']]
+
     def build_response_object(self, response):
         results = []
         columnHeader = response.get('columnHeader', {})
         dimensionHeaders = columnHeader.get('dimensions', [])
         metricHeaders = columnHeader.get('metricHeader', {}).get('metricHeaderEntries', [])
+        metricNames = [metricHeader.get('name') for metricHeader in metricHeaders]
 
+        # Rows are built with the raw headers, the cleaner renames and cleans them a column at a time
         for row in response.get('data', {}).get('rows', {}):
-            dimensions = row.get('dimensions', [])
-            values = row.get('metrics', [])
-            rowValues = {}
-            for header, dimension in zip(dimensionHeaders, dimensions):
-                header = self.cleanHeaders(header)
-                rowValues[header] = dimension
-            for i, values in enumerate(values):
-                for metricHeader, value in zip(metricHeaders, values.get('values')):
-                    mHeader = self.cleanHeaders(metricHeader.get('name'))
-                    rowValues[mHeader] = value
+            rowValues = dict(zip(dimensionHeaders, row.get('dimensions', [])))
+            for values in row.get('metrics', []):
+                rowValues.update(zip(metricNames, values.get('values')))
             results.append(rowValues)
 
-        jsnResults = json.dumps(results, indent=4)
-        parsed = json.loads(jsnResults)
-        return parsed
+        types = None
+        if self.coerce_metrics:
+            types = {self.cleaner.clean_header(metricHeader.get('name')): self.METRIC_TYPES.get(metricHeader.get('type'), 'str') for metricHeader in metricHeaders}
+        return self.cleaner.clean_records(results, types=types)
 
     def cleanHeaders(self, header):
-        if header == 'ga:dimension6':
-            header = 'tags'
-        elif header == 'ga:dimension18':
-            header = 'articleId'
-        elif header == 'ga:dimension14':
-            header = 'role'
-        elif header == 'ga:dimension40':
-            header = 'pubDate'
-        elif header == 'ga:dimension41':
-            header = 'lastModifiedDate'
-        elif header == 'ga:dimension2':
-            header = 'author'
-        elif header == 'ga:dimension17':
-            header = 'title'
-        elif header == 'ga:avgTimeOnPage':
-            header = 'avgTimeOnPage'
-        else:
-            header = header.strip("ga:")
-        return header
+        return self.cleaner.clean_header(header)
 
     def cleanValues(self, val):
-        val = val.replace('&#039;', "'")
-        return val
+        return self.cleaner.clean_value(val)
 
 
 if __name__=='__main__':
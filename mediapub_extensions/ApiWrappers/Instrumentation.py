@@ -0,0 +1,294 @@
+import os
+import time
+import socket
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Event(object):
+    """
+    The measurements of one wrapper call
+
+    Attributes:
+        wrapper (str): The wrapper class, e.g. 'SQLServer'
+        operation (str): The wrapper method, e.g. 'run_query'
+        tags (dict): Extra labels, e.g. the service or table name
+        latency (float): Seconds the call took
+        rows (int): Rows returned or written
+        bytes (int): Bytes transferred
+        retries (int): Retries, reconnects or status polls
+        pages (int): Pages or batches fetched
+        cache_hits (int): Lookups served from a cache
+        cache_misses (int): Lookups that were not cached
+        queue_wait (float): Seconds spent waiting for a connection, slot or quota
+        error (str): The exception class name if the call failed
+    """
+
+    __slots__ = ('wrapper', 'operation', 'tags', 'timestamp', 'latency', 'rows', 'bytes', 'retries',
+                 'pages', 'cache_hits', 'cache_misses', 'queue_wait', 'error')
+    COUNTERS = ('rows', 'bytes', 'retries', 'pages', 'cache_hits', 'cache_misses', 'queue_wait')
+
+    def __init__(self, wrapper, operation, tags=None):
+        self.wrapper = wrapper
+        self.operation = operation
+        self.tags = tags or {}
+        self.timestamp = time.time()
+        self.latency = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self.pages = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.queue_wait = 0.0
+        self.error = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "Event({})".format(", ".join("{}={!r}".format(k, v) for k, v in self.as_dict().items() if v))
+
+
+class Instrumentation(object):
+    """
+    Collects timing and transfer measurements from the wrappers
+
+    Every wrapper has an instrumentation attribute that defaults to the
+    shared module level instance, so adding a sink to it instruments all
+    wrappers at once.  A single instance can be given its own with
+    wrapper.instrumentation = Instrumentation([MemorySink()]).  With no sinks
+    the measurements are dropped.
+
+    Example:
+        from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation, MemorySink
+        sink = instrumentation.add_sink(MemorySink())
+        sf.run_query(query)
+        print(sink.summary())
+
+    Attributes:
+        sinks (list): The sinks every event is sent to
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+
+    def add_sink(self, sink):
+        """ Send events to the sink, returns the sink """
+
+        self.sinks.append(sink)
+        return sink
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, event):
+        """ Send an event to every sink, a failing sink never breaks the wrapper call """
+
+        for sink in self.sinks:
+            try:
+                sink.handle(event)
+            except Exception:
+                logger.exception("Instrumentation sink %r failed", sink)
+
+    @contextmanager
+    def measure(self, wrapper, operation, **tags):
+        """
+        Time a block and emit its event when the block exits
+
+        The block receives the Event so it can add rows, bytes, pages, etc.
+
+        Example:
+            with self.instrumentation.measure('Snowflake', 'run_query') as event:
+                results = cs.fetchall()
+                event.rows = len(results)
+        """
+
+        event = Event(wrapper, operation, tags)
+        start = time.perf_counter()
+        try:
+            yield event
+        except (GeneratorExit, KeyboardInterrupt): # A consumer stopping early or a user interrupt is not a wrapper error
+            raise
+        except BaseException as e:
+            event.error = type(e).__name__
+            raise
+        finally:
+            event.latency = time.perf_counter() - start
+            self.emit(event)
+
+    def measure_iter(self, iterable, wrapper, operation, count=len, pages=True, **tags):
+        """
+        Measure a generator for as long as it is consumed
+
+        count(item) is added to the rows for each item, and each item counts
+        as a page unless pages is False (e.g. when the items are single rows).
+        """
+
+        with self.measure(wrapper, operation, **tags) as event:
+            for item in iterable:
+                if pages: event.pages += 1
+                if count: event.rows += count(item)
+                yield item
+
+
+#####################################################
+# Sinks
+#####################################################
+
+class LoggingSink(object):
+    """ Log each event """
+
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def handle(self, event):
+        self.logger.log(self.level, "%s.%s %.3fs %r", event.wrapper, event.operation, event.latency, event)
+
+
+class MemorySink(object):
+    """
+    Keep events in memory
+
+    Attributes:
+        events (collections.deque): The events, oldest first.  Only the newest max_events are kept.
+    """
+
+    def __init__(self, max_events=100000):
+        self.events = deque(maxlen=max_events)
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+
+    def summary(self):
+        """
+        Aggregate the events by wrapper and operation
+
+        Returns:
+            dict: (wrapper, operation) to the call count, errors, total/mean/p50/p95/max
+                latency and the summed counters
+        """
+
+        with self._lock:
+            events = list(self.events)
+        groups = {}
+        for event in events:
+            groups.setdefault((event.wrapper, event.operation), []).append(event)
+
+        summary = {}
+        for key, group in groups.items():
+            latencies = sorted(event.latency for event in group)
+            stats = {
+                'calls': len(group),
+                'errors': sum(1 for event in group if event.error),
+                'latency_total': sum(latencies),
+                'latency_mean': sum(latencies) / len(latencies),
+                'latency_p50': _percentile(latencies, 50),
+                'latency_p95': _percentile(latencies, 95),
+                'latency_max': latencies[-1],
+            }
+            for counter in Event.COUNTERS:
+                stats[counter] = sum(getattr(event, counter) for event in group)
+            summary[key] = stats
+        return summary
+
+
+class StatsdSink(object):
+    """
+    Send events to StatsD over UDP
+
+    Latency and queue wait are sent as timers in ms, the other counters as counts:
+    <prefix>.<wrapper>.<operation>.<metric>
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='mediapub'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def handle(self, event):
+        name = "{}.{}.{}".format(self.prefix, event.wrapper, event.operation)
+        lines = ["{}.latency:{:.3f}|ms".format(name, event.latency * 1000), "{}.calls:1|c".format(name)]
+        if event.error: lines.append("{}.errors:1|c".format(name))
+        if event.queue_wait: lines.append("{}.queue_wait:{:.3f}|ms".format(name, event.queue_wait * 1000))
+        for counter in Event.COUNTERS:
+            value = getattr(event, counter)
+            if value and counter != 'queue_wait': lines.append("{}.{}:{}|c".format(name, counter, value))
+        self._socket.sendto("\n".join(lines).encode('utf-8'), self.address)
+
+
+class PrometheusSink(object):
+    """
+    Aggregate events into Prometheus text exposition format
+
+    Call render() to get the metrics text, or write(path) to refresh a file
+    for the node_exporter textfile collector.
+    """
+
+    def __init__(self, prefix='mediapub'):
+        self.prefix = prefix
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def handle(self, event):
+        key = (event.wrapper, event.operation)
+        with self._lock:
+            totals = self._totals.setdefault(key, dict.fromkeys(('calls', 'errors', 'latency') + Event.COUNTERS, 0))
+            totals['calls'] += 1
+            totals['errors'] += 1 if event.error else 0
+            totals['latency'] += event.latency
+            for counter in Event.COUNTERS:
+                totals[counter] += getattr(event, counter)
+
+    def render(self):
+        with self._lock:
+            totals = {key: dict(values) for key, values in self._totals.items()}
+        names = [('calls', 'calls_total', 'Wrapper calls'),
+                 ('errors', 'errors_total', 'Wrapper calls that raised'),
+                 ('latency', 'latency_seconds_total', 'Seconds spent in wrapper calls'),
+                 ('rows', 'rows_total', 'Rows transferred'),
+                 ('bytes', 'bytes_total', 'Bytes transferred'),
+                 ('retries', 'retries_total', 'Retries, reconnects and status polls'),
+                 ('pages', 'pages_total', 'Pages or batches fetched'),
+                 ('cache_hits', 'cache_hits_total', 'Cache hits'),
+                 ('cache_misses', 'cache_misses_total', 'Cache misses'),
+                 ('queue_wait', 'queue_wait_seconds_total', 'Seconds spent waiting for a connection, slot or quota')]
+        lines = []
+        for field, name, help_text in names:
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} counter".format(metric))
+            for (wrapper, operation), values in sorted(totals.items()):
+                lines.append('{}{{wrapper="{}",operation="{}"}} {}'.format(metric, wrapper, operation, values[field]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """ Atomically replace path with the current metrics """
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(self.render())
+        os.replace(temp_path, path)
+
+
+def _percentile(values, percent):
+    """ Nearest rank percentile of sorted values """
+
+    if not values: return 0.0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+# The shared instance every wrapper reports to by default
+instrumentation = Instrumentation()
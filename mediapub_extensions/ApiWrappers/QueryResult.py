@@ -0,0 +1,177 @@
+from array import array
+
+class QueryResult(object):
+    """
+    Columnar query results shared by all of the wrappers
+
+    Holds the column names, one storage per column and any metadata the
+    source returned.  Columns where every value is an int or float are
+    stored as typed arrays ('q' or 'd'), everything else as lists, which
+    keeps large numeric extracts compact and lets to_arrow() wrap the typed
+    arrays without copying.
+
+    Example:
+        result = sql.run_query_result(query)
+        for batch in result.iter_batches(10000):
+            ...
+        df = result.to_pandas()
+
+    Attributes:
+        columns (list): The column names
+        data (dict): Column name to array.array or list
+        meta (dict): Source metadata, e.g. Ad Manager report properties or the BigQuery total
+    """
+
+    columns = None
+    data = None
+    meta = None
+
+    def __init__(self, columns, data=None, meta=None, typed=True):
+        """
+        Create a result from columnar data
+
+        Args:
+            columns (list): The column names
+            data (dict): Column name to a sequence of values, missing columns are empty
+            meta (dict): Source metadata
+            typed (bool): Store numeric columns as typed arrays
+        """
+
+        self.columns = list(columns)
+        if len(set(self.columns)) != len(self.columns): raise ValueError("Duplicate column names: {}".format(self.columns))
+        data = data or {}
+        self.data = {col: self._store(data.get(col, []), typed) for col in self.columns}
+        lengths = set(len(values) for values in self.data.values())
+        if len(lengths) > 1: raise ValueError("Columns have different lengths: {}".format(sorted(lengths)))
+        self.meta = meta or {}
+
+    #####################################################
+    # Constructors
+    #####################################################
+
+    @classmethod
+    def from_rows(cls, rows, columns, meta=None, typed=True):
+        """ Create a result from a sequence of rows in column order """
+
+        return cls.from_batches([rows], columns, meta=meta, typed=typed)
+
+    @classmethod
+    def from_batches(cls, batches, columns, meta=None, typed=True):
+        """
+        Create a result from batches of rows
+
+        Each batch is a list of rows in column order, e.g. the batches of
+        SQLServer.stream_query.  Rows are moved into the columns batch by
+        batch so the full row list is never built.
+        """
+
+        columns = list(columns)
+        data = [[] for _ in columns]
+        for batch in batches:
+            if not batch: continue
+            for values, column in zip(data, zip(*batch)):
+                values.extend(column)
+        return cls(columns, dict(zip(columns, data)), meta=meta, typed=typed)
+
+    @classmethod
+    def from_records(cls, records, columns=None, meta=None, typed=True):
+        """
+        Create a result from dicts, e.g. the rows of GoogleAnalytics.build_response_object
+
+        The columns default to the keys in order of first appearance.
+        Missing keys are None.
+        """
+
+        records = list(records)
+        if columns is None:
+            columns = []
+            seen = set()
+            for record in records:
+                for key in record:
+                    if key not in seen:
+                        seen.add(key)
+                        columns.append(key)
+        data = {col: [record.get(col) for record in records] for col in columns}
+        return cls(columns, data, meta=meta, typed=typed)
+
+    @staticmethod
+    def _store(values, typed=True):
+        """ Store a column as a typed array when every value is an int or float """
+
+        if isinstance(values, array): return values
+        values = values if isinstance(values, list) else list(values)
+        if not typed or not values: return values
+        kinds = set(type(value) for value in values)
+        try:
+            if kinds == {int}: return array('q', values)
+            if kinds <= {int, float}: return array('d', values)
+        except OverflowError: # Ints too large for 64 bits stay as python ints
+            pass
+        return values
+
+    #####################################################
+    # Access
+    #####################################################
+
+    def __len__(self):
+        return len(self.data[self.columns[0]]) if self.columns else 0
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def __repr__(self):
+        return "QueryResult({} rows, columns={})".format(len(self), self.columns)
+
+    def iter_rows(self):
+        """ Yield each row as a tuple in column order """
+
+        return zip(*(self.data[col] for col in self.columns))
+
+    def iter_batches(self, batch_size=10000):
+        """ Yield QueryResults of at most batch_size rows, sharing the metadata """
+
+        for start in range(0, len(self), batch_size):
+            data = {col: self.data[col][start:start + batch_size] for col in self.columns}
+            yield QueryResult(self.columns, data, meta=self.meta)
+
+    def to_rows(self):
+        """ Return a list of row tuples """
+
+        return list(self.iter_rows())
+
+    def to_dicts(self):
+        """ Return a list of dicts keyed by column name """
+
+        return [dict(zip(self.columns, row)) for row in self.iter_rows()]
+
+    def to_arrow(self):
+        """
+        Convert to a pyarrow.Table
+
+        Typed array columns are wrapped without copying, the other columns
+        are converted by pyarrow.  Requires pyarrow.
+        """
+
+        import pyarrow #NOTE: Imported here so pyarrow stays an optional dependency
+
+        arrays = []
+        for col in self.columns:
+            values = self.data[col]
+            if isinstance(values, array):
+                arrow_type = pyarrow.int64() if values.typecode == 'q' else pyarrow.float64()
+                arrays.append(pyarrow.Array.from_buffers(arrow_type, len(values), [None, pyarrow.py_buffer(values)]))
+            else:
+                arrays.append(pyarrow.array(values))
+        return pyarrow.Table.from_arrays(arrays, names=self.columns)
+
+    def to_pandas(self):
+        """ Convert to a pandas.DataFrame, through Arrow when pyarrow is installed.  Requires pandas. """
+
+        try:
+            return self.to_arrow().to_pandas()
+        except ImportError:
+            import pandas
+            return pandas.DataFrame({col: list(self.data[col]) for col in self.columns}, columns=self.columns)
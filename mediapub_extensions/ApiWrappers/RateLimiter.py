@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+
+try:
+    import fcntl
+except ImportError: # Windows, the file store is then only shared between threads
+    fcntl = None
+
+class RateLimiter(object):
+    """
+    A token bucket rate limiter shared between threads and processes
+
+    Each (service, scope) pair has its own bucket, e.g. one per GA view,
+    Ad Manager network or WordPress host.  Buckets live in a store, so
+    workers pointed at the same SqliteBucketStore or FileBucketStore share
+    one budget instead of each bursting into the quota on its own.
+
+    When a wrapper hits a 429 or quota error it calls throttled(), which
+    halves the bucket's rate for every process; the rate then recovers
+    linearly over recovery_seconds.
+
+    Example:
+        limiter = RateLimiter(SqliteBucketStore('/tmp/quota.db'), limits={'GoogleAnalytics': (1.0, 10)})
+        ga = GoogleAnalytics(keyfile, view_id)
+        ga.rate_limiter = limiter
+
+    Attributes:
+        store: The bucket store, MemoryBucketStore by default
+        limits (dict): Service name to (requests per second, burst size)
+        recovery_seconds (float): How long a throttled bucket takes to return to its full rate
+        max_retries (int): How many times the wrappers retry a throttled request
+        stats (dict): Per bucket key: acquires, waits, wait_seconds and throttles in this process
+    """
+
+    DEFAULT_LIMITS = {
+        'GoogleAnalytics': (1.0, 10), # The Reporting API allows 100 requests per 100 seconds per user
+        'GoogleAdManager': (8.0, 8),
+        'Wordpress': (5.0, 10),
+    }
+    MIN_FACTOR = 0.05
+    store = None
+    limits = None
+    recovery_seconds = 60.0
+    max_retries = 5
+    instrumentation = instrumentation
+
+    def __init__(self, store=None, limits=None, recovery_seconds=60.0, max_retries=5):
+        self.store = store or MemoryBucketStore()
+        self.limits = dict(self.DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.recovery_seconds = recovery_seconds
+        self.max_retries = max_retries
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def acquire(self, service, scope=None, tokens=1):
+        """
+        Take tokens from the bucket, sleeping until they are available
+
+        Tokens are reserved immediately, so callers are served in the order
+        they arrive and each acquire costs a single store update.
+
+        Returns:
+            float: The seconds spent waiting
+        """
+
+        rate, burst = self.__limit(service)
+        key = self.key(service, scope)
+
+        def take(state, now):
+            state = self.__refill(state, now, rate, burst)
+            state['tokens'] -= tokens
+            wait = -state['tokens'] / (rate * state['factor']) if state['tokens'] < 0 else 0.0
+            return state, wait
+
+        with self.instrumentation.measure('RateLimiter', 'acquire', service=service, scope=scope) as event:
+            wait = self.store.update(key, take)
+            if wait > 0: time.sleep(wait)
+            event.queue_wait = wait
+        self.__count(key, acquires=1, waits=1 if wait > 0 else 0, wait_seconds=wait)
+        return wait
+
+    def throttled(self, service, scope=None):
+        """ Halve the bucket's rate and drop its remaining burst after a 429 or quota error """
+
+        rate, burst = self.__limit(service)
+        key = self.key(service, scope)
+
+        def slow_down(state, now):
+            state = self.__refill(state, now, rate, burst)
+            state['factor'] = max(self.MIN_FACTOR, state['factor'] / 2.0)
+            state['tokens'] = min(state['tokens'], 0.0)
+            return state, None
+
+        self.store.update(key, slow_down)
+        self.__count(key, throttles=1)
+
+    def backoff(self, attempt, retry_after=None):
+        """ Sleep before a retry: Retry-After when the server sent one, otherwise exponential """
+
+        delay = float(retry_after) if retry_after else min(2.0 ** attempt, 60.0)
+        time.sleep(delay)
+        return delay
+
+    @staticmethod
+    def key(service, scope=None):
+        return service if scope is None else "{}:{}".format(service, scope)
+
+    def __limit(self, service):
+        if service not in self.limits: raise KeyError("No rate limit configured for {}".format(service))
+        return self.limits[service]
+
+    def __refill(self, state, now, rate, burst):
+        """ Add the tokens earned since the last update and recover the rate """
+
+        if state is None: return {'tokens': float(burst), 'updated': now, 'factor': 1.0}
+        elapsed = max(now - state['updated'], 0.0)
+        factor = min(1.0, state['factor'] + elapsed / self.recovery_seconds)
+        tokens = min(float(burst), state['tokens'] + elapsed * rate * state['factor'])
+        return {'tokens': tokens, 'updated': now, 'factor': factor}
+
+    def __count(self, key, **counts):
+        with self._stats_lock:
+            stats = self.stats.setdefault(key, {'acquires': 0, 'waits': 0, 'wait_seconds': 0.0, 'throttles': 0})
+            for name, value in counts.items():
+                stats[name] += value
+
+
+#####################################################
+# Bucket Stores
+#####################################################
+
+class MemoryBucketStore(object):
+    """ Buckets shared by the threads of one process """
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def update(self, key, function):
+        """ Replace the bucket's state with function(state, now)[0] and return the second value """
+
+        with self._lock:
+            state, result = function(self._buckets.get(key), time.time())
+            self._buckets[key] = state
+            return result
+
+
+class SqliteBucketStore(object):
+    """ Buckets in a sqlite database, shared by every process that opens the same file """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self.__transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, factor REAL)")
+
+    def update(self, key, function):
+        with self.__transaction() as conn:
+            row = conn.execute("SELECT tokens, updated, factor FROM buckets WHERE key = ?", (key,)).fetchone()
+            state = dict(zip(('tokens', 'updated', 'factor'), row)) if row else None
+            state, result = function(state, time.time())
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, factor) VALUES (?, ?, ?, ?)",
+                         (key, state['tokens'], state['updated'], state['factor']))
+            return result
+
+    @contextmanager
+    def __transaction(self):
+        """ A write transaction on this thread's connection, BEGIN IMMEDIATE serializes the processes """
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class FileBucketStore(object):
+    """ Buckets in a flock'd JSON file, shared by every process that opens the same file """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def update(self, key, function):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, 'r+') as file:
+                if fcntl: fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    content = file.read()
+                    try:
+                        buckets = json.loads(content) if content else {}
+                    except ValueError: # A corrupt file only resets the buckets
+                        buckets = {}
+                    buckets[key], result = function(buckets.get(key), time.time())
+                    file.seek(0)
+                    file.truncate()
+                    json.dump(buckets, file)
+                    file.flush()
+                    return result
+                finally:
+                    if fcntl: fcntl.flock(file, fcntl.LOCK_UN)
@@ -1,5 +1,14 @@
 import pyodbc
 import getpass
+import datetime
+import decimal
+import queue
+import time
+import threading
+import weakref
+from contextlib import contextmanager
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
 
 class SQLServer():
     """
@@ -17,6 +26,8 @@ class SQLServer():
         conn_string (str): The SQL Server connection string
         cursor (pyodbc.cursor): The ODBC cursor https://docs.microsoft.com/en-us/sql/odbc/reference/develop-app/cursors?view=sql-server-2017
         verbose (bool): The verbosity flag
+        pool_size (int): The maximum number of pooled connections, None when pooling is off
+        instrumentation (Instrumentation): Receives the timing and row counts of each query
 
     Resources:
         https://github.com/mkleehammer/pyodbc/issues/276
@@ -26,15 +37,26 @@ class SQLServer():
     conn_string = None
     cursor = None
     conn = None
+    pool_size = None
+    pool_timeout = None
+    reconnect_attempts = 1
+    instrumentation = instrumentation
+    ROW_FORMATS = ('row', 'tuple', 'dict', 'columns', 'dataframe')
 
 
-    def __init__(self, dsn=None, driver=None, server=None, db=None, user_id=None, password=None, trusted_connection = False, verbose=False):
+    def __init__(self, dsn=None, driver=None, server=None, db=None, user_id=None, password=None, trusted_connection = False, pool_size=None, pool_timeout=None, reconnect_attempts=1, verbose=False):
         """
         Create a SQL Server connection for this instance.
 
-        Creates a SQL Server connection.
+        Creates a SQL Server connection.  When pool_size is set the instance
+        runs in pooled mode instead: connections are opened on demand up to
+        pool_size, every query gets its own cursor, and the instance can be
+        shared between threads.
 
         Args:
+            pool_size (int): The maximum number of pooled connections, None for a single shared connection
+            pool_timeout (float): Seconds to wait for a free pooled connection, None waits forever
+            reconnect_attempts (int): How many times a pooled query is retried after a dropped connection
             verbose (bool): Sets expressive output
 
         Yields:
@@ -44,8 +66,18 @@ class SQLServer():
         self.verbose = verbose
         if self.verbose: print("initializing SQL Server...")
         self.conn_string = self.__get_conn_string(dsn, driver, server, db, user_id, password, trusted_connection)
-        self.__set_cursor(self.conn_string)
-        if self.verbose: print("SQL Server connection established")
+        if pool_size:
+            self.pool_size = pool_size
+            self.pool_timeout = pool_timeout
+            self.reconnect_attempts = reconnect_attempts
+            self.__pool = queue.LifoQueue(maxsize=pool_size)
+            self.__pool_lock = threading.Lock()
+            self.__pool_opened = 0
+            self.__local = threading.local()
+            if self.verbose: print("SQL Server pool of {} connections ready".format(pool_size))
+        else:
+            self.__set_cursor(self.conn_string)
+            if self.verbose: print("SQL Server connection established")
 
     #####################################################
     # Connection Methods
@@ -57,6 +89,172 @@ class SQLServer():
         self.conn = pyodbc.connect(conn_string)
         self.cursor = self.conn.cursor()
 
+    def __acquire(self):
+        """ Take a connection from the pool, opening a new one if the pool is not full """
+
+        try:
+            conn = self.__pool.get_nowait()
+            self.__measure_acquire(0.0, cache_hits=1)
+            return conn
+        except queue.Empty:
+            pass
+        with self.__pool_lock:
+            if self.__pool_opened < self.pool_size:
+                self.__pool_opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                conn = pyodbc.connect(self.conn_string)
+            except Exception:
+                with self.__pool_lock: self.__pool_opened -= 1
+                raise
+            self.__measure_acquire(0.0, cache_misses=1)
+            return conn
+        started = time.perf_counter()
+        try:
+            conn = self.__pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise RuntimeError("No SQL Server connection available after {} seconds".format(self.pool_timeout))
+        self.__measure_acquire(time.perf_counter() - started, cache_hits=1)
+        return conn
+
+    def __measure_acquire(self, queue_wait, cache_hits=0, cache_misses=0):
+        """ Report a pool checkout, reused connections count as cache hits """
+
+        with self.instrumentation.measure('SQLServer', 'pool_acquire') as event:
+            event.queue_wait = queue_wait
+            event.cache_hits = cache_hits
+            event.cache_misses = cache_misses
+
+    def __release(self, conn, discard=False):
+        """ Return a connection to the pool, or close it if it is no longer usable """
+
+        if discard:
+            with self.__pool_lock: self.__pool_opened -= 1
+            try:
+                conn.close()
+            except pyodbc.Error:
+                pass
+        else:
+            self.__pool.put(conn)
+
+    @staticmethod
+    def _is_disconnect(error):
+        """ Check if a pyodbc error means the connection was dropped """
+
+        #NOTE: SQLSTATE class 08 is "connection exception", e.g. 08S01 communication link failure
+        return bool(error.args) and str(error.args[0]).startswith('08')
+
+    def __open_cursor(self, query, event=None, params=()):
+        """
+        Execute a query, with optional ? parameters, on its own cursor
+
+        In pooled mode a connection is taken from the pool and the query is
+        retried on a fresh connection if the old one was dropped.  The caller
+        must hand the connection and cursor back with __close_cursor.
+        """
+
+        if not self.pool_size:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute(query, *params)
+            except Exception:
+                cursor.close()
+                raise
+            return self.conn, cursor
+
+        attempt = 0
+        while True:
+            conn = self.__acquire()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, *params)
+                return conn, cursor
+            except pyodbc.Error as e:
+                if self._is_disconnect(e) and attempt < self.reconnect_attempts:
+                    if self.verbose: print("SQL Server connection dropped, reconnecting...")
+                    self.__release(conn, discard=True)
+                    attempt += 1
+                    if event is not None: event.retries += 1
+                    continue
+                self.__close_cursor(conn, None, success=False, discard=self._is_disconnect(e))
+                raise
+            except Exception:
+                self.__close_cursor(conn, None, success=False)
+                raise
+
+    def __close_cursor(self, conn, cursor, success=True, discard=False):
+        """ Close a query cursor and, in pooled mode, end the transaction and release the connection """
+
+        if cursor is not None:
+            try:
+                cursor.close()
+            except pyodbc.Error:
+                pass
+        if not self.pool_size: return
+        if not discard:
+            try:
+                if success: conn.commit()
+                else: conn.rollback()
+            except pyodbc.Error as e:
+                discard = self._is_disconnect(e)
+                if not discard:
+                    self.__release(conn)
+                    raise
+        self.__release(conn, discard=discard)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements in one transaction
+
+        Yields a connection that is committed when the block exits and rolled
+        back if it raises.  In pooled mode the connection is reserved for the
+        block and then returned to the pool.
+
+        Example:
+            with sql.transaction() as conn:
+                conn.execute("DELETE FROM [reporting].[starts] WHERE ...")
+                conn.execute("INSERT INTO [reporting].[starts] ...")
+        """
+
+        conn = self.__acquire() if self.pool_size else self.conn
+        try:
+            yield conn
+        except pyodbc.Error as e:
+            self.__end_transaction(conn, success=False, discard=self._is_disconnect(e))
+            raise
+        except BaseException:
+            self.__end_transaction(conn, success=False)
+            raise
+        else:
+            self.__end_transaction(conn, success=True)
+
+    def __end_transaction(self, conn, success, discard=False):
+        """ Commit or roll back a transaction block """
+
+        if self.pool_size:
+            self.__close_cursor(conn, None, success=success, discard=discard)
+        elif success:
+            conn.commit()
+        else:
+            conn.rollback()
+
+    def close(self):
+        """ Close the connection, or every idle connection in the pool """
+
+        if not self.pool_size:
+            if self.conn is not None: self.conn.close()
+            return
+        while True:
+            try:
+                conn = self.__pool.get_nowait()
+            except queue.Empty:
+                break
+            self.__release(conn, discard=True)
+
     def __get_conn_string(self, dsn=None, driver=None, server=None, db=None, user_id=None, password=None, trusted_connection = False):
         """ Build the auth connection string """
 
@@ -93,18 +291,297 @@ class SQLServer():
 
         #NOTE: This should probably return standard python objects intead of pyodbc.Row
         #TODO: This should get some injection checking.  For now assuming good faith actors
-        query = self.cursor.execute(query)
-        if results:
-            return self.cursor.fetchall()
+        with self.instrumentation.measure('SQLServer', 'run_query') as event:
+            if not self.pool_size:
+                query = self.cursor.execute(query)
+                if results:
+                    rows = self.cursor.fetchall()
+                    event.rows = len(rows)
+                    return rows
+                else:
+                    return True
+
+            # Pooled mode: each query runs and commits on its own cursor and connection
+            conn, cursor = self.__open_cursor(query, event)
+            try:
+                self.__local.description = cursor.description
+                rows = cursor.fetchall() if results else True
+            except pyodbc.Error as e:
+                self.__close_cursor(conn, cursor, success=False, discard=self._is_disconnect(e))
+                raise
+            except BaseException:
+                self.__close_cursor(conn, cursor, success=False)
+                raise
+            self.__close_cursor(conn, cursor)
+            if results: event.rows = len(rows)
+            return rows
+
+    def stream_query(self, query, batch_size=1000, row_format='tuple'):
+        """
+        Run a SQL query and stream the results in batches
+
+        Execute the provided SQL Query on its own cursor and page through the
+        results with fetchmany so that large extracts run in bounded memory.
+        The query is executed immediately so the column names are available
+        before the first batch is read.
+
+        Example:
+            cols, batches = sql.stream_query(query, batch_size=5000, row_format='dict')
+            for batch in batches:
+                ...
+
+        Args:
+            query (str): The SQL Query to be run
+            batch_size (int): The number of rows fetched per batch
+            row_format (str): The shape of each batch, one of 'row' (pyodbc.Row),
+                'tuple', 'dict', 'columns' (dict of column name to list) or
+                'dataframe' (requires pandas)
+
+        Returns:
+            cols (list): The column names
+            batches (generator): A generator of batches in the requested row_format
+        """
+
+        if row_format not in self.ROW_FORMATS: raise ValueError("Invalid row_format: {}".format(row_format))
+        conn, cursor = self.__open_cursor(query)
+        try:
+            cols = [column[0] for column in cursor.description]
+        except Exception:
+            self.__close_cursor(conn, cursor, success=False)
+            raise
+        batches = self.__iter_batches(conn, cursor, cols, batch_size, row_format)
+        #NOTE: A generator that is never started never runs its finally, so the cursor is also handed back when the batches are dropped unread
+        release = weakref.finalize(batches, self.__close_cursor, conn, cursor, success=False)
+        batches = self.__detach_on_start(batches, release)
+        count = (lambda batch: len(batch[cols[0]]) if cols else 0) if row_format == 'columns' else len
+        return cols, self.instrumentation.measure_iter(batches, 'SQLServer', 'stream_query', count=count)
+
+    def run_query_result(self, query, batch_size=10000):
+        """
+        Run a SQL query and return the results as a QueryResult
+
+        The rows are streamed into columnar storage batch by batch.
+
+        Args:
+            query (str): The SQL Query to be run
+            batch_size (int): The number of rows fetched per batch
+
+        Returns:
+            QueryResult: The columnar results
+        """
+
+        cols, batches = self.stream_query(query, batch_size=batch_size, row_format='tuple')
+        return QueryResult.from_batches(batches, cols)
+
+    def extract_partitioned(self, table, key, partitions=8, columns='*', where=None, ordered=True, batch_size=10000, row_format='tuple', max_workers=None, queue_size=4):
+        """
+        Extract a table in key ranges on parallel connections
+
+        Finds the MIN and MAX of a numeric or date key, splits that range into
+        partitions and runs each partition as its own query on a pooled
+        connection, max_workers at a time.  Batches are yielded in key order
+        when ordered is set (each partition is also sorted by the key), or as
+        they arrive otherwise.  Rows with a NULL key are in the first
+        partition.  Each partition buffers at most queue_size batches ahead of
+        the consumer.
+
+        Requires pooled mode, each worker holds one connection from the pool.
+
+        Example:
+            sql = SQLServer(dsn='...', user_id='...', password='...', pool_size=8)
+            cols, batches = sql.extract_partitioned('[AUDREPMETA].[reporting].[starts]', 'start_id', partitions=32)
+
+        Args:
+            table (str): The table to extract
+            key (str): The numeric, date or datetime column to split on, ideally indexed
+            partitions (int): The number of key ranges
+            columns (str): The select list
+            where (str): An extra filter for every partition
+            ordered (bool): Yield batches in key order instead of as they arrive
+            batch_size (int): The number of rows fetched per batch
+            row_format (str): The shape of each batch, see stream_query
+            max_workers (int): Partitions run at once, defaults to (and is capped at) pool_size
+            queue_size (int): Batches each running partition may buffer
+
+        Returns:
+            cols (list): The column names
+            batches (generator): A generator of batches in the requested row_format
+        """
+
+        #TODO: This should get some injection checking.  For now assuming good faith actors
+        if not self.pool_size: raise RuntimeError("Partitioned extracts need a connection pool, create the SQLServer with pool_size")
+        if row_format not in self.ROW_FORMATS: raise ValueError("Invalid row_format: {}".format(row_format))
+        max_workers = min(max_workers or self.pool_size, self.pool_size)
+        condition = " WHERE ({})".format(where) if where else ""
+
+        low, high = self.run_query("SELECT MIN({0}), MAX({0}) FROM {1}{2}".format(key, table, condition))[0]
+        cols = [column[0] for column in self.__describe("SELECT {} FROM {} WHERE 1 = 0".format(columns, table))]
+
+        queries = []
+        select = "SELECT {} FROM {} WHERE ".format(columns, table) + ("({}) AND ".format(where) if where else "")
+        order = " ORDER BY {}".format(key) if ordered else ""
+        ranges = self._split_range(low, high, partitions) if low is not None else []
+        for index, (start, end) in enumerate(ranges):
+            predicate = "{0} >= ? AND {0} {1} ?".format(key, '<=' if index == len(ranges) - 1 else '<')
+            if index == 0: predicate = "({} OR {} IS NULL)".format(predicate, key)
+            queries.append((select + predicate + order, (start, end)))
+        if not queries: # Every key is NULL or the table is empty
+            queries.append(("SELECT {} FROM {}{}".format(columns, table, condition), ()))
+        if self.verbose: print("Extracting {} in {} partitions on {} connections".format(table, len(queries), max_workers))
+
+        batches = self.__iter_partitions(queries, cols, batch_size, row_format, ordered, max_workers, queue_size)
+        count = (lambda batch: len(batch[cols[0]]) if cols else 0) if row_format == 'columns' else len
+        return cols, self.instrumentation.measure_iter(batches, 'SQLServer', 'extract_partitioned', count=count, table=table, partitions=len(queries))
+
+    def __describe(self, query):
+        """ Get the cursor description of a query without keeping its connection """
+
+        conn, cursor = self.__open_cursor(query)
+        try:
+            return cursor.description
+        finally:
+            self.__close_cursor(conn, cursor)
+
+    def __iter_partitions(self, queries, cols, batch_size, row_format, ordered, max_workers, queue_size):
+        """ Run the partition queries on worker threads and yield their batches """
+
+        done = object()
+        stop = threading.Event()
+        tasks = queue.Queue()
+        for task in enumerate(queries): tasks.put(task)
+        outputs = [queue.Queue(maxsize=queue_size) for _ in queries]
+        if not ordered: outputs = [queue.Queue(maxsize=queue_size * max_workers)] * len(queries)
+
+        def put(out_queue, item):
+            while not stop.is_set():
+                try:
+                    out_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def work():
+            #NOTE: Workers take partitions in order, so in ordered mode the one being consumed is always running or done
+            while not stop.is_set():
+                try:
+                    index, (query, params) = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    conn, cursor = self.__open_cursor(query, params=params)
+                    batches = self.__iter_batches(conn, cursor, cols, batch_size, row_format)
+                    try:
+                        for batch in batches:
+                            if not put(outputs[index], batch): return
+                    finally:
+                        batches.close()
+                    put(outputs[index], done)
+                except BaseException as e: # Raised in the consumer instead
+                    put(outputs[index], e)
+                    return
+
+        threads = [threading.Thread(target=work, name='sqlserver-partition-{}'.format(i), daemon=True) for i in range(min(max_workers, len(queries)))]
+        for thread in threads: thread.start()
+        try:
+            remaining = len(queries)
+            position = 0
+            while remaining:
+                item = outputs[position].get()
+                if isinstance(item, BaseException): raise item
+                if item is done:
+                    remaining -= 1
+                    if ordered: position += 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+            for thread in threads: thread.join()
+
+    @staticmethod
+    def _split_range(low, high, partitions):
+        """
+        Split [low, high] into at most partitions (start, end) ranges
+
+        Works for ints, floats, Decimals, dates and datetimes.  Int and date
+        ranges never split a single value, so there may be fewer ranges than
+        asked for.
+        """
+
+        if isinstance(low, bool) or not isinstance(low, (int, float, decimal.Decimal, datetime.date)):
+            raise TypeError("Cannot partition on a {} key".format(type(low).__name__))
+        partitions = max(1, int(partitions))
+        span = high - low
+        if isinstance(low, int):
+            edges = [low + span * i // partitions for i in range(partitions + 1)]
+        elif isinstance(low, datetime.date) and not isinstance(low, datetime.datetime):
+            edges = [low + datetime.timedelta(days=span.days * i // partitions) for i in range(partitions + 1)]
         else:
-            return True
+            edges = [low + span * i / partitions for i in range(partitions + 1)]
+        edges[-1] = high
+        edges = [edge for i, edge in enumerate(edges) if i == 0 or edge != edges[i - 1]]
+        if len(edges) == 1: return [(low, high)]
+        return list(zip(edges[:-1], edges[1:]))
+
+    def __iter_batches(self, conn, cursor, cols, batch_size, row_format):
+        """ Yield converted batches from the cursor until it is exhausted """
+
+        #NOTE: In pooled mode the connection stays checked out until the generator is exhausted or closed
+        success = False
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows: break
+                if self.verbose: print("Fetched {} rows".format(len(rows)))
+                yield self.convert_rows(rows, cols, row_format)
+            success = True
+        finally:
+            self.__close_cursor(conn, cursor, success=success)
+
+    @staticmethod
+    def __detach_on_start(batches, release):
+        """ Drop the unread batches finalizer once reading starts, the batches' own finally takes over """
+
+        release.detach()
+        yield from batches
+
+    @staticmethod
+    def convert_rows(rows, cols, row_format='tuple'):
+        """
+        Convert pyodbc.Row objects to standard python objects
+
+        Args:
+            rows (list): The pyodbc.Row objects to convert
+            cols (list): The column names, in cursor order
+            row_format (str): One of 'row', 'tuple', 'dict', 'columns' or 'dataframe'
+
+        Returns:
+            The rows in the requested format
+        """
+
+        if row_format == 'row':
+            return rows
+        if row_format == 'tuple':
+            return [tuple(row) for row in rows]
+        if row_format == 'dict':
+            return [dict(zip(cols, row)) for row in rows]
+        if row_format == 'columns':
+            return dict(zip(cols, (list(col) for col in zip(*rows)))) if rows else {col: [] for col in cols}
+        if row_format == 'dataframe':
+            import pandas #NOTE: Imported here so pandas stays an optional dependency
+            return pandas.DataFrame.from_records([tuple(row) for row in rows], columns=cols)
+        raise ValueError("Invalid row_format: {}".format(row_format))
 
     def commit(self):
+        #NOTE: Pooled queries commit on their own, use transaction() to group statements
+        if self.pool_size: return True
         return self.conn.commit()
 
     def get_cols(self):
         """ Get the column names as a list """
-        return [column[0] for column in self.cursor.description]
+        #NOTE: In pooled mode this is the description of the last run_query on the calling thread
+        description = getattr(self.__local, 'description', None) if self.pool_size else self.cursor.description
+        return [column[0] for column in description]
 
 
 if __name__=='__main__':
@@ -117,3 +594,8 @@ if __name__=='__main__':
     cols = sql.get_cols()
     print(cols)
     print(type(results[0]), " - ", results[0])
+
+    # Stream the same table in batches of dicts
+    cols, batches = sql.stream_query(query, batch_size=5000, row_format='dict')
+    for batch in batches:
+        print(len(batch), " - ", batch[0])
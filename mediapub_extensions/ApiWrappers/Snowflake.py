@@ -1,7 +1,12 @@
 import snowflake.connector as snowcon
 import json
 import getpass
+import glob
+import os
 import sys
+import uuid
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
 
 class Snowflake():
     """
@@ -18,12 +23,14 @@ class Snowflake():
         password (str): The Snowflake Password
         account (str): The Snowflake accountID
         ctx (snowflake.connector): The connection to Snowflake
+        instrumentation (Instrumentation): Receives the timing and row counts of each query
     """
 
     user = None
     password = None
     account = None
     ctx = None
+    instrumentation = instrumentation
 
     def __init__(self, username=None, password=None, account=None, role='STAGE_R', db='ST_WEB', warehouse='ST_ANALYTICSAPI', schema='WEB_STAGE_META', verbose=False):
         """
@@ -118,6 +125,38 @@ class Snowflake():
         """
 
         #NOTE: This does not have any checking on what queries are passed in and run.  Limits enforced by roles
+        with self.instrumentation.measure('Snowflake', 'run_query') as event:
+            cs = self.ctx.cursor()
+            try:
+                cs.execute(self.ROLE)
+                cs.execute(self.DB)
+                cs.execute(self.SCHEMA)
+                cs.execute(self.WAREHOUSE)
+                cs.execute(SQL_CMD)
+                if ignore_results: return True
+                results = cs.fetchall()
+                event.rows = len(results)
+                return results
+            finally:
+                cs.close()
+
+    def stream_query(self, SQL_CMD, batch_size=10000):
+        """
+        Run a supplied query on Snowflake and stream the results in batches
+
+        The query is executed immediately so the column names are available
+        before the first batch is read.  The cursor is closed once the
+        batches are exhausted.
+
+        Args:
+            SQL_CMD (str): The SQL command to be run
+            batch_size (int): The number of rows fetched per batch
+
+        Returns:
+            cols (list): The column names
+            batches (generator): Lists of row tuples
+        """
+
         cs = self.ctx.cursor()
         try:
             cs.execute(self.ROLE)
@@ -125,29 +164,121 @@ class Snowflake():
             cs.execute(self.SCHEMA)
             cs.execute(self.WAREHOUSE)
             cs.execute(SQL_CMD)
-            if ignore_results: return True
-            results = cs.fetchall()
-            return results
+            cols = [col[0] for col in cs.description]
+        except Exception:
+            cs.close()
+            raise
+        return cols, self.instrumentation.measure_iter(self.__iter_batches(cs, batch_size), 'Snowflake', 'stream_query')
+
+    def __iter_batches(self, cs, batch_size):
+        """ Yield batches from the cursor until it is exhausted """
+
+        try:
+            while True:
+                rows = cs.fetchmany(batch_size)
+                if not rows: break
+                yield rows
         finally:
             cs.close()
 
-    def push_files(self, PATH, stage):
-        """ Push the file to Snowflake Stage """
+    def run_query_result(self, SQL_CMD, batch_size=10000):
+        """
+        Run a supplied query on Snowflake and return the results as a QueryResult
+
+        Returns:
+            QueryResult: The columnar results
+        """
+
+        cols, batches = self.stream_query(SQL_CMD, batch_size=batch_size)
+        return QueryResult.from_batches(batches, cols)
 
-        SQL_PUT = "put file://" + PATH + " @S_" + stage + " auto_compress=true;"
-        return self.run_query(SQL_PUT, ignore_results=True)
-        pass
+    def push_files(self, PATH, stage, prefix=''):
+        """ Push the file to Snowflake Stage, optionally under a path prefix on the stage """
 
-    def process_files(self, table, stage, format, on_error="SKIP_FILE", purge=True):
-        """ Process staged files """
+        SQL_PUT = "put file://" + PATH + " @S_" + stage + ("/" + prefix if prefix else "") + " auto_compress=true;"
+        with self.instrumentation.measure('Snowflake', 'push_files', stage=stage) as event:
+            # PUT accepts wildcards, so count every matching file
+            event.bytes = sum(os.path.getsize(path) for path in glob.glob(PATH))
+            return self.run_query(SQL_PUT, ignore_results=True)
+
+    def process_files(self, table, stage, format, on_error="SKIP_FILE", purge=True, prefix=''):
+        """ Process staged files, only the ones under prefix when it is set """
 
         SQL_COPY = "copy into " + table + " "\
-                "from @S_" + stage + " "\
+                "from @S_" + stage + ("/" + prefix if prefix else "") + " "\
                 "file_format = (format_name = " + format + ") "\
                 "ON_ERROR = " + on_error + " "\
-                "PURGE = " + purge + ";"
+                "PURGE = " + str(purge).upper() + ";" # purge is documented as a bool, SQL wants TRUE/FALSE
         return self.run_query(SQL_COPY, ignore_results=True)
 
+    def unload_query(self, SQL_CMD, stage, local_dir, format=None, max_file_size=100000000, max_workers=4, cleanup=True):
+        """
+        Unload a query to gzip files on a stage and download them in parallel
+
+        The mirror image of push_files/process_files.  COPY INTO writes the
+        results to the stage split into files of about max_file_size bytes,
+        one GET with PARALLEL = max_workers downloads them all and the stage
+        prefix is removed afterwards.  Rows never pass through the Python
+        cursor.
+
+        Example:
+            files = sf.unload_query("SELECT * FROM starts", 'EXPORTS', '/data/starts')
+            total = sum(rows for path, rows in files)
+
+        Args:
+            SQL_CMD (str): The query to unload
+            stage (str): The stage name, without the S_ prefix
+            local_dir (str): The directory to download into, created if needed
+            format (str): A named file format, default is gzip CSV without a header
+            max_file_size (int): The target size of each unloaded file in bytes
+            max_workers (int): The GET download threads, 1 to 99
+            cleanup (bool): Remove the unloaded files from the stage afterwards
+
+        Returns:
+            list: (local path, row count) per file, sorted by file name
+        """
+
+        return list(self.iter_unload(SQL_CMD, stage, local_dir, format=format, max_file_size=max_file_size, max_workers=max_workers, cleanup=cleanup))
+
+    def iter_unload(self, SQL_CMD, stage, local_dir, format=None, max_file_size=100000000, max_workers=4, cleanup=True):
+        """
+        Unload a query like unload_query, yielding each (local path, row count) sorted by file name
+
+        Every file is downloaded before the first is yielded.  The stage is
+        cleaned up when the generator is exhausted or closed.
+        """
+
+        prefix = "unload/{}/".format(uuid.uuid4().hex)
+        location = "@S_" + stage + "/" + prefix
+        file_format = "(format_name = " + format + ")" if format else "(type = CSV compression = GZIP field_optionally_enclosed_by = '\"')"
+        SQL_UNLOAD = "copy into " + location + "data "\
+                "from (" + SQL_CMD + ") "\
+                "file_format = " + file_format + " "\
+                "header = FALSE "\
+                "max_file_size = " + str(int(max_file_size)) + " "\
+                "detailed_output = TRUE;" # One result row per file: FILE_NAME, FILE_SIZE, ROW_COUNT
+        os.makedirs(local_dir, exist_ok=True)
+
+        with self.instrumentation.measure('Snowflake', 'unload', stage=stage) as event:
+            try:
+                #NOTE: An empty result unloads no files, any row without a row count is skipped
+                unloaded = sorted((os.path.basename(row[0]), row[2]) for row in self.run_query(SQL_UNLOAD) if row[2])
+                if self.verbose: print("Unloaded {} rows into {} files on {}".format(sum(rows for name, rows in unloaded), len(unloaded), location))
+
+                #NOTE: One GET downloads the whole prefix on the connector's own threads, the connection is never shared between Python threads
+                if unloaded:
+                    parallel = max(1, min(int(max_workers), 99))
+                    self.run_query("get " + location + " file://" + os.path.abspath(local_dir) + "/ parallel = " + str(parallel) + ";")
+                for name, rows in unloaded:
+                    path = os.path.join(local_dir, name)
+                    if not os.path.exists(path): raise RuntimeError("GET did not download {}{}".format(location, name))
+                    event.pages += 1
+                    event.rows += rows
+                    event.bytes += os.path.getsize(path)
+                    yield path, rows
+            finally:
+                if cleanup: self.run_query("remove " + location + ";", ignore_results=True)
+
     ############################################################
     # Queries
     ############################################################
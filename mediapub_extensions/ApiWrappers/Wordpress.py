@@ -1,6 +1,12 @@
+import os
+import time
 import requests
 import json
 import platform
+from urllib.parse import urlparse
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
+from mediapub_extensions.ApiWrappers.Cleaning import Cleaner
 
 class Wordpress(object):
     """
@@ -14,12 +20,21 @@ class Wordpress(object):
         base_prod_url (str): The base URL to the production API
         base_stage_url (str): The base URL to the staging API
         headers (str): HTTP headers to accompany the request
+        instrumentation (Instrumentation): Receives the timing, page and byte counts of each crawl
+        rate_limiter (RateLimiter): Paces requests per host and retries 429s, None to disable
+        page_retries (int): How many times a crawl retries a page that failed with a transient error
+        cleaner (Cleaner): Cleans the posts before they are returned, None to return them as the API sent them.
+            By default only the rendered titles are entity decoded, content and excerpts are HTML and left alone.
     """
 
     verbose = False #TODO: There are no verbose outputs currently
     base_prod_url =  None
     base_stage_url =  None
     headers = None
+    instrumentation = instrumentation
+    rate_limiter = None
+    page_retries = 3
+    cleaner = Cleaner(fields=('title',))
 
     def __init__(self, prod_url='https://seattletimes.com/wp-json/', stage_url='https://staging.seattletimes.com/wp-json/'):
         """
@@ -56,14 +71,20 @@ class Wordpress(object):
             }
 
 
-    def get_posts(self, env='stage', post_id=None, *args, **kwargs):
+    def get_posts(self, env='stage', post_id=None, *args, checkpoint_file=None, **kwargs):
         """
         Gets posts that match the given criteria
 
+        A crawl of every page can checkpoint to an NDJSON file.  Each completed
+        page is appended to it with the crawl's URL, and a rerun with the same
+        criteria only requests the pages the file does not have yet.  The file
+        is removed once the crawl finishes.
+
         Args:
             env (str): The enviornment URL to request
             post_id (int): The Wordpress post ID to request a single post
             args (list): additional arguments
+            checkpoint_file (str): NDJSON file to resume a crawl of every page from
             kwargs (dictionary): additional filters for URL params
 
         Returns:
@@ -75,9 +96,27 @@ class Wordpress(object):
         url = self.__add_params(url, args=args, kwargs=kwargs)
 
         # Only pass the page param if it is set in the kwargs, used to determine if request shoudl iterate through the pages.
-        if 'page' in kwargs: posts = self.__get_items(url, kwargs['page'], post_id=post_id)
-        else: posts = self.__get_items(url, post_id=post_id)
-        return posts
+        with self.instrumentation.measure('Wordpress', 'get_posts', env=env) as event:
+            if 'page' in kwargs: posts = self.__get_items(url, kwargs['page'], post_id=post_id, event=event)
+            else: posts = self.__get_items(url, post_id=post_id, event=event, checkpoint_file=checkpoint_file)
+            event.rows = len(posts) if isinstance(posts, list) else 1
+        if self.cleaner is None: return posts
+        if isinstance(posts, dict): return self.cleaner.clean_records([posts])[0] # A single post_id returns the post itself
+        return self.cleaner.clean_records(posts)
+
+    def get_posts_result(self, env='stage', post_id=None, *args, **kwargs):
+        """
+        Gets posts that match the given criteria as a QueryResult
+
+        Takes the same arguments as get_posts.  Each top level post field is a column.
+
+        Returns:
+            QueryResult: The posts
+        """
+
+        posts = self.get_posts(env, post_id, *args, **kwargs)
+        if isinstance(posts, dict): posts = [posts] # A single post_id returns the post itself
+        return QueryResult.from_records(posts)
 
     def get_categories(self):
         #TODO: do this
@@ -107,40 +146,105 @@ class Wordpress(object):
             else:
                 raise RuntimeError(response.reason)
 
-    def __get_items(self, url, page=None, post_id=None):
+    def __get_items(self, url, page=None, post_id=None, event=None, checkpoint_file=None):
         # Perform the requests to get the API items.
 
-        iter = False # Flag used to iterate through request pages for more results.
-        items = [] # Results are stored in a list so that iterated items can be added to current results
-
         # If a specific page was requested pull that item and return without iterating
         if page or post_id:
             try:
                 print(url)
-                response = requests.get(url, self.headers)
-                items = self.__handle_response(response)
+                return self.__get_page(url, event)
             except IndexError as e: #TODO: these exceptions should be a bit more robust.
                 return []
-        # Otherwise iterate through pages until there are no more results.
-        else:
-            # Add page=1 to the URL params and turn on iteration
+
+        # Otherwise iterate through pages until there are no more results, skipping the checkpointed ones.
+        pages = self.__load_checkpoint(checkpoint_file, url)
+        checkpoint = open(checkpoint_file, 'a') if checkpoint_file else None
+        try:
             page = 1
-            url = url + "page={}".format(page)
-            iter = True
-            if iter: #TODO remove this extra if.
-                while True: #page <= 10: # For testing, only get the first 10 pages instead of all of them. #TODO: remove
-                    # Replace the page param with an updated one.
-                    #NOTE: This fails to replace on the first iteration since there is no page -1 value found.  Expected.
-                    url = url.replace('&page=' + str(page - 1), '&page=' + str(page))
-                    # print(url)
+            while True:
+                if page not in pages:
                     try:
-                        response = requests.get(url, self.headers)
-                        items.extend(self.__handle_response(response))
+                        pages[page] = self.__get_page(url + "page={}".format(page), event)
                     except IndexError as e: # when the last page is reached stop iter
                         break
-                    page += 1
+                    if checkpoint:
+                        checkpoint.write(json.dumps({'page': page, 'items': pages[page]}) + "\n")
+                        checkpoint.flush()
+                page += 1
+        finally:
+            if checkpoint: checkpoint.close()
+
+        if checkpoint_file: os.remove(checkpoint_file)
+        items = [] # Results are stored in a list so that iterated items can be added to current results
+        for number in sorted(pages):
+            items.extend(pages[number])
         return items
 
+    def __get_page(self, url, event=None):
+        # Request one page, retrying transient failures with exponential backoff.
+
+        #NOTE: IndexError marks the last page and is never retried
+        attempt = 0
+        while True:
+            try:
+                return self.__handle_response(self.__request(url, event))
+            except (RuntimeError, ValueError, requests.exceptions.RequestException):
+                if attempt >= self.page_retries: raise
+            if self.rate_limiter: self.rate_limiter.backoff(attempt)
+            else: time.sleep(min(2 ** attempt, 60))
+            attempt += 1
+            if event is not None: event.retries += 1
+
+    def __load_checkpoint(self, checkpoint_file, url):
+        # Read the pages a previous run of this crawl completed, starting the file when there is none.
+
+        pages = {}
+        if not checkpoint_file: return pages
+        if not os.path.exists(checkpoint_file) or not os.path.getsize(checkpoint_file):
+            with open(checkpoint_file, 'w') as file:
+                file.write(json.dumps({'crawl': {'url': url}}) + "\n")
+            return pages
+
+        with open(checkpoint_file, 'rb+') as file:
+            header = json.loads(file.readline().decode('utf-8'))
+            if header.get('crawl', {}).get('url') != url:
+                raise ValueError("Checkpoint {} belongs to a different crawl".format(checkpoint_file))
+            complete = file.tell()
+            for line in iter(file.readline, b''):
+                #NOTE: A crash mid-write leaves a partial last line, it is cut off so the next append starts cleanly
+                if not line.endswith(b"\n"): break
+                entry = json.loads(line.decode('utf-8'))
+                pages[entry['page']] = entry['items']
+                complete = file.tell()
+            file.truncate(complete)
+        return pages
+
+    def __request(self, url, event=None):
+        # Get a URL, waiting on the rate limiter and retrying 429s when there is one.
+
+        attempt = 0
+        host = urlparse(url).netloc
+        while True:
+            if self.rate_limiter:
+                wait = self.rate_limiter.acquire('Wordpress', host)
+                if event is not None: event.queue_wait += wait
+            response = requests.get(url, self.headers)
+            self.__measure_response(event, response)
+            if self.rate_limiter is None or response.status_code != 429 or attempt >= self.rate_limiter.max_retries:
+                return response
+            self.rate_limiter.throttled('Wordpress', host)
+            self.rate_limiter.backoff(attempt, response.headers.get('Retry-After'))
+            attempt += 1
+            if event is not None: event.retries += 1
+
+    def __measure_response(self, event, response):
+        # Count the page and its size on the crawl's instrumentation event.
+
+        if event is None: return
+        event.pages += 1
+        event.bytes += len(response.content)
+
     def __build_posts_url(self, env='prod', post_id=None):
         # Construct the API URL (sans params)
 
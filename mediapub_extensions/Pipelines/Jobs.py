@@ -0,0 +1,417 @@
+"""
+Run a declarative job spec across the wrappers
+
+A job spec (YAML or JSON) names the wrapper instances a job needs and the
+steps to run on them.  Steps form a DAG through their after lists, and
+every step whose dependencies are done runs straight away, limited by the
+concurrency of the services it uses.  A run takes as long as its critical
+path instead of the sum of its steps.
+
+Usage:
+    python -m mediapub_extensions.Pipelines.Jobs morning.yaml [--report timings.json] [--max-workers N] [--dry-run]
+
+Spec:
+    max_workers: 8
+    services:                     # One wrapper instance per service, shared by its steps
+      warehouse:
+        wrapper: Snowflake
+        args: {username: etl, password: "${SNOWFLAKE_PASSWORD}", account: xy12345}
+        concurrency: 4            # Steps using the service at once, see DEFAULT_CONCURRENCY
+      audrep:
+        wrapper: SQLServer
+        args: {dsn: AUDREP, user_id: etl, password: "${AUDREP_PASSWORD}", pool_size: 4}
+    steps:
+      truncate_starts:
+        service: warehouse
+        method: run_query
+        args: {SQL_CMD: "TRUNCATE TABLE STARTS", ignore_results: true}   # or a list of positional args
+      copy_starts:
+        after: [truncate_starts]
+        transfer:
+          reader: {type: SQLServerReader, service: audrep, args: {query: "SELECT * FROM [reporting].[starts]"}}
+          writer: {type: SnowflakeWriter, service: warehouse, args: {table: STARTS, stage: STARTS, file_format: CSV_GZIP}}
+
+Strings may use ${ENV_VAR}, which must be set.  An argument written as
+{result_of: step} is replaced with the return value of that step, which is
+then implicitly a dependency, e.g. BigQuery.process_results on the results
+of run_query.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+
+class JobRunner(object):
+    """
+    Schedules the steps of a job spec over shared wrapper instances
+
+    Steps are started in order of the longest chain of steps waiting on
+    them, so the critical path is never held up by steps that have slack.
+    A failed step skips everything downstream of it, the independent
+    steps still run.
+
+    Example:
+        runner = JobRunner(load_spec('morning.yaml'), verbose=True)
+        report = runner.run()
+        runner.write_report('timings.json')
+
+    Attributes:
+        spec (dict): The parsed job spec
+        max_workers (int): Steps running at once across all services
+        report (dict): Per step: status, service(s), started/finished seconds into the run,
+            seconds, queue_wait (ready but waiting on a service or worker) and error
+        verbose (bool): The verbosity flag
+    """
+
+    DEFAULT_CONCURRENCY = {
+        'Snowflake': 4,
+        'BigQuery': 8,
+        'GoogleAnalytics': 2,
+        'GoogleAdManager': 4,
+        'SQLServer': 1, # One shared cursor unless the service sets pool_size
+        'Wordpress': 2,
+    }
+    spec = None
+    max_workers = 8
+    report = None
+    verbose = False
+    instrumentation = instrumentation
+
+    def __init__(self, spec, max_workers=None, verbose=False):
+        self.spec = _expand_env(spec)
+        self.max_workers = max_workers or self.spec.get('max_workers', self.max_workers)
+        self.verbose = verbose
+        self.report = {}
+        self._services = {}
+        self._limits = {}
+        self._instances = {}
+        self._instance_locks = {}
+        self._results = {}
+
+        self.__load_services(self.spec.get('services', {}))
+        self.steps = self.spec.get('steps', {})
+        if not self.steps: raise ValueError("The job spec has no steps")
+        self.dependencies = {name: self.__dependencies(name, step) for name, step in self.steps.items()}
+        self.order = self.__topological_order()
+        self.priority = self.__priorities()
+
+    #####################################################
+    # Spec
+    #####################################################
+
+    def __load_services(self, services):
+        """
+        Validate the services and set up their concurrency limits
+
+        Services with the same wrapper and arguments share one instance, so
+        they share one semaphore too, sized to the smallest of their limits.
+        """
+
+        concurrency = {}
+        for name, service in services.items():
+            if 'wrapper' not in service: raise ValueError("Service {} has no wrapper".format(name))
+            args = service.get('args', {})
+            limit = service.get('concurrency')
+            if limit is None:
+                limit = args.get('pool_size') if service['wrapper'] == 'SQLServer' and args.get('pool_size') else self.DEFAULT_CONCURRENCY.get(service['wrapper'], 1)
+            if limit < 1: raise ValueError("Service {} needs a concurrency of at least 1".format(name))
+            key = (service['wrapper'], json.dumps(args, sort_keys=True, default=str))
+            concurrency[key] = min(limit, concurrency.get(key, limit))
+            self._services[name] = {'wrapper': service['wrapper'], 'args': args, 'key': key}
+        self._limits = {key: threading.BoundedSemaphore(limit) for key, limit in concurrency.items()}
+        self._instance_locks = {key: threading.Lock() for key in concurrency}
+        for service in self._services.values():
+            service['concurrency'] = concurrency[service['key']]
+
+    def __dependencies(self, name, step):
+        """ The after list plus every step referenced with result_of """
+
+        after = list(step.get('after', []))
+        after += [ref for ref in _references(step) if ref not in after]
+        for dependency in after:
+            if dependency not in self.steps: raise ValueError("Step {} depends on unknown step {}".format(name, dependency))
+        for service in self.__step_services(step):
+            if service not in self._services: raise ValueError("Step {} uses unknown service {}".format(name, service))
+        return after
+
+    @staticmethod
+    def __step_services(step):
+        """ The services a step holds a concurrency slot on while it runs """
+
+        if 'transfer' in step:
+            names = [step['transfer'][part].get('service') for part in ('reader', 'writer')]
+            return sorted(set(name for name in names if name))
+        return [step['service']] if step.get('service') else []
+
+    def __topological_order(self):
+        """ Order the steps so each comes after its dependencies, raising ValueError on a cycle """
+
+        remaining = {name: set(dependencies) for name, dependencies in self.dependencies.items()}
+        order = []
+        while remaining:
+            ready = sorted(name for name, dependencies in remaining.items() if not dependencies)
+            if not ready: raise ValueError("The steps have a dependency cycle: {}".format(sorted(remaining)))
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+            for dependencies in remaining.values():
+                dependencies.difference_update(ready)
+        return order
+
+    def __priorities(self):
+        """ The length of the longest chain of steps that waits on each step """
+
+        dependents = {name: [] for name in self.steps}
+        for name, dependencies in self.dependencies.items():
+            for dependency in dependencies: dependents[dependency].append(name)
+        priority = {}
+        for name in reversed(self.order):
+            priority[name] = 1 + max([priority[dependent] for dependent in dependents[name]] or [0])
+        return priority
+
+    def plan(self):
+        """ Group the steps into levels that could run side by side, for --dry-run """
+
+        level = {}
+        for name in self.order:
+            level[name] = 1 + max([level[dependency] for dependency in self.dependencies[name]] or [-1])
+        levels = [[] for _ in range(max(level.values()) + 1)]
+        for name in self.order: levels[level[name]].append(name)
+        return levels
+
+    #####################################################
+    # Running
+    #####################################################
+
+    def run(self):
+        """
+        Run every step
+
+        Returns:
+            dict: The timing report, also kept in self.report
+        """
+
+        started = time.perf_counter()
+        pending = {name: set(dependencies) for name, dependencies in self.dependencies.items()}
+        ready = {name: started for name, dependencies in pending.items() if not dependencies}
+        for name in ready: del pending[name]
+        running = {}
+        self.report = {name: {'status': 'pending', 'services': self.__step_services(self.steps[name])} for name in self.steps}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor, \
+                self.instrumentation.measure('JobRunner', 'run', steps=len(self.steps)) as event:
+            while ready or running:
+                # Start the ready steps with the longest chains behind them while there are workers and service slots
+                for name in sorted(ready, key=lambda name: (-self.priority[name], name)):
+                    if len(running) >= self.max_workers: break
+                    step = self.steps[name]
+                    if not self.__try_acquire(self.__step_services(step)): continue
+                    now = time.perf_counter()
+                    self.report[name].update(status='running', started=now - started, queue_wait=now - ready.pop(name))
+                    if self.verbose: print("Starting {}".format(name))
+                    running[executor.submit(self.__run_step, name, step)] = name
+
+                if not running: raise RuntimeError("No step can start: {}".format(sorted(ready)))
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.__release(self.__step_services(self.steps[name]))
+                    finished = time.perf_counter() - started
+                    entry = self.report[name]
+                    entry.update(finished=finished, seconds=finished - entry['started'])
+                    try:
+                        self._results[name] = future.result()
+                        entry['status'] = 'done'
+                    except Exception as e:
+                        entry.update(status='failed', error="{}: {}".format(type(e).__name__, e))
+                        for skipped in self.__downstream(name):
+                            if self.report[skipped]['status'] == 'pending':
+                                self.report[skipped].update(status='skipped', error="{} failed".format(name))
+                                pending.pop(skipped, None)
+                    if self.verbose: print("{} {} in {:.1f}s".format(name, entry['status'], entry['seconds']))
+
+                    for waiting, dependencies in list(pending.items()):
+                        dependencies.discard(name)
+                        if not dependencies:
+                            del pending[waiting]
+                            ready[waiting] = time.perf_counter()
+            event.pages = sum(1 for entry in self.report.values() if entry['status'] == 'done')
+
+        self.report['_run'] = {
+            'seconds': time.perf_counter() - started,
+            'step_seconds': sum(entry.get('seconds', 0.0) for name, entry in self.report.items() if name != '_run'),
+            'failed': sorted(name for name, entry in self.report.items() if name != '_run' and entry['status'] in ('failed', 'skipped')),
+        }
+        return self.report
+
+    def __try_acquire(self, services):
+        """ Take a slot on every service's instance without blocking, or none of them """
+
+        taken = []
+        for key in self.__instance_keys(services):
+            if not self._limits[key].acquire(blocking=False):
+                for held in taken: self._limits[held].release()
+                return False
+            taken.append(key)
+        return True
+
+    def __release(self, services):
+        for key in self.__instance_keys(services):
+            self._limits[key].release()
+
+    def __instance_keys(self, services):
+        """ The instances behind the services, once each and sorted so two steps never wait on each other """
+
+        return sorted(set(self._services[service]['key'] for service in services))
+
+    def __downstream(self, name):
+        """ Every step that depends on name, directly or not """
+
+        found = set()
+        frontier = [name]
+        while frontier:
+            current = frontier.pop()
+            for other, dependencies in self.dependencies.items():
+                if current in dependencies and other not in found:
+                    found.add(other)
+                    frontier.append(other)
+        return found
+
+    def __run_step(self, name, step):
+        with self.instrumentation.measure('JobRunner', 'step', step=name):
+            if 'transfer' in step: return self.__run_transfer(step['transfer'])
+            if 'method' not in step: raise ValueError("Step {} needs a method or a transfer".format(name))
+            method = getattr(self.get_service(step['service']), step['method'])
+            args = self.__resolve(step.get('args', {}))
+            return method(*args) if isinstance(args, list) else method(**args)
+
+    def __run_transfer(self, spec):
+        from mediapub_extensions.Pipelines import Transfer as transfer
+
+        parts = {}
+        for part in ('reader', 'writer', 'serializer'):
+            if part not in spec: continue
+            cls = getattr(transfer, spec[part]['type'])
+            args = self.__resolve(spec[part].get('args', {}))
+            service = spec[part].get('service')
+            parts[part] = cls(self.get_service(service), **args) if service else cls(**args)
+        options = {key: spec[key] for key in ('queue_size', 'checkpoint_file') if key in spec}
+        return transfer.Transfer(parts['reader'], parts['writer'], serializer=parts.get('serializer'), verbose=self.verbose, **options).run()
+
+    def __resolve(self, value):
+        """ Replace {result_of: step} arguments with the step's return value """
+
+        if isinstance(value, dict):
+            if set(value) == {'result_of'}: return self._results[value['result_of']]
+            return {key: self.__resolve(item) for key, item in value.items()}
+        if isinstance(value, list): return [self.__resolve(item) for item in value]
+        return value
+
+    def get_service(self, name):
+        """
+        Get a service's wrapper instance, created on first use
+
+        Services with the same wrapper and arguments (the same credentials)
+        share one instance.  Each instance has its own lock, so connecting
+        one service never holds up steps waiting on another.
+        """
+
+        service = self._services[name]
+        key = service['key']
+        with self._instance_locks[key]:
+            if key not in self._instances:
+                if self.verbose: print("Connecting {} ({})".format(name, service['wrapper']))
+                wrapper = getattr(importlib.import_module('mediapub_extensions'), service['wrapper'])
+                self._instances[key] = wrapper(**service['args'])
+            return self._instances[key]
+
+    #####################################################
+    # Reporting
+    #####################################################
+
+    def write_report(self, path):
+        """ Write the timing report as JSON """
+
+        with open(path, 'w') as file:
+            json.dump(self.report, file, indent=4, sort_keys=True, default=str)
+
+    def format_report(self):
+        """ The timing report as a table, in start order """
+
+        lines = ["{:<32} {:<8} {:>9} {:>9} {:>9}  {}".format('step', 'status', 'start s', 'wait s', 'run s', 'error')]
+        steps = sorted((name for name in self.report if name != '_run'), key=lambda name: (self.report[name].get('started', float('inf')), name))
+        for name in steps:
+            entry = self.report[name]
+            lines.append("{:<32} {:<8} {:>9.1f} {:>9.1f} {:>9.1f}  {}".format(
+                name, entry['status'], entry.get('started', 0.0), entry.get('queue_wait', 0.0), entry.get('seconds', 0.0), entry.get('error', '')))
+        if '_run' in self.report:
+            run = self.report['_run']
+            lines.append("Ran {} steps in {:.1f}s ({:.1f}s of step time)".format(len(steps), run['seconds'], run['step_seconds']))
+        return "\n".join(lines)
+
+
+#####################################################
+# Helpers
+#####################################################
+
+def load_spec(path):
+    """ Read a YAML (.yaml/.yml, requires PyYAML) or JSON job spec """
+
+    with open(path) as file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml #NOTE: Imported here so PyYAML stays an optional dependency
+            return yaml.safe_load(file)
+        return json.load(file)
+
+_ENV_VAR = re.compile(r'\$\{(\w+)\}')
+
+def _expand_env(value):
+    """ Expand ${ENV_VAR} in every string of the spec, raising ValueError if one is not set """
+
+    if isinstance(value, dict): return {key: _expand_env(item) for key, item in value.items()}
+    if isinstance(value, list): return [_expand_env(item) for item in value]
+    if isinstance(value, str):
+        #NOTE: expandvars leaves an unset variable in place, which would be passed on as a password or path
+        missing = [name for name in _ENV_VAR.findall(value) if name not in os.environ]
+        if missing: raise ValueError("The job spec uses {}, which is not set in the environment".format(", ".join("${" + name + "}" for name in missing)))
+        return os.path.expandvars(value)
+    return value
+
+def _references(value):
+    """ The steps named by {result_of: step} arguments """
+
+    if isinstance(value, dict):
+        if set(value) == {'result_of'}: return [value['result_of']]
+        return [ref for item in value.values() for ref in _references(item)]
+    if isinstance(value, list): return [ref for item in value for ref in _references(item)]
+    return []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('spec', help="the YAML or JSON job spec")
+    parser.add_argument('--report', help="also write the timing report to this JSON file")
+    parser.add_argument('--max-workers', type=int, help="steps running at once, overrides the spec")
+    parser.add_argument('--dry-run', action='store_true', help="print the steps that can run side by side and exit")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    runner = JobRunner(load_spec(args.spec), max_workers=args.max_workers, verbose=args.verbose)
+    if args.dry_run:
+        for level, names in enumerate(runner.plan()):
+            print("{}: {}".format(level, ", ".join(names)))
+        return 0
+
+    report = runner.run()
+    print(runner.format_report())
+    if args.report: runner.write_report(args.report)
+    return 1 if report['_run']['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
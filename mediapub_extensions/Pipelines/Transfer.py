@@ -0,0 +1,448 @@
+import os
+import csv
+import gzip
+import json
+import time
+import uuid
+import queue
+import shutil
+import tempfile
+import threading
+import itertools
+from mediapub_extensions.ApiWrappers.Instrumentation import instrumentation
+
+class Transfer(object):
+    """
+    Streams data from one wrapper into another
+
+    The reader, serializer and writer each run on their own thread and hand
+    batches to each other through bounded queues, so a slow stage holds the
+    others back (backpressure) instead of everything piling up in memory.
+    Throughput is limited by the slowest stage rather than the sum of them.
+
+    With a checkpoint_file, the number of batches written is saved after
+    every write and a rerun of the same transfer skips those batches.  The
+    reader must return rows in a stable order (e.g. an ORDER BY) for that to
+    be safe.  The checkpoint is saved after the write, so a batch written
+    just before a crash is written again on resume: delivery is at least
+    once, and the writer (or a key on the target table) has to absorb the
+    duplicates if exactly once matters.
+
+    Example:
+        sql = SQLServer(...)
+        sf = Snowflake(...)
+        transfer = Transfer(SQLServerReader(sql, 'SELECT * FROM [AUDREPMETA].[reporting].[starts] ORDER BY id'),
+                            SnowflakeWriter(sf, 'STARTS', 'STARTS', 'CSV_GZIP'),
+                            checkpoint_file='starts.checkpoint')
+        print(transfer.run())
+
+    Attributes:
+        reader: Has open() returning (column names, iterator of row batches)
+        writer: Has write(columns, chunk) and close().  When writer.needs_files is set
+            the batches are serialized to files first, otherwise the writer gets the rows.
+        serializer: Turns (columns, rows) into a chunk file, CsvChunkSerializer by default
+        queue_size (int): The number of batches each queue holds before the stage before it waits
+        verbose (bool): The verbosity flag
+    """
+
+    reader = None
+    writer = None
+    serializer = None
+    queue_size = 4
+    checkpoint_file = None
+    verbose = False
+    instrumentation = instrumentation
+    _DONE = object()
+
+    def __init__(self, reader, writer, serializer=None, queue_size=4, checkpoint_file=None, verbose=False):
+        self.reader = reader
+        self.writer = writer
+        self.serializer = serializer or CsvChunkSerializer()
+        self.queue_size = queue_size
+        self.checkpoint_file = checkpoint_file
+        self.verbose = verbose
+
+    def run(self):
+        """
+        Run the transfer to completion
+
+        Returns:
+            dict: rows, batches, bytes and skipped_batches, plus busy and
+                waiting seconds for each stage
+
+        Raises:
+            The first exception raised by any stage.  The checkpoint keeps the batches written before it.
+        """
+
+        skip = self._load_checkpoint()
+        stats = {'rows': 0, 'batches': 0, 'bytes': 0, 'skipped_batches': skip, 'seconds': 0.0}
+        for stage in ('read', 'serialize', 'write'):
+            stats[stage + '_seconds'] = 0.0
+            stats[stage + '_wait_seconds'] = 0.0
+        self._stop = threading.Event()
+        self._errors = []
+        started = time.perf_counter()
+
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size) if self.writer.needs_files else read_queue
+        workdir = tempfile.mkdtemp(prefix='mediapub_transfer_') if self.writer.needs_files else None
+        columns = {}
+        threads = [threading.Thread(target=self.__guard, args=(self.__read, read_queue, skip, columns, stats), name='transfer-read')]
+        if self.writer.needs_files:
+            threads.append(threading.Thread(target=self.__guard, args=(self.__serialize, read_queue, write_queue, workdir, columns, stats), name='transfer-serialize'))
+
+        try:
+            with self.instrumentation.measure('Transfer', 'run', reader=type(self.reader).__name__, writer=type(self.writer).__name__) as event:
+                for thread in threads: thread.start()
+                self.__guard(self.__write, write_queue, skip, columns, stats)
+                for thread in threads: thread.join()
+                if self._errors: raise self._errors[0]
+                self.writer.close()
+                event.rows, event.bytes, event.pages = stats['rows'], stats['bytes'], stats['batches']
+                event.queue_wait = stats['write_wait_seconds']
+        finally:
+            self._stop.set()
+            for thread in threads: thread.join()
+            if workdir: shutil.rmtree(workdir, ignore_errors=True)
+
+        if self.checkpoint_file and os.path.exists(self.checkpoint_file): os.remove(self.checkpoint_file)
+        stats['seconds'] = time.perf_counter() - started
+        if self.verbose: print("Transferred {} rows in {} batches in {:.1f}s".format(stats['rows'], stats['batches'], stats['seconds']))
+        return stats
+
+    #####################################################
+    # Stages
+    #####################################################
+
+    def __guard(self, stage, *args):
+        """ Run a stage, recording its error and stopping the other stages if it fails """
+
+        try:
+            stage(*args)
+        except BaseException as e:
+            self._errors.append(e)
+            self._stop.set()
+
+    def __put(self, out_queue, item, stats, stage):
+        """ Put an item on a queue, waiting while it is full unless the transfer stopped """
+
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats[stage + '_wait_seconds'] += time.perf_counter() - started
+        return not self._stop.is_set()
+
+    def __get(self, in_queue, stats, stage):
+        """ Get an item from a queue, returns _DONE if the transfer stopped """
+
+        started = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                item = in_queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            item = self._DONE
+        stats[stage + '_wait_seconds'] += time.perf_counter() - started
+        return item
+
+    def __read(self, out_queue, skip, columns, stats):
+        started = time.perf_counter()
+        columns['names'], batches = self.reader.open()
+        try:
+            for index, batch in enumerate(batches):
+                if not batch: continue
+                stats['read_seconds'] += time.perf_counter() - started
+                if index >= skip and not self.__put(out_queue, (index, batch), stats, 'read'): return
+                started = time.perf_counter()
+            stats['read_seconds'] += time.perf_counter() - started
+            self.__put(out_queue, self._DONE, stats, 'read')
+        finally:
+            #NOTE: Closing the batches when another stage fails lets the reader release its connection now, not when they are collected
+            if hasattr(batches, 'close'): batches.close()
+
+    def __serialize(self, in_queue, out_queue, workdir, columns, stats):
+        while True:
+            item = self.__get(in_queue, stats, 'serialize')
+            if item is self._DONE: break
+            index, batch = item
+            started = time.perf_counter()
+            path = self.serializer.serialize(columns['names'], batch, os.path.join(workdir, 'chunk_{:06d}'.format(index)))
+            stats['serialize_seconds'] += time.perf_counter() - started
+            if not self.__put(out_queue, (index, path, len(batch)), stats, 'serialize'): return
+        self.__put(out_queue, self._DONE, stats, 'serialize')
+
+    def __write(self, in_queue, skip, columns, stats):
+        while True:
+            item = self.__get(in_queue, stats, 'write')
+            if item is self._DONE: break
+            started = time.perf_counter()
+            if self.writer.needs_files:
+                index, path, rows = item
+                stats['bytes'] += os.path.getsize(path)
+                self.writer.write(columns['names'], path)
+                os.remove(path)
+            else:
+                index, batch = item
+                rows = len(batch)
+                self.writer.write(columns['names'], batch)
+            stats['write_seconds'] += time.perf_counter() - started
+            stats['rows'] += rows
+            stats['batches'] += 1
+            self._save_checkpoint(index + 1)
+            if self.verbose: print("Wrote batch {} ({} rows)".format(index, rows))
+
+    #####################################################
+    # Checkpoints
+    #####################################################
+
+    def _load_checkpoint(self):
+        """ Return the number of batches a previous run already wrote """
+
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file): return 0
+        with open(self.checkpoint_file) as file:
+            checkpoint = json.load(file)
+        if checkpoint.get('transfer') != self._describe():
+            raise ValueError("Checkpoint {} belongs to a different transfer".format(self.checkpoint_file))
+        if self.verbose: print("Resuming after batch {}".format(checkpoint['batches']))
+        return checkpoint['batches']
+
+    def _save_checkpoint(self, batches):
+        if not self.checkpoint_file: return
+        temp_path = self.checkpoint_file + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'transfer': self._describe(), 'batches': batches}, file)
+        os.replace(temp_path, self.checkpoint_file)
+
+    def _describe(self):
+        """ Identify the transfer so a checkpoint is not resumed by a different one """
+
+        return {'reader': getattr(self.reader, 'description', type(self.reader).__name__),
+                'writer': getattr(self.writer, 'description', type(self.writer).__name__)}
+
+
+#####################################################
+# Readers
+#####################################################
+
+class SQLServerReader(object):
+    """ Read a SQLServer query in batches """
+
+    def __init__(self, sql, query, batch_size=10000):
+        self.sql = sql
+        self.query = query
+        self.batch_size = batch_size
+        self.description = 'SQLServer: ' + query
+
+    def open(self):
+        return self.sql.stream_query(self.query, batch_size=self.batch_size, row_format='tuple')
+
+
+class SnowflakeReader(object):
+    """ Read a Snowflake query in batches """
+
+    def __init__(self, sf, query, batch_size=10000):
+        self.sf = sf
+        self.query = query
+        self.batch_size = batch_size
+        self.description = 'Snowflake: ' + query
+
+    def open(self):
+        return self.sf.stream_query(self.query, batch_size=self.batch_size)
+
+
+class BigQueryReader(object):
+    """ Read the results of a finished BigQuery query page by page """
+
+    def __init__(self, bq, results, max_results=10000):
+        self.bq = bq
+        self.results = results
+        self.max_results = max_results
+        self.description = 'BigQuery: {}'.format(getattr(results, 'name', results))
+
+    def open(self):
+        cols = [col.name for col in self.results.schema]
+        return cols, self.__iter_pages()
+
+    def __iter_pages(self):
+        rows = self.results.fetch_data(max_results=self.max_results)
+        while True:
+            yield [tuple(row) for row in rows]
+            if rows.next_page_token is None: break
+            rows = self.results.fetch_data(max_results=self.max_results, page_token=rows.next_page_token)
+
+
+class AdManagerReportReader(object):
+    """ Run an Ad Manager report and read it in batches as it downloads """
+
+    def __init__(self, dfp, report_job, batch_size=10000, version=None):
+        self.dfp = dfp
+        self.report_job = report_job
+        self.batch_size = batch_size
+        self.version = version
+        self.description = 'GoogleAdManager: ' + json.dumps(report_job, sort_keys=True, default=str)
+
+    def open(self):
+        batches, cols, meta = self.dfp.run_request_stream(self.report_job, version=self.version, batch_size=self.batch_size)
+        return cols, batches
+
+
+class GoogleAnalyticsReader(object):
+    """ Run Google Analytics queries one at a time, each report is a batch """
+
+    def __init__(self, ga, queries):
+        self.ga = ga
+        self.queries = list(queries)
+        self.description = 'GoogleAnalytics: ' + json.dumps(self.queries, sort_keys=True, default=str)
+
+    def open(self):
+        #NOTE: The columns come from the first report, so every query should ask for the same dimensions and metrics
+        reports = (self.ga.parse_response(self.ga.batch_get([self.ga.build_query(params)]))[0] for params in self.queries)
+        first = next(reports, [])
+        cols = list(first[0]) if first else []
+        batches = ([tuple(row.get(col) for col in cols) for row in report] for report in itertools.chain([first], reports))
+        return cols, batches
+
+
+#####################################################
+# Serializers
+#####################################################
+
+class CsvChunkSerializer(object):
+    """ Write each batch to a CSV file, gzip compressed by default """
+
+    def __init__(self, compress=True, header=False):
+        self.compress = compress
+        self.header = header
+
+    def serialize(self, columns, rows, path):
+        path = path + ('.csv.gz' if self.compress else '.csv')
+        opener = gzip.open if self.compress else open
+        #NOTE: compresslevel 1 keeps the serializer from becoming the slowest stage
+        kwargs = {'compresslevel': 1} if self.compress else {}
+        with opener(path, 'wt', newline='', **kwargs) as file:
+            writer = csv.writer(file)
+            if self.header: writer.writerow(columns)
+            writer.writerows(rows)
+        return path
+
+
+class ParquetChunkSerializer(object):
+    """ Write each batch to a snappy compressed Parquet file.  Requires pyarrow. """
+
+    def __init__(self, compression='snappy'):
+        self.compression = compression
+
+    def serialize(self, columns, rows, path):
+        import pyarrow #NOTE: Imported here so pyarrow stays an optional dependency
+        import pyarrow.parquet
+        path = path + '.parquet'
+        table = pyarrow.Table.from_arrays([pyarrow.array(list(col)) for col in zip(*rows)], names=columns)
+        pyarrow.parquet.write_table(table, path, compression=self.compression)
+        return path
+
+
+#####################################################
+# Writers
+#####################################################
+
+class SnowflakeWriter(object):
+    """
+    Load chunk files into a Snowflake table through a stage
+
+    Each chunk is PUT under a prefix on @S_<stage> that is unique to this
+    writer and copied from that prefix only, with PURGE.  Transfers sharing
+    a stage never load each other's chunks or the leftovers of a crashed
+    run.  A chunk copied just before a crash is copied again when the
+    transfer resumes from its checkpoint (at least once, see Transfer).
+    The file_format must match the serializer, e.g. a gzip CSV format
+    without a header.
+    """
+
+    needs_files = True
+
+    def __init__(self, sf, table, stage, file_format, on_error='ABORT_STATEMENT'):
+        self.sf = sf
+        self.table = table
+        self.stage = stage
+        self.file_format = file_format
+        self.on_error = on_error
+        self.prefix = "transfer/{}/".format(uuid.uuid4().hex)
+        self.description = 'Snowflake: {} via @S_{}'.format(table, stage)
+
+    def write(self, columns, path):
+        self.sf.push_files(path, self.stage, prefix=self.prefix)
+        self.sf.process_files(self.table, self.stage, self.file_format, on_error=self.on_error, purge=True, prefix=self.prefix)
+
+    def close(self):
+        pass
+
+
+class BigQueryWriter(object):
+    """ Append chunk files to a BigQuery table with load jobs """
+
+    needs_files = True
+
+    def __init__(self, bq, dataset, table, source_format='CSV'):
+        self.bq = bq
+        self.table = bq.client.dataset(dataset).table(table)
+        self.source_format = source_format
+        self.description = 'BigQuery: {}.{}'.format(dataset, table)
+
+    def write(self, columns, path):
+        source_format = 'PARQUET' if path.endswith('.parquet') else self.source_format
+        with open(path, 'rb') as file:
+            job = self.table.upload_from_file(file, source_format=source_format, write_disposition='WRITE_APPEND', client=self.bq.client)
+        self.bq.wait_for_job(job)
+
+    def close(self):
+        pass
+
+
+class SQLServerWriter(object):
+    """ Insert row batches into a SQL Server table, each batch in one transaction """
+
+    needs_files = False
+
+    def __init__(self, sql, table):
+        self.sql = sql
+        self.table = table
+        self.description = 'SQLServer: ' + table
+
+    def write(self, columns, rows):
+        statement = "INSERT INTO {} ({}) VALUES ({})".format(self.table, ", ".join(columns), ", ".join("?" * len(columns)))
+        with self.sql.transaction() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.fast_executemany = True
+                cursor.executemany(statement, rows)
+            finally:
+                cursor.close()
+
+    def close(self):
+        pass
+
+
+class DirectoryWriter(object):
+    """ Keep the chunk files in a local directory """
+
+    needs_files = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = []
+        self.description = 'Directory: ' + directory
+        if not os.path.isdir(directory): os.makedirs(directory)
+
+    def write(self, columns, path):
+        destination = os.path.join(self.directory, os.path.basename(path))
+        shutil.copyfile(path, destination)
+        self.files.append(destination)
+
+    def close(self):
+        pass
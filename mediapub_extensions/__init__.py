@@ -0,0 +1,31 @@
+import importlib
+
+__version__ = '1.0.beta'
+__author__ = 'David Parks businessintelligence@seattletimes.com'
+
+# The wrappers are loaded on first access so that importing one of them does
+# not pull in every SDK (snowflake, google-cloud, googleads, pyodbc, ...).
+_WRAPPERS = {
+    'BigQuery': 'mediapub_extensions.ApiWrappers.BigQuery',
+    'GoogleAdManager': 'mediapub_extensions.ApiWrappers.GoogleAdManager',
+    'GoogleAnalytics': 'mediapub_extensions.ApiWrappers.GoogleAnalytics',
+    'Snowflake': 'mediapub_extensions.ApiWrappers.Snowflake',
+    'SQLServer': 'mediapub_extensions.ApiWrappers.SQLServer',
+    'Wordpress': 'mediapub_extensions.ApiWrappers.Wordpress',
+}
+
+__all__ = sorted(_WRAPPERS)
+
+
+def __getattr__(name):
+    """ Import a wrapper class the first time it is accessed """
+
+    if name not in _WRAPPERS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    wrapper = getattr(importlib.import_module(_WRAPPERS[name]), name)
+    globals()[name] = wrapper # Cache it so later lookups skip __getattr__
+    return wrapper
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_WRAPPERS))
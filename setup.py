@@ -17,7 +17,14 @@ setup(
                       'oauth2client==4.1.2',
                       'pyodbc',
                       'googleads==20.0.0'
-                      ]
+                      ],
+    extras_require={
+        # BigQuery.stream_results_arrow and process_results_arrow read through the v2 Storage API
+        'bigquery-storage': ['google-cloud-bigquery-storage>=2.0,<3', 'pyarrow'],
+    },
+    entry_points={
+        'console_scripts': ['mediapub-jobs = mediapub_extensions.Pipelines.Jobs:main'],
+    },
     # setup_requires=[],
     # test_suite=''
     # keywords = ''
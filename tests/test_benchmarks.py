@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import importlib
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+
+
+@pytest.fixture(scope='module')
+def bench():
+    sys.path.insert(0, BENCHMARKS)
+    try:
+        yield importlib.import_module('run'), importlib.import_module('import_time')
+    finally:
+        sys.path.remove(BENCHMARKS)
+
+
+@pytest.mark.parametrize('name', [
+    'wordpress.get_posts', 'google_analytics.parse_response', 'sqlserver.run_query', 'sqlserver.stream_query',
+    'sqlserver.run_query_result', 'sqlserver.pooled_concurrent', 'sqlserver.extract_partitioned',
+    'snowflake.run_query', 'google_ad_manager.read_temp_file', 'google_ad_manager.stream_report',
+])
+def test_every_case_reads_the_rows_its_standin_serves(bench, name, tmp_path):
+    run_module, _ = bench
+    setup = dict(run_module.CASES)[name]
+    try:
+        run = setup(str(tmp_path), 0.1)
+    except ImportError as e:
+        pytest.skip(str(e))
+    try:
+        result = run_module.measure(run, repeat=2)
+    finally:
+        if hasattr(run, 'cleanup'): run.cleanup()
+
+    expected = {'wordpress.get_posts': 20, 'google_analytics.parse_response': 500, 'sqlserver.pooled_concurrent': 1000}
+    assert result['rows'] == expected.get(name, 10000)
+    assert result['latency_p50'] <= result['latency_p95'] <= result['latency_max']
+    assert result['peak_mb'] > 0
+
+
+def test_run_writes_the_selected_cases_to_json(bench, tmp_path, monkeypatch):
+    run_module, _ = bench
+    path = tmp_path / 'results.json'
+    monkeypatch.setattr(sys, 'argv', ['run.py', '--repeat', '1', '--scale', '0.01', '--json', str(path), 'google_ad_manager.'])
+    run_module.main()
+
+    results = json.loads(path.read_text())
+    assert sorted(results) == ['google_ad_manager.read_temp_file', 'google_ad_manager.stream_report']
+
+
+def test_wordpress_standin_ends_like_wordpress(bench):
+    standins = sys.modules['standins']
+    server = standins.WordpressServer(pages=2, per_page=3)
+    status, posts = server.respond(standins.urlparse('/wp/v2/posts/?page=2'))
+    assert status == 200 and [post['id'] for post in posts] == [3, 4, 5]
+    status, error = server.respond(standins.urlparse('/wp/v2/posts/?page=3'))
+    assert status == 400 and error['code'] == 'rest_post_invalid_page_number'
+    assert server.respond(standins.urlparse('/wp/v2/posts/7/'))[1]['id'] == 7
+
+
+def test_importing_the_package_loads_no_sdk(bench):
+    _, import_time = bench
+    probe = import_time.probe('')
+    assert probe['error'] is None
+    assert probe['sdks'] == []
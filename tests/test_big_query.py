@@ -0,0 +1,130 @@
+import sys
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('google.cloud.bigquery_storage')
+pyarrow = pytest.importorskip('pyarrow')
+from mediapub_extensions.ApiWrappers.BigQuery import BigQuery
+
+SCHEMA = pyarrow.schema([('id', pyarrow.int64()), ('name', pyarrow.string())])
+
+
+class Field(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Table(object):
+    """ A destination table as the current bigquery client names its parts """
+
+    def __init__(self):
+        self.project, self.dataset_id, self.table_id = 'my-project', '_anon', 'anon123'
+
+
+class LegacyTable(object):
+    """ A destination table as the pinned google-cloud 0.27 client names its parts """
+
+    def __init__(self):
+        self.project, self.dataset_name, self.name = 'my-project', '_anon', 'anon123'
+        self.table_id = 'my-project:_anon.anon123' # The full id once the table has been loaded from the server
+
+
+class Job(object):
+    def __init__(self, table):
+        self.destination = table
+
+
+class Results(object):
+    """ The parts of QueryResults the Arrow methods use """
+
+    def __init__(self, table=None):
+        self.schema = [Field('id'), Field('name')]
+        self.job = Job(table or Table())
+
+
+class Stream(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class Page(object):
+    def __init__(self, batch):
+        self.batch = batch
+
+    def to_arrow(self):
+        return self.batch
+
+
+class FakeReadClient(object):
+    """ A read session whose streams each hold a few record batches of ids """
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.requests = []
+
+    def create_read_session(self, parent, read_session, max_stream_count):
+        self.requests.append((parent, read_session.table, max_stream_count))
+        session = type('Session', (), {})()
+        session.streams = [Stream('stream-{}'.format(i)) for i in range(min(len(self.streams), max_stream_count))]
+        session.arrow_schema = type('ArrowSchema', (), {'serialized_schema': SCHEMA.serialize().to_pybytes()})()
+        return session
+
+    def read_rows(self, name):
+        pages = [Page(pyarrow.record_batch([pyarrow.array(ids, pyarrow.int64()), pyarrow.array([str(i) for i in ids])], schema=SCHEMA))
+                 for ids in self.streams[int(name.split('-')[1])]]
+        reader = type('Reader', (), {})()
+        reader.rows = lambda session: type('Rows', (), {'pages': pages})()
+        return reader
+
+
+def make_bq(streams):
+    bq = BigQuery.__new__(BigQuery) # Skip the login, the read client is stubbed
+    bq.project = 'my-project'
+    bq.read_client = FakeReadClient(streams)
+    return bq
+
+
+STREAMS = [[[0, 1, 2], [3, 4]], [[5], [6, 7, 8], [9]], [[10, 11]]]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_stream_results_arrow_reads_every_stream(ordered):
+    bq = make_bq(STREAMS)
+    cols, batches = bq.stream_results_arrow(Results(), max_streams=3, ordered=ordered)
+    ids = [i for batch in batches for i in batch.column(0).to_pylist()]
+
+    assert cols == ['id', 'name']
+    assert sorted(ids) == list(range(12))
+    if ordered: assert ids == list(range(12))
+    assert bq.read_client.requests == [('projects/my-project', 'projects/my-project/datasets/_anon/tables/anon123', 3)]
+
+
+def test_process_results_arrow_merges_the_streams():
+    table = make_bq(STREAMS).process_results_arrow(Results(), max_streams=3)
+    assert table.schema.equals(SCHEMA)
+    assert table.column('id').to_pylist() == list(range(12))
+
+
+def test_an_empty_table_has_no_streams():
+    bq = make_bq([])
+    cols, batches = bq.stream_results_arrow(Results())
+    assert cols == ['id', 'name'] and list(batches) == []
+
+    table = bq.process_results_arrow(Results())
+    assert table.num_rows == 0 and table.schema.equals(SCHEMA)
+
+
+def test_read_session_uses_the_legacy_table_names():
+    bq = make_bq(STREAMS)
+    bq.process_results_arrow(Results(LegacyTable()))
+    assert bq.read_client.requests[0][1] == 'projects/my-project/datasets/_anon/tables/anon123'
+
+
+def test_a_missing_storage_client_names_the_extra(monkeypatch):
+    import google.cloud
+    monkeypatch.setitem(sys.modules, 'google.cloud.bigquery_storage', None)
+    monkeypatch.delattr(google.cloud, 'bigquery_storage', raising=False)
+    bq = make_bq([])
+    bq.read_client = None
+    with pytest.raises(ImportError, match=r'mediapub_extensions\[bigquery-storage\]'):
+        bq.get_read_client()
@@ -0,0 +1,114 @@
+import datetime
+import pytest
+from array import array
+from mediapub_extensions.ApiWrappers import Cleaning as module
+from mediapub_extensions.ApiWrappers.Cleaning import Cleaner, COERCIONS
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
+
+GA_ROWS = [
+    {'ga:dimension18': ' 1234 ', 'ga:pagePath': '/news/it&#039;s-here', 'ga:pageviews': '12', 'ga:date': '20190102'},
+    {'ga:dimension18': '1235', 'ga:pagePath': '/news/a  &amp;\tb', 'ga:pageviews': '7.0', 'ga:date': '20190103'},
+]
+
+
+def shout(value):
+    """ A custom coercion, module level so the process pool can pickle it """
+
+    return value.upper()
+
+
+def test_headers_are_renamed_or_lose_their_prefix():
+    cleaner = Cleaner(rename={'ga:dimension18': 'articleId'}, prefixes=('ga:', 'Dimension.'))
+    assert cleaner.clean_header('ga:dimension18') == 'articleId'
+    assert cleaner.clean_header('ga:pageviews') == 'pageviews'
+    assert cleaner.clean_header('Dimension.DATE') == 'DATE'
+    assert cleaner.clean_header('views') == 'views'
+
+
+def test_values_are_unescaped_and_collapsed_at_any_depth():
+    cleaner = Cleaner()
+    assert cleaner.clean_value('  It&#039;s\n here ') == "It's here"
+    assert cleaner.clean_value({'rendered': 'A &amp; B', 'tags': [' x ', 3]}) == {'rendered': 'A & B', 'tags': ['x', 3]}
+    assert Cleaner(unescape=False, whitespace=False).clean_value(' a &amp; b ') == ' a &amp; b '
+
+
+def test_clean_records_cleans_and_coerces_every_column():
+    cleaner = Cleaner(rename={'ga:dimension18': 'articleId'}, prefixes=('ga:',), types={'pageviews': 'int', 'date': 'date'})
+    rows = cleaner.clean_records(GA_ROWS, types={'articleId': 'int'})
+    assert rows == [
+        {'articleId': 1234, 'pagePath': "/news/it's-here", 'pageviews': 12, 'date': datetime.date(2019, 1, 2)},
+        {'articleId': 1235, 'pagePath': '/news/a & b', 'pageviews': 7, 'date': datetime.date(2019, 1, 3)},
+    ]
+    assert cleaner.types == {'pageviews': 'int', 'date': 'date'} # Batch types do not stick
+
+
+def test_clean_records_keeps_missing_keys_missing():
+    rows = Cleaner(types={'views': 'int'}).clean_records([{'title': ' a '}, {'views': '3'}])
+    assert rows == [{'title': 'a'}, {'views': 3}]
+
+
+def test_only_the_listed_fields_are_cleaned():
+    cleaner = Cleaner(fields=('title',))
+    post = {'title': {'rendered': 'A &amp; B'}, 'content': {'rendered': '<p>A &amp; B</p>'}}
+    assert cleaner.clean_records([post]) == [{'title': {'rendered': 'A & B'}, 'content': {'rendered': '<p>A &amp; B</p>'}}]
+
+
+def test_a_repeated_value_is_cleaned_once():
+    calls = []
+
+    def coerce(value):
+        calls.append(value)
+        return value
+    assert Cleaner().clean_column('section', ['News', ' News', 'News', 'Sports', 'News'], coerce) == ['News'] * 3 + ['Sports', 'News']
+    assert calls == ['News', 'News', 'Sports']
+
+
+@pytest.mark.parametrize('name, value, expected', [
+    ('int', '12.0', 12),
+    ('int', '', None),
+    ('float', '2.5', 2.5),
+    ('bool', ' Yes', True),
+    ('bool', 'no', False),
+    ('bool', 0, False),
+    ('date', '2019-01-02', datetime.date(2019, 1, 2)),
+    ('date', '20190102', datetime.date(2019, 1, 2)),
+    ('datetime', '2018-05-07T07:30:00Z', datetime.datetime(2018, 5, 7, 7, 30, tzinfo=datetime.timezone.utc)),
+    ('str', 12, '12'),
+    ('str', None, None),
+])
+def test_coercions(name, value, expected):
+    assert COERCIONS[name](value) == expected
+
+
+def test_an_unknown_coercion_is_refused():
+    with pytest.raises(ValueError):
+        Cleaner(types={'views': 'number'}).clean_records([{'views': '1'}])
+
+
+def test_clean_result_stores_numeric_columns_typed():
+    result = QueryResult(['ga:pageviews', 'ga:pagePath'], {'ga:pageviews': ['1', '2'], 'ga:pagePath': ['/a&amp;b', '/c']}, meta={'total': 2})
+    cleaned = Cleaner(prefixes=('ga:',), types={'pageviews': 'int'}).clean_result(result)
+    assert cleaned.columns == ['pageviews', 'pagePath']
+    assert cleaned['pageviews'] == array('q', [1, 2])
+    assert cleaned['pagePath'] == ['/a&b', '/c']
+    assert cleaned.meta == {'total': 2}
+
+
+def test_large_batches_are_cleaned_on_a_process_pool(monkeypatch):
+    pools = []
+
+    class Pool(module.ProcessPoolExecutor):
+        def __init__(self, max_workers=None):
+            pools.append(max_workers)
+            super(Pool, self).__init__(max_workers=max_workers)
+    monkeypatch.setattr(module, 'ProcessPoolExecutor', Pool)
+
+    records = [{'ga:title': 'It&#039;s {}'.format(i % 7), 'ga:views': str(i)} for i in range(50)]
+    records[3] = {'ga:views': '3'}
+    serial = Cleaner(prefixes=('ga:',), types={'views': 'int', 'title': shout})
+    parallel = Cleaner(prefixes=('ga:',), types={'views': 'int', 'title': shout}, processes=3, parallel_threshold=10)
+    rows = parallel.clean_records(records)
+    assert rows == serial.clean_records(records)
+    assert rows[3] == {'views': 3}
+    assert rows[1] == {'title': "IT'S 1", 'views': 1}
+    assert pools == [3]
@@ -0,0 +1,70 @@
+import os
+import datetime
+import pytest
+from mediapub_extensions.ApiWrappers.Credentials import CredentialManager
+
+posix = pytest.mark.skipif(not hasattr(os, 'getuid'), reason="Token file ownership is only checked on POSIX")
+
+
+def expiry():
+    return (datetime.datetime.utcnow() + datetime.timedelta(hours=1)).replace(microsecond=0)
+
+
+def test_token_file_defaults_to_the_user_cache_dir():
+    assert not CredentialManager.token_file.startswith(os.path.realpath('/tmp'))
+    assert CredentialManager.token_file.endswith(os.path.join('mediapub_extensions', 'tokens.json'))
+
+
+@posix
+def test_tokens_are_shared_through_a_private_token_file(tmp_path):
+    path = str(tmp_path / 'cache' / 'tokens.json')
+    CredentialManager(token_file=path).put_token('k', 'abc', expiry())
+
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+    assert CredentialManager(token_file=path).get_token('k')[0] == 'abc'
+
+
+@posix
+def test_a_token_file_others_can_read_is_refused(tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    with open(path, 'w') as file:
+        file.write('{"k": {"token": "planted", "expiry": "2999-01-01T00:00:00"}}')
+    os.chmod(path, 0o644)
+    manager = CredentialManager(token_file=path)
+
+    assert manager.get_token('k') is None
+    manager.put_token('k', 'abc', expiry())
+    assert 'planted' in open(path).read()
+    assert manager.get_token('k')[0] == 'abc' # Still cached in memory
+
+
+def test_an_unusable_token_file_still_refreshes(tmp_path):
+    blocker = tmp_path / 'not_a_dir'
+    blocker.write_text('')
+    manager = CredentialManager(token_file=str(blocker / 'tokens.json'))
+    token = ('abc', expiry())
+
+    assert manager.get_token('k') is None
+    assert manager.get_or_refresh_token('k', lambda: token) == token
+
+
+@pytest.mark.parametrize('content', [
+    '["not", "a", "dict"]',
+    '{"k": "not an entry"}',
+    '{"k": {"expiry": "2999-01-01T00:00:00"}}',
+    '{"k": {"token": "abc"}}',
+    '{"k": {"token": "abc", "expiry": "2999-01-01 00:00:00+00:00"}}',
+    '{"k": {"token": 42, "expiry": "2999-01-01T00:00:00"}}',
+    '{"k": null, "other": {"token": "abc", "expiry": 7}}',
+])
+def test_a_malformed_token_file_is_a_cache_miss(tmp_path, content):
+    path = tmp_path / 'tokens.json'
+    path.write_text(content)
+    os.chmod(str(path), 0o600)
+    manager = CredentialManager(token_file=str(path))
+    token = ('fresh', expiry())
+
+    assert manager.get_token('k') is None
+    assert manager.get_or_refresh_token('k', lambda: token) == token
+    assert CredentialManager(token_file=str(path)).get_token('k') == token
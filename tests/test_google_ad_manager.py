@@ -0,0 +1,305 @@
+import gc
+import os
+import re
+import gzip
+import pytest
+
+pytest.importorskip('googleads')
+import googleads.errors
+from googleads import ad_manager, common
+from mediapub_extensions.ApiWrappers.GoogleAdManager import GoogleAdManager
+
+posix = pytest.mark.skipif(not hasattr(os, 'getuid'), reason="Cache file ownership is only checked on POSIX")
+
+
+class FakeStatement(object):
+    """ The parts of StatementBuilder that iter_by_statement uses """
+
+    def __init__(self, limit):
+        self.offset = 0
+        self.limit = limit
+
+    def ToStatement(self):
+        return {'offset': self.offset, 'limit': self.limit}
+
+
+class FakeLineItemService(object):
+    def __init__(self, total):
+        self.total = total
+
+    def getLineItemsByStatement(self, statement):
+        ids = range(statement['offset'], min(statement['offset'] + statement['limit'], self.total))
+        return {'totalResultSetSize': self.total, 'results': [{'id': i} for i in ids]}
+
+
+class FakeClient(object):
+    cache = None
+
+    @classmethod
+    def LoadFromStorage(cls):
+        return cls()
+
+
+@pytest.fixture
+def login(monkeypatch):
+    monkeypatch.setattr(ad_manager, 'AdManagerClient', FakeClient, raising=False)
+
+
+def make_dfp(service):
+    dfp = GoogleAdManager.__new__(GoogleAdManager) # Skip the login, the fakes need no client
+    dfp.get_service = lambda *args, **kwargs: service
+    return dfp
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+@pytest.mark.parametrize('count', [0, 1, 7, 8, 9, 20, 101])
+def test_iter_parallel_maps_every_item(count, ordered):
+    results = list(GoogleAdManager._iter_parallel(lambda x: x, range(count), max_workers=4, ordered=ordered))
+    assert sorted(results) == list(range(count))
+    if ordered: assert results == list(range(count))
+
+
+def test_iter_parallel_maps_none_items():
+    items = [1, None, 2, None] * 10
+    assert list(GoogleAdManager._iter_parallel(lambda x: x, items, max_workers=2)) == items
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_iter_by_statement_returns_every_page(max_workers):
+    dfp = make_dfp(FakeLineItemService(total=2047))
+    results = list(dfp.iter_by_statement('LineItemService', 'getLineItemsByStatement', statement=FakeStatement(limit=100), version='v0', max_workers=max_workers))
+    assert [result['id'] for result in results] == list(range(2047))
+
+
+def test_iter_by_statement_leaves_the_statement_as_it_was():
+    dfp = make_dfp(FakeLineItemService(total=1000))
+    statement = FakeStatement(limit=100)
+    statement.offset = 200
+    results = list(dfp.iter_by_statement('LineItemService', 'getLineItemsByStatement', statement=statement, version='v0'))
+
+    assert [result['id'] for result in results] == list(range(200, 1000))
+    assert (statement.offset, statement.limit) == (200, 100)
+    assert len(list(dfp.iter_by_statement('LineItemService', 'getLineItemsByStatement', statement=statement, version='v0'))) == 800
+
+
+class FakeLineItemTable(object):
+    """
+    A Line_Item table behind the PQL service and DownloadPqlResultToList, filtering on Id ranges
+
+    Like googleads, an empty result has no header row unless empty_header is set.
+    """
+
+    def __init__(self, ids, empty_header=False):
+        self.ids = sorted(ids)
+        self.empty_header = empty_header
+
+    def select(self, statement):
+        # _get_pql_key_bound asks for the lowest or highest Id
+        if not self.ids: return {}
+        value = self.ids[-1] if 'DESC' in statement['query'] else self.ids[0]
+        return {'rows': [{'values': [{'value': str(value)}]}]}
+
+    def GetDataDownloader(self, version=None):
+        return self
+
+    def DownloadPqlResultToList(self, query):
+        match = re.search(r'Id >= (\d+) AND Id < (\d+)', query)
+        ids = [i for i in self.ids if i >= int(match.group(1)) and i < int(match.group(2))] if match else self.ids
+        if not ids and not self.empty_header: return []
+        return [['id', 'name']] + [[i, 'Line item {}'.format(i)] for i in ids]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+@pytest.mark.parametrize('partitions,max_workers', [(16, 4), (32, 2), (3, 8), (100, 4)])
+def test_run_pql_partitioned_covers_every_partition(partitions, max_workers, ordered):
+    table = FakeLineItemTable([i for i in range(35, 5000) if i % 11])
+    dfp = make_dfp(table)
+    dfp.client = table
+    dfp.default_version = 'v0'
+
+    query = 'SELECT Id, Name FROM Line_Item'
+    unpartitioned = dfp.run_pql(query)
+    rows = list(dfp.run_pql_partitioned(query, partitions=partitions, max_workers=max_workers, ordered=ordered))
+    assert rows[0] == unpartitioned[0]
+    assert len(rows) == len(unpartitioned)
+    assert sorted(row[0] for row in rows[1:]) == table.ids
+    if ordered: assert rows[1:] == unpartitioned[1:]
+
+
+def make_pql_dfp(table):
+    dfp = make_dfp(table)
+    dfp.client = table
+    dfp.default_version = 'v0'
+    return dfp
+
+
+@pytest.mark.parametrize('empty_header', [True, False])
+def test_run_pql_partitioned_on_an_empty_table_matches_run_pql(empty_header):
+    dfp = make_pql_dfp(FakeLineItemTable([], empty_header=empty_header))
+    query = 'SELECT Id, Name FROM Line_Item'
+    assert list(dfp.run_pql_partitioned(query)) == dfp.run_pql(query)
+
+
+class VanishingLineItemTable(FakeLineItemTable):
+    """ Rows deleted between the key bound queries and the partition queries """
+
+    def DownloadPqlResultToList(self, query):
+        return [['id', 'name']] if self.empty_header else []
+
+
+@pytest.mark.parametrize('empty_header', [True, False])
+def test_run_pql_partitioned_with_only_empty_partitions_matches_run_pql(empty_header):
+    dfp = make_pql_dfp(VanishingLineItemTable([1, 500], empty_header=empty_header))
+    query = 'SELECT Id, Name FROM Line_Item'
+    assert list(dfp.run_pql_partitioned(query, partitions=4)) == dfp.run_pql(query)
+    assert list(dfp.run_pql_partitioned(query, partitions=4)) == ([['id', 'name']] if empty_header else [])
+
+
+def test_run_pql_to_file_writes_nothing_for_an_empty_result(tmp_path):
+    dfp = make_pql_dfp(FakeLineItemTable([]))
+    path = tmp_path / 'line_items.csv'
+    assert dfp.run_pql_to_file('SELECT Id, Name FROM Line_Item', str(path)) == 0
+    assert not path.exists()
+
+
+def test_wsdl_cache_defaults_to_the_user_cache_dir():
+    assert not GoogleAdManager.wsdl_cache_path.startswith(os.path.realpath('/tmp'))
+    assert GoogleAdManager.wsdl_cache_path.endswith(os.path.join('mediapub_extensions', 'wsdl_cache.db'))
+
+
+@posix
+def test_wsdl_cache_is_a_private_file(login, tmp_path):
+    path = str(tmp_path / 'cache' / 'wsdl_cache.db')
+    dfp = GoogleAdManager(wsdl_cache_path=path)
+
+    assert dfp.wsdl_cache_path == path
+    assert dfp.client.cache.path == path
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o700
+
+
+def test_no_wsdl_cache_path_turns_caching_off(login):
+    dfp = GoogleAdManager(wsdl_cache_path=None)
+    assert dfp.wsdl_cache_path is None
+    assert dfp.client.cache == common.ZeepServiceProxy.NO_CACHE
+
+
+@posix
+def test_a_wsdl_cache_others_can_write_is_not_used(login, tmp_path):
+    path = tmp_path / 'wsdl_cache.db'
+    path.write_text('')
+    os.chmod(str(path), 0o666)
+    dfp = GoogleAdManager(wsdl_cache_path=str(path))
+
+    assert dfp.wsdl_cache_path is None
+    assert dfp.client.cache == common.ZeepServiceProxy.NO_CACHE
+
+
+class FakeReportDownloader(object):
+    """ Saves a gzip compressed CSV_DUMP report with properties to the file it is given """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.files = []
+
+    def GetDataDownloader(self, version=None):
+        return self
+
+    def DownloadReportToFile(self, report_job_id, export_format, outfile, include_report_properties=True, use_gzip_compression=True):
+        lines = ['Report job ID,{}'.format(report_job_id)] + ['Property {},value'.format(i) for i in range(1, 7)] + ['', 'Date,Impressions']
+        lines += ['2019-10-{:02d},{}'.format(i % 28 + 1, i) for i in range(self.rows)]
+        data = "\n".join(lines).encode('utf-8')
+        outfile.write(gzip.compress(data) if use_gzip_compression else data)
+        self.files.append(outfile.name)
+
+
+def test_stream_report_returns_every_row():
+    downloader = FakeReportDownloader(rows=25)
+    dfp = make_dfp(None)
+    dfp.client = downloader
+    rows, cols, meta = dfp.stream_report(1, version='v0', batch_size=10)
+
+    assert cols == ['Date', 'Impressions']
+    assert meta['Property 1'] == 'value'
+    assert [len(batch) for batch in rows] == [10, 10, 5]
+    assert not os.path.exists(downloader.files[0])
+
+
+@pytest.mark.parametrize('read', [0, 1])
+def test_abandoned_stream_report_removes_its_temp_file(read):
+    downloader = FakeReportDownloader(rows=25)
+    dfp = make_dfp(None)
+    dfp.client = downloader
+    rows, cols, meta = dfp.stream_report(1, version='v0')
+    for _ in range(read): next(rows)
+    assert os.path.exists(downloader.files[0])
+
+    del rows
+    gc.collect()
+    assert not os.path.exists(downloader.files[0])
+
+
+class FakeReportService(object):
+    """ Runs each report job for its number of polls, then ends it in its status """
+
+    def __init__(self):
+        self.jobs = {}
+        self.polls = {}
+
+    def runReportJob(self, report_job):
+        report_job_id = len(self.jobs) + 1
+        self.jobs[report_job_id] = report_job
+        self.polls[report_job_id] = 0
+        return {'id': report_job_id}
+
+    def getReportJobStatus(self, report_job_id):
+        self.polls[report_job_id] += 1
+        report_job = self.jobs[report_job_id]
+        if self.polls[report_job_id] < report_job['polls']: return 'IN_PROGRESS'
+        return report_job.get('status', 'COMPLETED')
+
+
+def make_report_dfp(rows=5):
+    service = FakeReportService()
+    dfp = make_dfp(service)
+    dfp.client = FakeReportDownloader(rows)
+    dfp.default_version = 'v0'
+    return dfp, service
+
+
+def test_run_requests_downloads_every_report():
+    dfp, service = make_report_dfp(rows=5)
+    results = dfp.run_requests({'revenue': {'polls': 3}, 'requests': {'polls': 1}}, poll_interval=0)
+
+    assert list(results) == ['revenue', 'requests']
+    data, cols, meta = results['revenue']
+    assert cols == ['Date', 'Impressions']
+    assert len(data) == 5 and data[0] == ['2019-10-01', '0']
+    assert meta['Property 1'] == 'value'
+    assert service.polls == {1: 3, 2: 1} # Each job stops being polled once it is done
+    assert not any(os.path.exists(name) for name in dfp.client.files)
+
+
+def test_run_requests_keys_a_list_by_index():
+    dfp, _ = make_report_dfp()
+    results = dfp.run_requests([{'polls': 2}, {'polls': 1}], poll_interval=0)
+    assert sorted(results) == [0, 1]
+
+
+def test_run_requests_raises_a_failed_report():
+    dfp, _ = make_report_dfp()
+    with pytest.raises(googleads.errors.AdManagerReportError):
+        dfp.run_requests({'ok': {'polls': 1}, 'broken': {'polls': 2, 'status': 'FAILED'}}, poll_interval=0)
+
+
+def test_run_requests_can_return_failures_with_the_results():
+    dfp, _ = make_report_dfp()
+    results = dfp.run_requests({'ok': {'polls': 1}, 'broken': {'polls': 2, 'status': 'FAILED'}}, poll_interval=0, raise_errors=False)
+    assert isinstance(results['broken'], googleads.errors.AdManagerReportError)
+    assert len(results['ok'][0]) == 5
+
+
+def test_run_requests_gives_up_after_the_timeout():
+    dfp, _ = make_report_dfp()
+    with pytest.raises(RuntimeError, match='stuck'):
+        dfp.run_requests({'done': {'polls': 1}, 'stuck': {'polls': 10 ** 6}}, poll_interval=0.01, timeout=0.05)
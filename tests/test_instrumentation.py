@@ -0,0 +1,21 @@
+import pytest
+from mediapub_extensions.ApiWrappers.Instrumentation import Instrumentation, MemorySink
+
+
+def test_stopping_a_measured_generator_early_is_not_an_error():
+    sink = MemorySink()
+    batches = Instrumentation([sink]).measure_iter(iter([[1, 2], [3]]), 'SQLServer', 'stream_query')
+    assert next(batches) == [1, 2]
+    batches.close()
+
+    event, = sink.events
+    assert event.error is None
+    assert (event.pages, event.rows) == (1, 2)
+
+
+def test_a_failed_block_records_its_error():
+    sink = MemorySink()
+    with pytest.raises(ValueError):
+        with Instrumentation([sink]).measure('Snowflake', 'run_query'):
+            raise ValueError("bad query")
+    assert sink.events[0].error == 'ValueError'
@@ -0,0 +1,107 @@
+import time
+import threading
+import pytest
+import mediapub_extensions
+from mediapub_extensions.Pipelines.Jobs import JobRunner
+
+
+class FakeCursor(object):
+    """ Tracks how many steps use it at once """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most = 0
+
+    def work(self):
+        with self.lock:
+            self.active += 1
+            self.most = max(self.most, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+
+
+def test_services_sharing_an_instance_share_the_smallest_limit():
+    args = {'dsn': 'AUDREP', 'user_id': 'etl'}
+    spec = {
+        'services': {
+            'audrep': {'wrapper': 'SQLServer', 'args': args},
+            'audrep_again': {'wrapper': 'SQLServer', 'args': dict(args), 'concurrency': 4},
+        },
+        'steps': {
+            'a': {'service': 'audrep', 'method': 'work'},
+            'b': {'service': 'audrep_again', 'method': 'work'},
+            'c': {'service': 'audrep_again', 'method': 'work'},
+        },
+    }
+    runner = JobRunner(spec, max_workers=4)
+    cursor = FakeCursor()
+    runner._instances[runner._services['audrep']['key']] = cursor
+
+    report = runner.run()
+
+    assert runner.get_service('audrep') is runner.get_service('audrep_again') is cursor
+    assert runner._services['audrep_again']['concurrency'] == 1
+    assert cursor.most == 1
+    assert report['_run']['failed'] == []
+
+
+def test_transfer_on_one_instance_takes_one_slot():
+    spec = {
+        'services': {
+            'warehouse': {'wrapper': 'Snowflake', 'args': {'account': 'xy12345'}, 'concurrency': 1},
+            'warehouse_again': {'wrapper': 'Snowflake', 'args': {'account': 'xy12345'}},
+        },
+        'steps': {'copy': {'transfer': {'reader': {'service': 'warehouse'}, 'writer': {'service': 'warehouse_again'}}}},
+    }
+    runner = JobRunner(spec)
+    taken = runner._JobRunner__try_acquire(['warehouse', 'warehouse_again'])
+    assert taken
+    assert not runner._JobRunner__try_acquire(['warehouse'])
+    runner._JobRunner__release(['warehouse', 'warehouse_again'])
+    assert runner._JobRunner__try_acquire(['warehouse'])
+
+
+class SlowWrapper(object):
+    """ Connects only once another instance is connecting at the same time """
+
+    barrier = None
+
+    def __init__(self, account):
+        self.account = account
+        self.barrier.wait()
+
+
+def test_services_connect_side_by_side(monkeypatch):
+    monkeypatch.setattr(mediapub_extensions, 'SlowWrapper', SlowWrapper, raising=False)
+    monkeypatch.setattr(SlowWrapper, 'barrier', threading.Barrier(2, timeout=5))
+    spec = {
+        'services': {
+            'east': {'wrapper': 'SlowWrapper', 'args': {'account': 'east'}},
+            'west': {'wrapper': 'SlowWrapper', 'args': {'account': 'west'}},
+        },
+        'steps': {'noop': {}},
+    }
+    runner = JobRunner(spec)
+    instances = {}
+    threads = [threading.Thread(target=lambda name=name: instances.update({name: runner.get_service(name)})) for name in ('east', 'west')]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert instances['east'].account == 'east' and instances['west'].account == 'west'
+    assert runner.get_service('east') is instances['east']
+
+
+def test_env_vars_in_the_spec_are_expanded(monkeypatch):
+    monkeypatch.setenv('AUDREP_PASSWORD', 's3cret')
+    spec = {'services': {'audrep': {'wrapper': 'SQLServer', 'args': {'password': '${AUDREP_PASSWORD}', 'dsn': 'pa$$word'}}}, 'steps': {'noop': {}}}
+    args = JobRunner(spec).spec['services']['audrep']['args']
+    assert args == {'password': 's3cret', 'dsn': 'pa$$word'}
+
+
+def test_an_unset_env_var_is_a_config_error(monkeypatch):
+    monkeypatch.delenv('AUDREP_PASSWORD', raising=False)
+    spec = {'services': {'audrep': {'wrapper': 'SQLServer', 'args': {'password': '${AUDREP_PASSWORD}'}}}, 'steps': {'noop': {}}}
+    with pytest.raises(ValueError, match=r'\$\{AUDREP_PASSWORD\}'):
+        JobRunner(spec)
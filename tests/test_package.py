@@ -0,0 +1,32 @@
+import os
+import importlib.util
+import mediapub_extensions
+
+WRAPPERS = ['BigQuery', 'GoogleAdManager', 'GoogleAnalytics', 'SQLServer', 'Snowflake', 'Wordpress']
+
+
+def load_root():
+    """ The repository root __init__, imported as a stand-alone module """
+
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '__init__.py')
+    spec = importlib.util.spec_from_file_location('mediapub_root', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_package_keeps_its_metadata():
+    assert mediapub_extensions.__version__ == '1.0.beta'
+    assert mediapub_extensions.__author__
+
+
+def test_lazy_wrappers_are_listed_before_they_are_loaded():
+    assert sorted(mediapub_extensions.__all__) == sorted(WRAPPERS)
+    assert set(WRAPPERS) <= set(dir(mediapub_extensions))
+
+
+def test_root_keeps_its_metadata_and_lists_the_wrappers():
+    root = load_root()
+    assert root.__version__ == mediapub_extensions.__version__
+    assert root.__author__ == mediapub_extensions.__author__
+    assert set(WRAPPERS) <= set(dir(root))
@@ -0,0 +1,86 @@
+import pytest
+from array import array
+from mediapub_extensions.ApiWrappers.QueryResult import QueryResult
+
+COLUMNS = ['id', 'revenue', 'name', 'flag']
+ROWS = [(1, 2.5, 'a', True), (2, 3, 'b', False), (3, 4.0, None, True)]
+
+
+def test_numeric_columns_are_typed_arrays():
+    result = QueryResult.from_rows(ROWS, COLUMNS)
+    assert result['id'] == array('q', [1, 2, 3])
+    assert result['revenue'] == array('d', [2.5, 3.0, 4.0])
+    assert result['name'] == ['a', 'b', None]
+    assert result['flag'] == [True, False, True] # bools are not numbers here
+    assert not isinstance(QueryResult.from_rows(ROWS, COLUMNS, typed=False)['id'], array)
+
+
+def test_ints_too_large_for_64_bits_stay_a_list():
+    assert QueryResult(['big'], {'big': [1, 2 ** 70]})['big'] == [1, 2 ** 70]
+
+
+def test_from_batches_matches_from_rows():
+    batches = iter([ROWS[:2], [], ROWS[2:]])
+    result = QueryResult.from_batches(batches, COLUMNS, meta={'total': 3})
+    assert result.to_rows() == QueryResult.from_rows(ROWS, COLUMNS).to_rows() == [(1, 2.5, 'a', True), (2, 3.0, 'b', False), (3, 4.0, None, True)]
+    assert result.meta == {'total': 3}
+
+
+def test_from_records_fills_missing_keys():
+    result = QueryResult.from_records([{'id': 1}, {'name': 'b', 'id': 2}])
+    assert result.columns == ['id', 'name']
+    assert result.to_dicts() == [{'id': 1, 'name': None}, {'id': 2, 'name': 'b'}]
+
+
+def test_empty_results_keep_their_columns():
+    result = QueryResult.from_batches([], COLUMNS)
+    assert len(result) == 0 and result.columns == COLUMNS
+    assert list(result.iter_batches(10)) == []
+
+
+@pytest.mark.parametrize('data', [{'id': [1, 2], 'name': ['a']}, None])
+def test_invalid_columns_are_rejected(data):
+    columns = ['id', 'name'] if data else ['id', 'id']
+    with pytest.raises(ValueError):
+        QueryResult(columns, data)
+
+
+def test_iter_batches_slices_every_column():
+    result = QueryResult.from_rows([(i, str(i)) for i in range(25)], ['id', 'name'], meta={'source': 'test'})
+    batches = list(result.iter_batches(10))
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert isinstance(batches[-1]['id'], array) and batches[-1]['id'].tolist() == list(range(20, 25))
+    assert batches[0].meta is result.meta
+
+
+def test_to_arrow_wraps_typed_arrays_without_copying():
+    pyarrow = pytest.importorskip('pyarrow')
+    result = QueryResult.from_rows(ROWS, COLUMNS)
+    table = result.to_arrow()
+
+    assert table.column_names == COLUMNS
+    assert table.schema.field('id').type == pyarrow.int64()
+    assert table.schema.field('revenue').type == pyarrow.float64()
+    assert table.column('id').chunk(0).buffers()[1].address == result['id'].buffer_info()[0]
+    assert table.to_pylist()[2] == {'id': 3, 'revenue': 4.0, 'name': None, 'flag': True}
+
+
+def test_to_pandas_through_arrow():
+    pytest.importorskip('pyarrow')
+    pandas = pytest.importorskip('pandas')
+    frame = QueryResult.from_rows(ROWS, COLUMNS).to_pandas()
+    assert list(frame.columns) == COLUMNS
+    assert frame['id'].tolist() == [1, 2, 3]
+    assert str(frame['revenue'].dtype) == 'float64'
+
+
+def test_to_pandas_without_pyarrow(monkeypatch):
+    pytest.importorskip('pandas')
+
+    def to_arrow(self):
+        raise ImportError("No module named 'pyarrow'")
+    #NOTE: pandas may use pyarrow itself, so only the wrapper's conversion is cut off
+    monkeypatch.setattr(QueryResult, 'to_arrow', to_arrow)
+    frame = QueryResult.from_rows(ROWS, COLUMNS).to_pandas()
+    assert list(frame.columns) == COLUMNS
+    assert frame['name'].tolist()[:2] == ['a', 'b']
@@ -0,0 +1,82 @@
+import pytest
+from mediapub_extensions.ApiWrappers import RateLimiter as module
+from mediapub_extensions.ApiWrappers.RateLimiter import RateLimiter, MemoryBucketStore, SqliteBucketStore, FileBucketStore
+
+STORES = {
+    'memory': lambda path: MemoryBucketStore(),
+    'sqlite': lambda path: SqliteBucketStore(str(path / 'quota.db')),
+    'file': lambda path: FileBucketStore(str(path / 'quota.json')),
+}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """ Record the sleeps instead of taking them """
+
+    slept = []
+    monkeypatch.setattr(module.time, 'sleep', slept.append)
+    return slept
+
+
+@pytest.mark.parametrize('store', sorted(STORES))
+def test_a_bucket_bursts_then_waits_for_its_rate(store, tmp_path, sleeps):
+    limiter = RateLimiter(STORES[store](tmp_path), limits={'Service': (10.0, 3)})
+    waits = [limiter.acquire('Service', 'view') for _ in range(5)]
+
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] == pytest.approx(0.1, abs=0.02)
+    assert waits[4] == pytest.approx(0.2, abs=0.02) # Reserved behind the one before it
+    assert sleeps == waits[3:]
+    assert limiter.stats['Service:view'] == {'acquires': 5, 'waits': 2, 'wait_seconds': sum(waits), 'throttles': 0}
+
+
+@pytest.mark.parametrize('store', sorted(STORES))
+def test_scopes_have_their_own_buckets(store, tmp_path, sleeps):
+    limiter = RateLimiter(STORES[store](tmp_path), limits={'Service': (10.0, 1)})
+    assert limiter.acquire('Service', 'a') == 0.0
+    assert limiter.acquire('Service', 'b') == 0.0
+    assert limiter.acquire('Service') == 0.0
+    assert limiter.acquire('Service', 'a') > 0
+
+
+@pytest.mark.parametrize('store', ['sqlite', 'file'])
+def test_stores_on_the_same_file_share_one_budget(store, tmp_path, sleeps):
+    #NOTE: Each limiter opens the file on its own, like workers in separate processes
+    first = RateLimiter(STORES[store](tmp_path), limits={'Service': (10.0, 2)})
+    second = RateLimiter(STORES[store](tmp_path), limits={'Service': (10.0, 2)})
+    assert first.acquire('Service') == 0.0
+    assert second.acquire('Service') == 0.0
+    assert first.acquire('Service') > 0
+    assert second.acquire('Service') > 0
+
+
+@pytest.mark.parametrize('store', sorted(STORES))
+def test_throttled_halves_the_rate_and_drops_the_burst(store, tmp_path, sleeps):
+    limiter = RateLimiter(STORES[store](tmp_path), limits={'Service': (10.0, 5)}, recovery_seconds=1000.0)
+    limiter.acquire('Service')
+    limiter.throttled('Service')
+    assert limiter.acquire('Service') == pytest.approx(0.2, abs=0.02)
+    limiter.throttled('Service')
+    assert limiter.acquire('Service') > 0.6 # The second token waits behind the first, at a quarter of the rate
+    assert limiter.stats['Service']['throttles'] == 2
+
+
+def test_a_corrupt_bucket_file_resets_the_buckets(tmp_path, sleeps):
+    path = tmp_path / 'quota.json'
+    path.write_text('{"Service": {"tokens": ')
+    limiter = RateLimiter(FileBucketStore(str(path)), limits={'Service': (10.0, 2)})
+    assert limiter.acquire('Service') == 0.0
+    assert limiter.acquire('Service') == 0.0
+
+
+def test_unknown_services_need_a_limit():
+    with pytest.raises(KeyError):
+        RateLimiter().acquire('Nowhere')
+
+
+def test_backoff_prefers_retry_after(sleeps):
+    limiter = RateLimiter()
+    assert limiter.backoff(3, retry_after='7') == 7.0
+    assert limiter.backoff(3) == 8.0
+    assert limiter.backoff(10) == 60.0
+    assert sleeps == [7.0, 8.0, 60.0]
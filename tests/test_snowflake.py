@@ -0,0 +1,79 @@
+import os
+import re
+import pytest
+
+pytest.importorskip('snowflake.connector')
+from mediapub_extensions.ApiWrappers.Snowflake import Snowflake
+
+
+class FakeCursor(object):
+    """ Answers the unload statements the way Snowflake does, GET writes the files locally """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.results = []
+
+    def execute(self, statement):
+        self.ctx.statements.append(statement)
+        self.results = []
+        if statement.startswith('copy into @'):
+            self.results = [(name, 1000, rows) for name, rows in self.ctx.files]
+        elif statement.startswith('get '):
+            directory = re.search(r'file://(\S+?)/ ', statement).group(1)
+            for name, rows in self.ctx.files:
+                with open(os.path.join(directory, name), 'wb') as file:
+                    file.write(b'x' * rows)
+        return self
+
+    def fetchall(self):
+        return self.results
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def __init__(self, files):
+        self.files = files
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+def make_sf(files):
+    sf = Snowflake.__new__(Snowflake) # Skip the login, the connection is a fake
+    sf.verbose = False
+    sf.set_environment_settings()
+    sf.ctx = FakeConnection(files)
+    return sf
+
+
+FILES = [('data_0_0_2.csv.gz', 30), ('data_0_0_0.csv.gz', 10), ('data_0_0_1.csv.gz', 20)]
+
+
+def test_unload_downloads_every_file_with_one_get(tmp_path):
+    sf = make_sf(FILES)
+    files = sf.unload_query("SELECT * FROM starts", 'EXPORTS', str(tmp_path), max_workers=8)
+
+    assert files == [(str(tmp_path / name), rows) for name, rows in sorted(FILES)]
+    statements = [statement for statement in sf.ctx.statements if not statement.startswith('USE')]
+    assert [statement.split()[0] for statement in statements] == ['copy', 'get', 'remove']
+    assert 'parallel = 8;' in statements[1]
+    prefix = re.search(r'@S_EXPORTS/unload/\w+/', statements[0]).group(0)
+    assert all(prefix in statement for statement in statements)
+
+
+def test_an_empty_unload_skips_the_get(tmp_path):
+    sf = make_sf([])
+    assert sf.unload_query("SELECT * FROM starts WHERE 1 = 0", 'EXPORTS', str(tmp_path)) == []
+    assert not any(statement.startswith('get ') for statement in sf.ctx.statements)
+    assert sf.ctx.statements[-1].startswith('remove ')
+
+
+def test_closing_iter_unload_early_still_cleans_up_the_stage(tmp_path):
+    sf = make_sf(FILES)
+    files = sf.iter_unload("SELECT * FROM starts", 'EXPORTS', str(tmp_path))
+    assert next(files) == (str(tmp_path / 'data_0_0_0.csv.gz'), 10)
+    files.close()
+    assert sf.ctx.statements[-1].startswith('remove ')
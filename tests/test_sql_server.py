@@ -0,0 +1,248 @@
+import gc
+import decimal
+import sqlite3
+import datetime
+import pytest
+
+pyodbc = pytest.importorskip('pyodbc')
+from mediapub_extensions.ApiWrappers.SQLServer import SQLServer
+
+
+class FakeCursor(object):
+    description = (('id',), ('name',))
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.closed = False
+
+    def execute(self, query, *params):
+        return self
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.cursors = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        self.cursors.append(FakeCursor([(i, 'row') for i in range(5)]))
+        return self.cursors[-1]
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sql(monkeypatch):
+    monkeypatch.setattr(pyodbc, 'connect', lambda conn_string: FakeConnection())
+    return SQLServer(dsn='AUDREP', user_id='etl', password='secret', pool_size=1, pool_timeout=0.1)
+
+
+def test_unread_stream_hands_its_connection_back(sql):
+    cols, batches = sql.stream_query("SELECT id, name FROM starts")
+    assert cols == ['id', 'name']
+    del batches
+    gc.collect()
+
+    conn = sql._SQLServer__pool.get_nowait()
+    assert conn.cursors[-1].closed and conn.rollbacks == 1
+    sql._SQLServer__pool.put(conn)
+    cols, batches = sql.stream_query("SELECT id, name FROM starts")
+    assert [row for batch in batches for row in batch] == [(i, 'row') for i in range(5)]
+
+
+def test_read_stream_hands_its_connection_back_once(sql):
+    cols, batches = sql.stream_query("SELECT id, name FROM starts", batch_size=2)
+    assert sum(len(batch) for batch in batches) == 5
+    del batches
+    gc.collect()
+
+    assert sql._SQLServer__pool.qsize() == 1
+    assert sql._SQLServer__pool_opened == 1
+    assert sql._SQLServer__pool.get_nowait().rollbacks == 0
+
+
+ROWS = [(i, 'row') for i in range(5)]
+
+
+@pytest.mark.parametrize('row_format, first', [
+    ('tuple', [(0, 'row'), (1, 'row')]),
+    ('dict', [{'id': 0, 'name': 'row'}, {'id': 1, 'name': 'row'}]),
+    ('columns', {'id': [0, 1], 'name': ['row', 'row']}),
+])
+def test_stream_query_pages_in_the_requested_format(sql, row_format, first):
+    cols, batches = sql.stream_query("SELECT id, name FROM starts", batch_size=2, row_format=row_format)
+    batches = list(batches)
+    assert cols == ['id', 'name']
+    assert len(batches) == 3
+    assert batches[0] == first
+
+
+def test_stream_query_into_dataframes(sql):
+    pytest.importorskip('pandas')
+    cols, batches = sql.stream_query("SELECT id, name FROM starts", batch_size=4, row_format='dataframe')
+    frames = list(batches)
+    assert [len(frame) for frame in frames] == [4, 1]
+    assert list(frames[0].columns) == cols
+    assert frames[1].iloc[0].tolist() == [4, 'row']
+
+
+def test_stream_query_without_a_pool(monkeypatch):
+    monkeypatch.setattr(pyodbc, 'connect', lambda conn_string: FakeConnection())
+    sql = SQLServer(dsn='AUDREP', user_id='etl', password='secret')
+    cols, batches = sql.stream_query("SELECT id, name FROM starts", batch_size=3)
+    assert [row for batch in batches for row in batch] == ROWS
+    assert sql.conn.cursors[-1].closed
+
+
+def test_stream_query_rejects_an_unknown_row_format(sql):
+    with pytest.raises(ValueError):
+        sql.stream_query("SELECT id, name FROM starts", row_format='xml')
+    assert sql._SQLServer__pool_opened == 0
+
+
+def test_convert_rows():
+    cols = ['id', 'name']
+    assert SQLServer.convert_rows(ROWS, cols, 'row') is ROWS
+    assert SQLServer.convert_rows([[0, 'row']], cols, 'tuple') == [(0, 'row')]
+    assert SQLServer.convert_rows([], cols, 'columns') == {'id': [], 'name': []}
+    with pytest.raises(ValueError):
+        SQLServer.convert_rows(ROWS, cols, 'xml')
+
+
+class SqliteCursor(object):
+    """ A sqlite cursor behind the parts of the pyodbc cursor interface the wrapper uses """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, query, *params):
+        self.cursor.execute(query, params)
+        return self
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteConnection(object):
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+@pytest.fixture
+def starts(monkeypatch, tmp_path):
+    """ A pooled SQLServer on a sqlite starts table with ids 1 to 100 and two NULL ids """
+
+    path = str(tmp_path / 'starts.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE starts (id INTEGER, product TEXT)")
+    conn.executemany("INSERT INTO starts VALUES (?, ?)", [(i, 'product {}'.format(i % 3)) for i in range(100, 0, -1)] + [(None, 'none')] * 2)
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(pyodbc, 'connect', lambda conn_string: SqliteConnection(path))
+    return SQLServer(dsn='AUDREP', user_id='etl', password='secret', pool_size=4, pool_timeout=5)
+
+
+@pytest.mark.parametrize('partitions', [1, 3, 8, 200])
+def test_extract_partitioned_in_key_order(starts, partitions):
+    cols, batches = starts.extract_partitioned('starts', 'id', partitions=partitions, batch_size=7)
+    rows = [row for batch in batches for row in batch]
+    assert cols == ['id', 'product']
+    assert [row[0] for row in rows] == [None, None] + list(range(1, 101))
+    assert starts._SQLServer__pool.qsize() == starts._SQLServer__pool_opened
+
+
+def test_extract_partitioned_as_batches_arrive(starts):
+    cols, batches = starts.extract_partitioned('starts', 'id', partitions=8, ordered=False, max_workers=2, row_format='dict', where="product <> 'product 0'")
+    rows = [row for batch in batches for row in batch]
+    assert sorted(row['id'] or 0 for row in rows) == [0, 0] + [i for i in range(1, 101) if i % 3]
+
+
+@pytest.mark.parametrize('where', ["id IS NULL", "id > 1000"])
+def test_extract_partitioned_without_a_key_range(starts, where):
+    cols, batches = starts.extract_partitioned('starts', 'id', where=where, row_format='columns')
+    assert cols == ['id', 'product']
+    assert sum(len(batch['id']) for batch in batches) == (2 if where == "id IS NULL" else 0)
+
+
+def test_a_failed_partition_is_raised_to_the_reader(starts, monkeypatch):
+    execute = SqliteCursor.execute
+
+    def fail_last_partition(self, query, *params):
+        if params and params[0] == 75: raise pyodbc.Error('42000', "Partition failed")
+        return execute(self, query, *params)
+    monkeypatch.setattr(SqliteCursor, 'execute', fail_last_partition)
+
+    cols, batches = starts.extract_partitioned('starts', 'id', partitions=4)
+    read = []
+    with pytest.raises(pyodbc.Error, match='Partition failed'):
+        for batch in batches: read.extend(row[0] for row in batch)
+    assert read == [None, None] + list(range(1, 75)) # The partitions before [75, 100]
+    assert starts._SQLServer__pool.qsize() == starts._SQLServer__pool_opened
+
+
+def test_closing_a_partitioned_extract_early_frees_the_pool(starts):
+    cols, batches = starts.extract_partitioned('starts', 'id', partitions=8, batch_size=2)
+    next(batches)
+    batches.close()
+    assert starts._SQLServer__pool.qsize() == starts._SQLServer__pool_opened
+
+
+def test_extract_partitioned_needs_a_pool(monkeypatch):
+    monkeypatch.setattr(pyodbc, 'connect', lambda conn_string: FakeConnection())
+    with pytest.raises(RuntimeError):
+        SQLServer(dsn='AUDREP', user_id='etl', password='secret').extract_partitioned('starts', 'id')
+
+
+@pytest.mark.parametrize('low, high, partitions, ranges', [
+    (0, 100, 4, [(0, 25), (25, 50), (50, 75), (75, 100)]),
+    (1, 3, 8, [(1, 2), (2, 3)]),
+    (5, 5, 4, [(5, 5)]),
+    (0.0, 1.0, 2, [(0.0, 0.5), (0.5, 1.0)]),
+    (decimal.Decimal('0'), decimal.Decimal('1'), 2, [(decimal.Decimal('0'), decimal.Decimal('0.5')), (decimal.Decimal('0.5'), decimal.Decimal('1'))]),
+    (datetime.date(2019, 1, 1), datetime.date(2019, 1, 3), 4, [(datetime.date(2019, 1, 1), datetime.date(2019, 1, 2)), (datetime.date(2019, 1, 2), datetime.date(2019, 1, 3))]),
+    (datetime.datetime(2019, 1, 1), datetime.datetime(2019, 1, 1, 12), 2, [(datetime.datetime(2019, 1, 1), datetime.datetime(2019, 1, 1, 6)), (datetime.datetime(2019, 1, 1, 6), datetime.datetime(2019, 1, 1, 12))]),
+])
+def test_split_range(low, high, partitions, ranges):
+    assert SQLServer._split_range(low, high, partitions) == ranges
+
+
+@pytest.mark.parametrize('low, high', [(True, True), ('a', 'z')])
+def test_split_range_rejects_keys_it_cannot_split(low, high):
+    with pytest.raises(TypeError):
+        SQLServer._split_range(low, high, 4)
@@ -0,0 +1,95 @@
+import pytest
+from mediapub_extensions.Pipelines.Transfer import DirectoryWriter, SnowflakeWriter, Transfer
+
+
+class FakeSnowflake(object):
+    """ Records the stage calls SnowflakeWriter makes """
+
+    def __init__(self):
+        self.calls = []
+
+    def push_files(self, path, stage, prefix=''):
+        self.calls.append(('put', path, stage, prefix))
+
+    def process_files(self, table, stage, format, on_error='SKIP_FILE', purge=True, prefix=''):
+        self.calls.append(('copy', table, stage, prefix))
+
+
+def test_snowflake_writers_sharing_a_stage_use_their_own_prefix():
+    sf = FakeSnowflake()
+    starts = SnowflakeWriter(sf, 'STARTS', 'SHARED', 'CSV_GZIP')
+    stops = SnowflakeWriter(sf, 'STOPS', 'SHARED', 'CSV_GZIP')
+    starts.write(['id'], '/tmp/a/chunk_000000.csv.gz')
+    stops.write(['id'], '/tmp/b/chunk_000000.csv.gz')
+
+    assert starts.prefix and stops.prefix and starts.prefix != stops.prefix
+    assert sf.calls == [
+        ('put', '/tmp/a/chunk_000000.csv.gz', 'SHARED', starts.prefix),
+        ('copy', 'STARTS', 'SHARED', starts.prefix),
+        ('put', '/tmp/b/chunk_000000.csv.gz', 'SHARED', stops.prefix),
+        ('copy', 'STOPS', 'SHARED', stops.prefix),
+    ]
+
+
+class FakeReader(object):
+    """ Yields numbered batches and records whether the batches were closed """
+
+    def __init__(self, batches=100):
+        self.batches = batches
+        self.closed = False
+
+    def open(self):
+        self.generator = self.__iter_batches() # Held on to, so only an explicit close() runs its finally
+        return ['id'], self.generator
+
+    def __iter_batches(self):
+        try:
+            for index in range(self.batches):
+                yield [(index,)]
+        finally:
+            self.closed = True
+
+
+class FailingWriter(object):
+    needs_files = False
+
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.batches = []
+
+    def write(self, columns, rows):
+        if len(self.batches) == self.fail_at: raise IOError("disk full")
+        self.batches.append(rows)
+
+    def close(self):
+        pass
+
+
+class FailingSerializer(object):
+    def serialize(self, columns, rows, path):
+        raise ValueError("can not serialize")
+
+
+def test_a_failed_writer_closes_the_reader():
+    reader = FakeReader()
+    with pytest.raises(IOError):
+        Transfer(reader, FailingWriter(fail_at=2), queue_size=1).run()
+    assert reader.closed
+
+
+def test_a_failed_serializer_closes_the_reader(tmp_path):
+    reader = FakeReader()
+    with pytest.raises(ValueError):
+        Transfer(reader, DirectoryWriter(str(tmp_path)), serializer=FailingSerializer(), queue_size=1).run()
+    assert reader.closed
+
+
+def test_a_resumed_transfer_rewrites_the_batch_after_its_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / 'ids.checkpoint')
+    with pytest.raises(IOError):
+        Transfer(FakeReader(batches=5), FailingWriter(fail_at=2), checkpoint_file=checkpoint).run()
+
+    writer = FailingWriter(fail_at=None)
+    stats = Transfer(FakeReader(batches=5), writer, checkpoint_file=checkpoint).run()
+    assert stats['skipped_batches'] == 2
+    assert writer.batches == [[(2,)], [(3,)], [(4,)]]
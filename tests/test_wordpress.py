@@ -0,0 +1,104 @@
+import os
+import json
+import pytest
+from urllib.parse import urlparse, parse_qs
+
+requests = pytest.importorskip('requests')
+from mediapub_extensions.ApiWrappers import Wordpress as module
+from mediapub_extensions.ApiWrappers.Wordpress import Wordpress
+
+URL = 'https://example.com/wp-json/'
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.content = self.text.encode('utf-8')
+        self.reason = 'OK' if status_code == 200 else 'Bad Request'
+        self.headers = {}
+
+
+class FakeSite(object):
+    """ Serves pages of two posts, failing the pages in fail with a dropped connection """
+
+    def __init__(self, pages=4, fail=()):
+        self.pages = pages
+        self.fail = list(fail)
+        self.requested = []
+
+    def get(self, url, headers=None):
+        page = int(parse_qs(urlparse(url).query).get('page', ['1'])[0])
+        self.requested.append(page)
+        if page in self.fail:
+            self.fail.remove(page)
+            raise requests.exceptions.ConnectionError("Connection dropped on page {}".format(page))
+        if page > self.pages:
+            return FakeResponse(400, {'code': 'rest_post_invalid_page_number'})
+        return FakeResponse(200, [{'id': page * 10 + i, 'title': {'rendered': 'Post &amp; {}'.format(i)}} for i in range(2)])
+
+
+@pytest.fixture
+def site(monkeypatch):
+    site = FakeSite()
+    monkeypatch.setattr(module.requests, 'get', site.get)
+    monkeypatch.setattr(module.time, 'sleep', lambda seconds: None)
+    return site
+
+
+def ids(posts):
+    return [post['id'] for post in posts]
+
+
+def test_get_posts_reads_every_page(site):
+    posts = Wordpress(prod_url=URL).get_posts(env='prod', per_page=2)
+    assert ids(posts) == [10, 11, 20, 21, 30, 31, 40, 41]
+    assert posts[0]['title']['rendered'] == 'Post & 0'
+    assert site.requested == [1, 2, 3, 4, 5]
+
+
+def test_a_transient_failure_is_retried(site):
+    site.fail = [2, 2]
+    assert len(Wordpress(prod_url=URL).get_posts(env='prod')) == 8
+    assert site.requested == [1, 2, 2, 2, 3, 4, 5]
+
+
+def test_a_crawl_resumes_from_its_checkpoint(site, tmp_path):
+    checkpoint = str(tmp_path / 'posts.ndjson')
+    wp = Wordpress(prod_url=URL)
+    wp.page_retries = 0
+    site.fail = [3]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        wp.get_posts(env='prod', checkpoint_file=checkpoint)
+    assert len(open(checkpoint).readlines()) == 3 # The crawl header and pages 1 and 2
+
+    site.requested = []
+    posts = wp.get_posts(env='prod', checkpoint_file=checkpoint)
+    assert site.requested == [3, 4, 5]
+    assert ids(posts) == [10, 11, 20, 21, 30, 31, 40, 41]
+    assert posts[0]['title']['rendered'] == 'Post & 0'
+    assert not os.path.exists(checkpoint)
+
+
+def test_a_partly_written_page_is_fetched_again(site, tmp_path):
+    checkpoint = tmp_path / 'posts.ndjson'
+    wp = Wordpress(prod_url=URL)
+    wp.page_retries = 0
+    site.fail = [3]
+    with pytest.raises(requests.exceptions.ConnectionError):
+        wp.get_posts(env='prod', checkpoint_file=str(checkpoint))
+    lines = checkpoint.read_text().splitlines(True)
+    checkpoint.write_text(''.join(lines[:2]) + lines[2][:10]) # Crashed while writing page 2
+
+    site.requested = []
+    assert ids(wp.get_posts(env='prod', checkpoint_file=str(checkpoint))) == [10, 11, 20, 21, 30, 31, 40, 41]
+    assert site.requested == [2, 3, 4, 5]
+
+
+def test_a_checkpoint_from_another_crawl_is_refused(site, tmp_path):
+    checkpoint = str(tmp_path / 'posts.ndjson')
+    with open(checkpoint, 'w') as file:
+        file.write(json.dumps({'crawl': {'url': URL + 'wp/v2/posts/?after=2018&'}}) + "\n")
+    with pytest.raises(ValueError):
+        Wordpress(prod_url=URL).get_posts(env='prod', checkpoint_file=checkpoint)
+    assert site.requested == []